@@ -52,6 +52,117 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
 
+    subparser_modules.add_parser(
+        "validate",
+        help="""Check a detect config, its input files and the required
+        tools without running the pipeline.""",
+        description="Check a detect config, its input files and the required tools "
+        "without running the pipeline.",
+        parents=[subparser_args1],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    batch_parser = subparser_modules.add_parser(
+        "batch",
+        help="""Run many detect configs concurrently with a shared
+        thread budget.""",
+        description="Run many detect configs concurrently with a shared thread budget.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    batch_parser.add_argument("yaml_paths", nargs="+",
+                              help="""Paths to yaml configs, or directories
+                              of yaml configs.""")
+    batch_parser.add_argument("-t", "--threads", type=int, default=None,
+                              help="""Total threads shared by all jobs
+                              (default: all cores).""")
+    batch_parser.add_argument("-j", "--jobs", type=int, default=None,
+                              help="""Maximum number of concurrent jobs
+                              (default: all jobs).""")
+
+    sweep_parser = subparser_modules.add_parser(
+        "sweep",
+        parents=[subparser_args1],
+        help="""Pick clusters for many threshold combinations from a
+        finished run.""",
+        description="Pick clusters for every combination of support and distance "
+        "thresholds, reusing the tree and clade distances of a finished run.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    sweep_parser.add_argument("-s", "--fine_cluster_support", nargs="+",
+                              type=float, default=None,
+                              help="""Minimum cluster supports to try
+                              (default: CLUSTER_SWEEP in the yaml, else
+                              fine_cluster_support).""")
+    sweep_parser.add_argument("-d", "--distance_fraction", nargs="+",
+                              type=float, default=None,
+                              help="""Distance thresholds to try (default:
+                              CLUSTER_SWEEP in the yaml, else
+                              distance_fraction).""")
+
+    store_parser = subparser_modules.add_parser(
+        "store",
+        help="""Build an indexed sequence store from fasta files.""",
+        description="Build an indexed sequence store (.hvs) for use in QUERY_FILES.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    store_parser.add_argument("fasta_paths", nargs="+",
+                              help="""Paths to the input fasta files.""")
+    store_parser.add_argument("-o", "--output", required=True,
+                              help="""Path to the output store (.hvs).""")
+
+    bench_parser = subparser_modules.add_parser(
+        "bench",
+        help="""Benchmark the pipeline stages on synthetic outbreaks.""",
+        description="Simulate outbreaks of increasing size, time each pipeline stage "
+        "on them in isolation, and compare the results with earlier havic versions.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    bench_parser.add_argument("-o", "--outdir", default="havic_bench",
+                              help="""Directory for the simulated data, stage
+                              outputs and bench_results.tsv.""")
+    bench_parser.add_argument("-d", "--datasets", nargs="+",
+                              choices=["amplicon", "wgs"], default=["amplicon"],
+                              help="""Sequences to simulate: the HAVNET
+                              amplicon or the HAV genome.""")
+    bench_parser.add_argument("-n", "--sizes", nargs="+", type=int,
+                              default=[100, 1000, 10000, 50000],
+                              help="""Numbers of sequences to simulate.""")
+    bench_parser.add_argument("-s", "--stages", nargs="+", default=None,
+                              help="""Stages to measure (default: all).""")
+    bench_parser.add_argument("--seed", type=int, default=1,
+                              help="""Random seed of the simulations.""")
+    bench_parser.add_argument("--max_matrix_gb", type=float, default=4.0,
+                              help="""Skip SNP distances when the matrices
+                              would be larger than this.""")
+    bench_parser.add_argument("--baseline", default=None,
+                              help="""havic version to compare against
+                              (default: the latest other version in
+                              bench_results.tsv).""")
+    bench_parser.add_argument("--tolerance", type=float, default=1.25,
+                              help="""Report stages slower than the baseline
+                              by more than this factor.""")
+
+    serve_parser = subparser_modules.add_parser(
+        "serve",
+        parents=[subparser_args1],
+        help="""Keep a detect pipeline in memory and pick the clusters of
+        sequences submitted over HTTP.""",
+        description="Keep the reference, target region and mapping index of a detect "
+        "config in memory, and pick the clusters of fasta batches submitted to a "
+        "local HTTP API (POST /jobs, GET /jobs/<id>, GET /status).",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    serve_parser.add_argument("--host", default="127.0.0.1",
+                              help="""Address to listen on.""")
+    serve_parser.add_argument("-p", "--port", type=int, default=8765,
+                              help="""Port to listen on.""")
+    serve_parser.add_argument("--socket", default=None,
+                              help="""Listen on this Unix socket instead of
+                              a port.""")
+    serve_parser.add_argument("--coalesce", type=float, default=2.0,
+                              help="""Seconds to wait for further submissions
+                              before a pipeline update starts.""")
+
     subparser_modules.add_parser(
         "version", help="Print version.", description="Print version."
     )
@@ -93,6 +204,90 @@ def main():
         detection_pipeline._run()
         get_execution_time(yaml_in["OUTDIR"])
 
+    elif args.subparser_name == "validate":
+        import sys
+        import yaml
+        from .utils.validate import validate
+
+        yaml_in = yaml.load(open(args.yaml_path, "r"), Loader=yaml.FullLoader)
+        errors, warnings = validate(yaml_in)
+        for warning in warnings:
+            print(f"Warning: {warning}")
+        for error in errors:
+            print(f"Error: {error}")
+        if errors:
+            sys.exit(f"{args.yaml_path} is not valid ({len(errors)} errors).")
+        print(f"{args.yaml_path} is valid.")
+
+    elif args.subparser_name == "batch":
+        import sys
+        from .utils.batch import run_batch
+
+        failed = run_batch(args.yaml_paths, args.threads, args.jobs)
+        print(f"\nTotal runtime (HRS:MIN:SECS): {str(datetime.now() - STARTTIME)}")
+        sys.exit(1 if failed else 0)
+
+    elif args.subparser_name == "sweep":
+        import yaml
+
+        yaml_in = yaml.load(open(args.yaml_path, "r"), Loader=yaml.FullLoader)
+        sweep = yaml_in.get("CLUSTER_SWEEP") or {}
+        settings = yaml_in["CLUSTER_PICKER_SETTINGS"]
+        from .utils.pipeline_runner import Pipeline
+
+        prefix = Pipeline(yaml_in).sweep_clusters(
+            args.fine_cluster_support
+            or sweep.get("fine_cluster_support", [settings["fine_cluster_support"]]),
+            args.distance_fraction
+            or sweep.get("distance_fraction", [settings["distance_fraction"]]),
+        )
+        print(f"Cluster sweep written to {prefix}_sweep*.tsv")
+        get_execution_time(yaml_in["OUTDIR"])
+
+    elif args.subparser_name == "store":
+        import sys
+        from .utils.seq_store import build_store, is_store
+
+        if not is_store(args.output):
+            sys.exit(f"The store path must end in '.hvs', but was {args.output}")
+        stored, skipped = build_store(args.fasta_paths, args.output)
+        print(f"Stored {stored} sequences in {args.output} "
+              f"({skipped} duplicate ids skipped).")
+
+    elif args.subparser_name == "bench":
+        import sys
+        from . import __version__
+        from .utils.benchmark import (STAGES, compare_results, read_results,
+                                      run_benchmarks, write_results)
+
+        stages = args.stages or STAGES
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            sys.exit(f"Unknown stages {', '.join(sorted(unknown))}, choose from "
+                     f"{', '.join(STAGES)}.")
+        tsv = str(PurePath(args.outdir, "bench_results.tsv"))
+        write_results(run_benchmarks(args.outdir, args.datasets, args.sizes,
+                                     stages, args.seed, args.max_matrix_gb), tsv)
+        rows = read_results(tsv)
+        baseline = args.baseline or next(
+            (row["havic_version"] for row in reversed(rows)
+             if row["havic_version"] != __version__), None)
+        if baseline:
+            regressed = compare_results(rows, baseline, __version__, args.tolerance)
+            for dataset, sequences, stage, before, after in regressed:
+                print(f"Slower than {baseline}: {stage} on {sequences} {dataset} "
+                      f"sequences, {before:.2f} -> {after:.2f} secs")
+            if not regressed:
+                print(f"No stage is slower than in havic {baseline}.")
+        get_execution_time(args.outdir)
+
+    elif args.subparser_name == "serve":
+        import yaml
+        from .utils.service import serve
+
+        yaml_in = yaml.load(open(args.yaml_path, "r"), Loader=yaml.FullLoader)
+        serve(yaml_in, args.host, args.port, args.socket, args.coalesce)
+
     elif args.subparser_name == "version":
         from .utils.version import Version
 
@@ -6,12 +6,10 @@ R_LIBS = [
     "BiocManager",
     "Biostrings",
     "colorspace",
-    "GenomicAlignments",
     "ggtree",
     "magick",
     "pheatmap",
     "phytools",
     "Rcpp",
-    "Rsamtools",
     "tidyverse",
 ]
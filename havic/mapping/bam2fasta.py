@@ -1,18 +1,95 @@
-bam2fasta = '''
-library(GenomicAlignments)
-library(Rsamtools)
-bamFile <- BamFile('%s', index = '%s')
-bamFile
-seqinfo(bamFile)
-outp <- stackStringsFromBam(bamFile,
-                            param=GRanges('%s', IRanges(%d, %d)),
-                            Lpadding.letter='-',
-                            Rpadding.letter='-',
-                            use.names = T)
-sink('%s')
-for(i in 1:length(outp)){
-    cat('>',names(outp[i]), '\n', sep='')
-    cat(toString(outp[[i]]), '\n', sep='')
-}
-sink()
-'''
+#!/usr/bin/env python3
+
+"""Stack mapped query sequences on the reference to get an MSA.
+
+Each alignment in the bam file is projected onto reference coordinates using
+its CIGAR string: insertions relative to the reference are dropped,
+deletions are filled with '-', skipped reference regions with '.', and the
+sequence is padded with '-' to the left and right of the aligned region.
+This mirrors GenomicAlignments::stackStringsFromBam().
+"""
+
+import pysam
+
+# CIGAR operation codes, as used by the SAM specification, pysam and mappy.
+CONSUMES_BOTH = {0, 7, 8}  # M, =, X
+CONSUMES_QUERY = {1, 4}  # I, S
+DELETION = 2  # D
+REF_SKIP = 3  # N
+
+
+def project_to_reference(cigartuples, ref_start, query, region_start,
+                         region_end, pad="-", del_char="-", skip_char="."):
+    """Project an aligned query onto a window of the reference.
+
+    Args:
+        cigartuples (list): (operation, length) tuples.
+        ref_start (int): 0-based reference position of the first aligned base.
+        query (str): the query sequence, in reference orientation, including
+            soft-clipped bases.
+        region_start (int): 0-based start of the reference window.
+        region_end (int): 0-based, exclusive end of the reference window.
+        pad (str): left and right padding character.
+        del_char (str): character for deleted reference bases.
+        skip_char (str): character for skipped reference regions.
+
+    Returns:
+        str: the projected sequence, of length region_end - region_start.
+
+    >>> project_to_reference([(4, 2), (0, 3), (1, 1), (0, 2), (2, 2), (0, 1)],
+    ...                      3, 'xxACGTTCAG', 0, 14)
+    '---ACGTC--A---'
+    """
+    stacked = bytearray(pad.encode() * (region_end - region_start))
+    query = query.encode()
+    ref_pos, query_pos = ref_start, 0
+    for operation, length in cigartuples:
+        if operation in CONSUMES_BOTH:
+            fill = query[query_pos:query_pos + length]
+            query_pos += length
+        elif operation in CONSUMES_QUERY:
+            query_pos += length
+            continue
+        elif operation == DELETION:
+            fill = del_char.encode() * length
+        elif operation == REF_SKIP:
+            fill = skip_char.encode() * length
+        else:  # H and P consume neither sequence
+            continue
+        start = max(ref_pos, region_start)
+        end = min(ref_pos + length, region_end)
+        if start < end:
+            stacked[start - region_start:end - region_start] = \
+                fill[start - ref_pos:end - ref_pos]
+        ref_pos += length
+    return stacked.decode()
+
+
+def stack_strings_from_bam(bam, contig, start, end):
+    """Stack the reads mapped to a reference region.
+
+    Args:
+        bam (str): path to an indexed bam file.
+        contig (str): reference sequence name.
+        start (int): 0-based start of the region.
+        end (int): 0-based, exclusive end of the region.
+
+    Yields:
+        tuple: (read name, projected sequence)
+    """
+    with pysam.AlignmentFile(bam, "rb") as bam_h:
+        for read in bam_h.fetch(contig, start, end):
+            if read.is_unmapped or read.query_sequence is None:
+                continue
+            yield read.query_name, project_to_reference(
+                read.cigartuples,
+                read.reference_start,
+                read.query_sequence,
+                start,
+                end,
+            )
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""Map query sequences to the reference in-process with mappy.
+
+The minimap2 index of the reference is built once per reference and k-mer
+size and cached on disk as a '.mmi' file.  Query records are mapped in
+parallel threads, the first primary hit of each query is projected onto the
+reference, and the ids of unmapped queries are collected in the same pass.
+A bam file is only written on request.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import mappy
+import pysam
+from Bio.Seq import reverse_complement
+from .bam2fasta import project_to_reference
+
+SOFT_CLIP = 4
+
+
+def kmer_size(k_mer):
+    """Get the k-mer size from the MAPPER_SETTINGS k_mer option.
+
+    Args:
+        k_mer (str): the minimap2 option, e.g., '-k 5'.
+
+    Returns:
+        int: the k-mer size, or None if not set.
+
+    >>> kmer_size("-k 5")
+    5
+    """
+    match = re.search(r"-k\s*(\d+)", str(k_mer))
+    return int(match.group(1)) if match else None
+
+
+def index_path(subject, k, index_dir):
+    """Path of the cached index for a reference and k-mer size.
+
+    Args:
+        subject (str): path to the reference fasta.
+        k (int): k-mer size, or None for the minimap2 default.
+        index_dir (str): directory holding the cached indexes.
+
+    Returns:
+        Path: the '.mmi' path, keyed on the reference contents.
+    """
+    digest = hashlib.sha256(Path(subject).read_bytes()).hexdigest()[:16]
+    return Path(index_dir).expanduser().joinpath(f"{digest}.k{k or 'default'}.mmi")
+
+
+def load_aligner(subject, k, index_dir, threads):
+    """Load the cached reference index, building it if needed.
+
+    Args:
+        subject (str): path to the reference fasta.
+        k (int): k-mer size, or None for the minimap2 default.
+        index_dir (str): directory holding the cached indexes.
+        threads (int): number of mapping threads.
+
+    Returns:
+        mappy.Aligner: the aligner.
+    """
+    mmi = index_path(subject, k, index_dir)
+    if not mmi.is_file():
+        mmi.parent.mkdir(parents=True, exist_ok=True)
+        tmp = mmi.with_suffix(f".{os.getpid()}.tmp")
+        options = {"k": k} if k else {}
+        if not mappy.Aligner(str(subject), fn_idx_out=str(tmp), **options):
+            raise RuntimeError(f"Unable to build a minimap2 index for {subject}")
+        os.replace(tmp, mmi)  # other runs never see a partial index
+        print(f"Wrote minimap2 index {mmi}")
+    aligner = mappy.Aligner(str(mmi), n_threads=threads)
+    if not aligner:
+        raise RuntimeError(f"Unable to load the minimap2 index {mmi}")
+    return aligner
+
+
+def oriented_alignment(seq, hit):
+    """Express a mappy hit as soft-clipped CIGAR tuples on the reference strand.
+
+    Args:
+        seq (str): the query sequence.
+        hit (mappy.Alignment): a hit of the query.
+
+    Returns:
+        tuple: (cigartuples, query sequence in reference orientation)
+
+    >>> from types import SimpleNamespace
+    >>> oriented_alignment("AACGT", SimpleNamespace(
+    ...     q_st=1, q_en=4, strand=-1, cigar=[[3, 0]]))
+    ([(4, 1), (0, 3), (4, 1)], 'ACGTT')
+    """
+    if hit.strand < 0:
+        seq = reverse_complement(seq)
+        left, right = len(seq) - hit.q_en, hit.q_st
+    else:
+        left, right = hit.q_st, len(seq) - hit.q_en
+    cigartuples = [(operation, length) for length, operation in hit.cigar]
+    if left:
+        cigartuples.insert(0, (SOFT_CLIP, left))
+    if right:
+        cigartuples.append((SOFT_CLIP, right))
+    return cigartuples, seq
+
+
+def map_records(aligner, records, threads):
+    """Map query records, keeping the first primary hit of each.
+
+    Args:
+        aligner (mappy.Aligner): the loaded aligner.
+        records (iterable): SeqRecords to map.
+        threads (int): number of mapping threads.
+
+    Returns:
+        list: (SeqRecord, hit) tuples in input order; hit is None if the
+            query did not map.
+    """
+    local = threading.local()
+
+    def map_one(record):
+        if not hasattr(local, "buffer"):
+            local.buffer = mappy.ThreadBuffer()
+        for hit in aligner.map(str(record.seq), buf=local.buffer):
+            if hit.is_primary:
+                return record, hit
+        return record, None
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(map_one, records))
+
+
+def stack_mapped(mapped, start, end):
+    """Project the mapped queries onto a reference window.
+
+    Args:
+        mapped (list): (SeqRecord, hit) tuples from map_records().
+        start (int): 0-based start of the window.
+        end (int): 0-based, exclusive end of the window.
+
+    Yields:
+        tuple: (query id, projected sequence) for each hit overlapping the
+            window, in reference start order, as from a sorted bam file.
+    """
+    hits = sorted((hit.r_st, idx, record, hit)
+                  for idx, (record, hit) in enumerate(mapped)
+                  if hit is not None and hit.r_st < end and hit.r_en > start)
+    for ref_start, _, record, hit in hits:
+        # upper case, as the sequence would be read back from a bam file
+        cigartuples, seq = oriented_alignment(str(record.seq).upper(), hit)
+        yield record.id, project_to_reference(cigartuples, ref_start, seq,
+                                              start, end)
+
+
+def write_bam(mapped, contig, length, bam):
+    """Write the primary hits and unmapped queries as a sorted, indexed bam.
+
+    Args:
+        mapped (list): (SeqRecord, hit) tuples from map_records().
+        contig (str): reference sequence name.
+        length (int): reference sequence length.
+        bam (str): output path.
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": length}]}
+    order = sorted(mapped, key=lambda pair: (pair[1] is None,
+                                             pair[1].r_st if pair[1] else 0))
+    with pysam.AlignmentFile(bam, "wb", header=header) as bam_h:
+        for record, hit in order:
+            segment = pysam.AlignedSegment(bam_h.header)
+            segment.query_name = record.id
+            if hit is None:
+                segment.flag = 4
+                segment.query_sequence = str(record.seq)
+            else:
+                cigartuples, seq = oriented_alignment(str(record.seq), hit)
+                segment.flag = 16 if hit.strand < 0 else 0
+                segment.reference_id = 0
+                segment.reference_start = hit.r_st
+                segment.mapping_quality = hit.mapq
+                segment.cigartuples = cigartuples
+                segment.query_sequence = seq
+            bam_h.write(segment)
+    pysam.index(bam)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""Draw the results plots in-process with matplotlib.
+
+This is the 'matplotlib' PLOTS_ENGINE, an alternative to the R script in
+treeplot_snpplot.py that writes the same PDF files.  The tree is drawn as a
+single line collection and the alignment and SNP matrices as images embedded
+at their own resolution, with alignment columns sampled down to a fixed
+width, so drawing time and file size stay small for thousands of tips.  Tip
+labels, support values and matrix numbers are only drawn while they would be
+legible.  The heatmap PDF has a page per cluster after the whole matrix, so
+cluster distances can be read at any cohort size.  Figures are built without
+pyplot, so they can be drawn in worker threads.
+"""
+
+import re
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.colors import ListedColormap
+
+# As the msaplot colours of the R script: gap, A, C, G, T, then other bases
+MSA_COLOURS = ["#f7fcfd", "#ef3b2c", "#41ab5d", "#ffffbf", "#4292c6", "#dface5"]
+MSA_CODES = np.full(256, 5, dtype=np.uint8)
+for _code, _bases in enumerate(["-", "A", "C", "G", "T"]):
+    MSA_CODES[ord(_bases)] = MSA_CODES[ord(_bases.lower())] = _code
+CLUSTER_TIP = re.compile(r"^Clust(\d+)_(.+)$")
+A4_LANDSCAPE = (11.69, 8.27)
+
+
+def font_size(n_tips):
+    """Tip label size in points, shrinking with the number of tips as in
+    the R script.
+
+    >>> round(font_size(10), 2)
+    5.42
+    """
+    return max(0.5, -0.005093 * n_tips + 1.955556) * 72.27 / 25.4
+
+
+def cluster_assignments(cluster_tree):
+    """Read the cluster of each tip from ClusterPicker 'ClustN_' tip names.
+
+    Args:
+        cluster_tree (ete3.Tree): the '_clusterPicks.nwk' tree.
+
+    Returns:
+        dict: cluster number keyed on tip name, for clustered tips.
+
+    >>> from ete3 import Tree
+    >>> cluster_assignments(Tree("((Clust1_a,Clust1_b),c);"))
+    {'a': 1, 'b': 1}
+    """
+    clusters = {}
+    for name in cluster_tree.get_leaf_names():
+        match = CLUSTER_TIP.match(name)
+        if match:
+            clusters[match.group(2)] = int(match.group(1))
+    return clusters
+
+
+def cluster_colours(clusters):
+    """A colour per cluster number, cycling through a qualitative palette.
+
+    Args:
+        clusters (dict): cluster number keyed on tip name.
+
+    Returns:
+        dict: hex colour keyed on cluster number.
+    """
+    from matplotlib import colormaps
+    palette = colormaps["tab10"].colors
+    return {number: palette[idx % len(palette)]
+            for idx, number in enumerate(sorted(set(clusters.values())))}
+
+
+def tree_layout(tree):
+    """Lay out a rectangular tree, first tip at the top.
+
+    Args:
+        tree (ete3.Tree): the rooted tree.
+
+    Returns:
+        tuple: tip names in plotting order, line segments, and (x, y) of
+            each node keyed on node.
+
+    >>> from ete3 import Tree
+    >>> tips, segments, xy = tree_layout(Tree("((a:1,b:2):1,c:1);"))
+    >>> tips, len(segments)
+    (['a', 'b', 'c'], 6)
+    """
+    xy = {}
+    for node in tree.traverse("preorder"):
+        xy[node] = [0.0 if node.is_root() else xy[node.up][0] + node.dist, None]
+    tips = []
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            xy[node][1] = len(tips)
+            tips.append(node.name)
+        else:
+            xy[node][1] = (xy[node.children[0]][1] + xy[node.children[-1]][1]) / 2
+    segments = []
+    for node in tree.traverse("preorder"):
+        x, y = xy[node]
+        if not node.is_root():
+            segments.append([(xy[node.up][0], y), (x, y)])
+        if not node.is_leaf():
+            segments.append([(x, xy[node.children[0]][1]),
+                             (x, xy[node.children[-1]][1])])
+    return tips, segments, {node: tuple(pos) for node, pos in xy.items()}
+
+
+def encode_msa(alignment, tips, max_columns=2000):
+    """Encode the alignment rows in tip order as colour indexes.
+
+    Args:
+        alignment (MultipleSeqAlignment): the trimmed alignment.
+        tips (list): tip names in plotting order.
+        max_columns (int): columns beyond this are sampled evenly.
+
+    Returns:
+        np.ndarray: (tips x columns) uint8 indexes into MSA_COLOURS; rows of
+            tips missing from the alignment are gaps.
+    """
+    width = alignment.get_alignment_length()
+    columns = np.arange(width) if width <= max_columns else \
+        np.linspace(0, width - 1, max_columns).round().astype(int)
+    rows = {record.id: record for record in alignment}
+    codes = np.zeros((len(tips), len(columns)), dtype=np.uint8)
+    for row, tip in enumerate(tips):
+        if tip in rows:
+            seq = np.frombuffer(str(rows[tip].seq).encode("ascii"), dtype=np.uint8)
+            codes[row] = MSA_CODES[seq[columns]]
+    return codes
+
+
+def plot_tree_msa(tree, alignment, clusters, highlight, subtitle, pdf,
+                  max_columns=2000, label_limit=300):
+    """Draw the tree with tips coloured by cluster, beside the alignment.
+
+    Args:
+        tree (ete3.Tree): the rooted tree, with support values.
+        alignment (MultipleSeqAlignment): the trimmed alignment.
+        clusters (dict): cluster number keyed on tip name.
+        highlight (list): tip names to mark.
+        subtitle (str): the plot subtitle.
+        pdf (str): output path.
+        max_columns (int): alignment columns drawn at most.
+        label_limit (int): tip labels and supports are drawn up to this
+            many tips.
+    """
+    tips, segments, xy = tree_layout(tree)
+    colours = cluster_colours(clusters)
+    size = font_size(len(tips))
+    fig = Figure(figsize=A4_LANDSCAPE)
+    ax_tree, ax_msa = fig.subplots(1, 2, sharey=True,
+                                   gridspec_kw={"width_ratios": [1, 1], "wspace": 0.3})
+    ax_tree.add_collection(LineCollection(segments, colors="black", linewidths=0.3))
+    ax_tree.autoscale_view()
+    ax_tree.set_ylim(len(tips) - 0.5, -0.5)
+    ax_tree.axis("off")
+    marked = [xy[leaf] for leaf in tree.iter_leaves() if leaf.name in set(highlight)]
+    if marked:
+        ax_tree.scatter(*zip(*marked), s=size * 4, color="red", alpha=0.7,
+                        marker="^", zorder=3, label="query")
+        ax_tree.legend(loc="lower left", fontsize=6, frameon=False)
+    ax_msa.imshow(encode_msa(alignment, tips, max_columns), aspect="auto",
+                  interpolation="none", cmap=ListedColormap(MSA_COLOURS),
+                  vmin=0, vmax=len(MSA_COLOURS) - 1)
+    ax_msa.set_xlabel("alignment column" if alignment.get_alignment_length()
+                      <= max_columns else "alignment column (sampled)", fontsize=6)
+    ax_msa.tick_params(axis="x", labelsize=5)
+    ax_msa.set_yticks([])
+    if len(tips) <= label_limit:
+        for node in tree.traverse():
+            if not node.is_leaf() and not node.is_root() and node.support >= 70:
+                ax_tree.text(*xy[node], f"{int(node.support)}", fontsize=size,
+                             ha="right", va="bottom")
+        # aligned tip labels between the tree and the alignment
+        for row, tip in enumerate(tips):
+            ax_msa.text(-0.02, row, tip, transform=ax_msa.get_yaxis_transform(),
+                        fontsize=size, ha="right", va="center",
+                        color=colours.get(clusters.get(tip), "black"))
+    fig.suptitle("ML IQtree with bootstrap %, tips cluster-picked (left); "
+                 "fasta alignment (right)", fontsize=9)
+    ax_tree.set_title(subtitle, fontsize=7, loc="left")
+    fig.savefig(pdf, dpi=300)
+
+
+def heatmap_order(ids, tips, max_cells=None):
+    """Order the matrix rows as the tree tips, sampling large matrices.
+
+    Args:
+        ids (list): sequence ids, in matrix order.
+        tips (list): tip names in plotting order; ids not in the tree
+            follow them.
+        max_cells (int): rows beyond this are sampled evenly, or None.
+
+    Returns:
+        np.ndarray: matrix indexes in plotting order.
+
+    >>> heatmap_order(["c", "b", "a", "x"], ["a", "b", "c"]).tolist()
+    [2, 1, 0, 3]
+    >>> heatmap_order(["c", "b", "a", "x"], ["a", "b", "c"], max_cells=2).tolist()
+    [2, 3]
+    """
+    index = {seqid: idx for idx, seqid in enumerate(ids)}
+    order = [index[tip] for tip in tips if tip in index]
+    order = np.array(order + sorted(set(range(len(ids))) - set(order)), dtype=int)
+    if max_cells and len(order) > max_cells:
+        order = order[np.linspace(0, len(order) - 1, max_cells).round().astype(int)]
+    return order
+
+
+def _draw_heatmap(matrix, names, clusters, colours, vmax, title, numbers,
+                  label_limit):
+    """Draw one heatmap page, with a cluster strip and colour bar."""
+    fig = Figure(figsize=A4_LANDSCAPE)
+    if not names:  # an empty alignment still gets its page
+        ax_heat = fig.subplots()
+        ax_heat.axis("off")
+        ax_heat.set_title(title, fontsize=8)
+        ax_heat.text(0.5, 0.5, "No sequences", ha="center", va="center")
+        return fig
+    # the spacer leaves room for the row labels, right of the heatmap
+    ax_clusters, ax_heat, ax_spacer, ax_bar = fig.subplots(
+        1, 4, gridspec_kw={"width_ratios": [1, 40, 8, 1], "wspace": 0.05})
+    ax_spacer.axis("off")
+    # embedded at the matrix resolution, not resampled to the page
+    image = ax_heat.imshow(matrix, aspect="auto", interpolation="none",
+                           cmap="RdYlBu_r", vmin=0, vmax=vmax)
+    fig.colorbar(image, cax=ax_bar, label="SNPs")
+    strip = [colours.get(clusters.get(name), (1.0, 1.0, 1.0)) for name in names]
+    ax_clusters.imshow(np.array(strip)[:, None, :], aspect="auto",
+                       interpolation="none")
+    ax_clusters.set_xticks([])
+    ax_clusters.set_yticks([])
+    ax_clusters.set_title("Cluster", fontsize=6)
+    ax_heat.set_title(title, fontsize=8)
+    # no larger than the row height (about 5.5 inches over all rows)
+    size = min(font_size(len(names)) * 2, 0.8 * 72 * 5.5 / len(names))
+    if len(names) <= label_limit:
+        labels = [f"{clusters[name]}_{name}" if name in clusters else name
+                  for name in names]
+        ax_heat.set_xticks(range(len(names)))
+        ax_heat.set_xticklabels(labels, fontsize=size, rotation=90)
+        ax_heat.set_yticks(range(len(names)))
+        ax_heat.set_yticklabels(labels, fontsize=size)
+        ax_heat.yaxis.tick_right()
+    else:
+        ax_heat.set_xticks([])
+        ax_heat.set_yticks([])
+    if numbers:
+        for (row, col), value in np.ndenumerate(matrix):
+            ax_heat.text(col, row, f"{value:.0f}", fontsize=size * 0.8,
+                         ha="center", va="center")
+    return fig
+
+
+def plot_snp_heatmap(ids, snps, tips, clusters, pdf, label_limit=300,
+                     number_limit=60, max_cells=2000, max_tiles=20):
+    """Draw the pairwise SNP distances in tree order, then a zoomed tile per
+    cluster.
+
+    The first page holds the whole matrix, sampled to at most max_cells rows
+    and columns.  Each following page is the matrix of one cluster, with
+    the cell values drawn; all pages share one colour scale.
+
+    Args:
+        ids (list): sequence ids, in matrix order.
+        snps (np.ndarray): (n x n) SNP counts.
+        tips (list): tip names in plotting order; ids not in the tree
+            follow them.
+        clusters (dict): cluster number keyed on tip name.
+        pdf (str): output path.
+        label_limit (int): row and column labels are drawn up to this many
+            sequences.
+        number_limit (int): cell values are drawn up to this many sequences
+            on the first page, and on tiles of up to this many members.
+        max_cells (int): rows and columns drawn at most on the first page.
+        max_tiles (int): cluster tiles drawn at most, in cluster order.
+    """
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    colours = cluster_colours(clusters)
+    vmax = max(int(snps.max()), 1) if len(ids) else 1
+    order = heatmap_order(ids, tips, max_cells)
+    title = "Pairwise SNPs" if len(order) == len(ids) else \
+        f"Pairwise SNPs (sampled, {len(order)} of {len(ids)} sequences)"
+    with PdfPages(pdf) as pages:
+        pages.savefig(_draw_heatmap(
+            snps[np.ix_(order, order)], [ids[idx] for idx in order], clusters,
+            colours, vmax, title, len(ids) <= number_limit, label_limit), dpi=300)
+        members = {}
+        for idx in heatmap_order(ids, tips):
+            if ids[idx] in clusters:
+                members.setdefault(clusters[ids[idx]], []).append(idx)
+        for number in sorted(members)[:max_tiles]:
+            tile = members[number]
+            pages.savefig(_draw_heatmap(
+                snps[np.ix_(tile, tile)], [ids[idx] for idx in tile], clusters,
+                colours, vmax, f"Cluster {number} ({len(tile)} sequences)",
+                len(tile) <= number_limit, label_limit), dpi=300)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
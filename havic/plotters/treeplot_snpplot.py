@@ -125,45 +125,10 @@ if(matrixplots){
 }
 
 
-aln <- read.dna(basename, format = 'fasta', as.character = TRUE)
-snp_dists <- function(alignment, exclude_char){
-    mat <- matrix(0, nrow = nrow(alignment), ncol = nrow(alignment))
-    colnames(mat) <- rownames(alignment)
-    rownames(mat) <- rownames(alignment)
-    mat_snps <- mat
-    pw_dist <- function(Aln_sub){
-        len_aln <- Aln_sub[, c(which(!(Aln_sub[1,] %in% exclude_char) &
-                                     !(Aln_sub[2,] %in% exclude_char)
-                                    )
-                              ),
-                           drop=FALSE]
-        n_snps <- len_aln[, c(which(len_aln[1,]!=len_aln[2,])), drop=FALSE]
-        return(c(paste0('=', ncol(n_snps), '/', ncol(len_aln)), ncol(n_snps)))
-    }
-    for(i in 1:nrow(alignment)){
-        for(j in i:nrow(alignment)){
-            seq1 <- rownames(alignment)[i]
-            seq2 <- rownames(alignment)[j]
-            val <- pw_dist(alignment[c(i,j), , drop=FALSE])
-            mat[seq1, seq2] <- val[1]
-            mat[seq2, seq1] <- val[1]
-            mat_snps[seq1, seq2] = as.numeric(val[2])
-            mat_snps[seq2, seq1] = as.numeric(val[2])
-            }
-        }
-    return(list(mat, mat_snps))
-}
-
-exclusions <- tolower(c(names(IUPAC_CODE_MAP)[!(names(IUPAC_CODE_MAP) %in%
-                                                c('A', 'C', 'T', 'G')
-                                               )
-                                             ],
-                        '-', '?')
-                     )
-
-#Returns two matrices
-snps <- snp_dists(aln, exclusions)
-heatmap_data <- snps[[2]]
+# SNP distances are computed by havic (see havic/utils/snp_dists.py)
+heatmap_data <- as.matrix(read.csv(paste0(basename, '_SNPdists.csv'),
+                                   row.names = 1,
+                                   check.names = FALSE))
 
 if(matrixplots){
     library(pheatmap)
@@ -194,18 +159,10 @@ if(matrixplots){
          annotation_col = annos,
          annotation_colors = cluster_colors_,
          labels_row = labs_row,
-         display_numbers = TRUE,
+         display_numbers = nrow(heatmap_data) <= 60,
          number_format = '%.0f',
          fontsize = fntsz*2))
     dev.off()
 }
 
-
-write.csv(x=heatmap_data, file=paste0(basename,
-                                      '_SNPdists.csv'),
-          quote=FALSE)
-
-write.csv(snps[[1]], file=paste0(basename,
-                                 '_SNPcountsOverAlignLength.csv'),
-          quote = FALSE)
 """
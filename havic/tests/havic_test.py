@@ -8,24 +8,33 @@ Unit Tests.
 
 import unittest
 
-from pkg_resources import resource_filename as rf
 from pathlib import Path
 import yaml
 import sys
-from .. import (__parent_dir__,
-                __havic_yaml__,
+import os
+import tempfile
+from .. import (__havic_yaml__,
                 __havic_wgs_yaml__,
                 __havic_PMC7259881__,
                 __measles_wgs_yaml__,
                 __hiv_amplicon_yaml__,
                 __version__)
+from ..utils.paths import package_path
 from ..utils.pipeline_runner import Pipeline
 
 
+class TempDirTestCase(unittest.TestCase):
+    """Give each test a temporary directory, self.tmpdir."""
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
 class HavAmpliconTestCase(unittest.TestCase):
     def setUp(self):
         self.version = __version__
-        self.yaml = yaml.load(open(rf(__parent_dir__, __havic_yaml__)), Loader=yaml.FullLoader)
+        self.yaml = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
 
     def yamler(self):
         """Check yaml loader."""
@@ -59,7 +68,8 @@ class HavAmpliconTestCase(unittest.TestCase):
 
 class HavWgsTestCase(unittest.TestCase):
     def setUp(self):
-        self.wgsyaml = yaml.load(open(rf(__parent_dir__, __havic_wgs_yaml__)), Loader=yaml.FullLoader)
+        self.wgsyaml = yaml.load(open(package_path(__havic_wgs_yaml__)),
+                                 Loader=yaml.FullLoader)
         self.detection_pipeline_wgs = Pipeline(self.wgsyaml)
 
     def wgs_suite_runner(self):
@@ -71,7 +81,8 @@ class HavWgsTestCase(unittest.TestCase):
 
 class MeaslesAmpliconTestCase(unittest.TestCase):
     def setUp(self):
-        self.measlesyaml = yaml.load(open(rf(__parent_dir__, __measles_wgs_yaml__)), Loader=yaml.FullLoader)
+        self.measlesyaml = yaml.load(open(package_path(__measles_wgs_yaml__)),
+                                     Loader=yaml.FullLoader)
         self.detection_pipeline_measles = Pipeline(self.measlesyaml)
 
     def measles_suite_runner(self):
@@ -83,7 +94,8 @@ class MeaslesAmpliconTestCase(unittest.TestCase):
 
 class HivAmpliconTestCase(unittest.TestCase):
     def setUp(self):
-        self.hivyaml = yaml.load(open(rf(__parent_dir__, __hiv_amplicon_yaml__)), Loader=yaml.FullLoader)
+        self.hivyaml = yaml.load(open(package_path(__hiv_amplicon_yaml__)),
+                                 Loader=yaml.FullLoader)
         self.detection_pipeline_hiv = Pipeline(self.hivyaml)
 
     def hiv_suite_runner(self):
@@ -95,7 +107,8 @@ class HivAmpliconTestCase(unittest.TestCase):
 
 class HavPmcTestCase(unittest.TestCase):
     def setUp(self):
-        self.PMC7259881yaml = yaml.load(open(rf(__parent_dir__, __havic_PMC7259881__)), Loader=yaml.FullLoader)
+        self.PMC7259881yaml = yaml.load(open(package_path(__havic_PMC7259881__)),
+                                        Loader=yaml.FullLoader)
         self.detection_pipeline_PMC7259881 = Pipeline(self.PMC7259881yaml)
 
     def pmc_suite_runner(self):
@@ -104,3 +117,731 @@ class HavPmcTestCase(unittest.TestCase):
         """
         self.detection_pipeline_PMC7259881._run()
         self.assertTrue(len(list(Path(self.detection_pipeline_PMC7259881.outdir).glob("*.pdf"))) >= 2)
+
+class SnpDistsTestCase(unittest.TestCase):
+    def setUp(self):
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        self.alignment = MultipleSeqAlignment(
+            [SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+             [("a", "ACGTACGT--"), ("b", "ACGAACGTAC"), ("c", "nCGAAYGTAC")]]
+        )
+
+    def snp_counter(self):
+        """
+        Check SNP and comparable-site counts against the R snp_dists rules.
+        """
+        from ..utils.snp_dists import snp_distances
+        ids, snps, sites = snp_distances(self.alignment, block_size=2, threads=2)
+        self.assertEqual(ids, ["a", "b", "c"])
+        self.assertEqual(snps.tolist(), [[0, 1, 1], [1, 0, 0], [1, 0, 0]])
+        self.assertEqual(sites.tolist(), [[8, 8, 6], [8, 10, 8], [6, 8, 8]])
+
+    def snp_writer(self):
+        """
+        Read back the SNP counts from the csv and npz outputs.
+        """
+        from ..utils.snp_dists import (snp_distances, write_snp_csvs, read_snp_csv,
+                                       write_snp_npz, read_snp_npz)
+        ids, snps, sites = snp_distances(self.alignment)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csvs = [Path(tmpdir).joinpath(fname) for fname in ["dists.csv", "counts.csv"]]
+            npz = Path(tmpdir).joinpath("dists.npz")
+            write_snp_csvs(ids, snps, sites, *csvs)
+            write_snp_npz(ids, snps, sites, npz)
+            for read_ids, read_snps in [read_snp_csv(csvs[0]), read_snp_npz(npz)]:
+                self.assertEqual(read_ids, ids)
+                self.assertEqual(read_snps.tolist(), snps.tolist())
+
+    def snp_storer(self):
+        """
+        Compare only the new and changed rows against a distance store.
+        """
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        from ..utils.snp_dists import snp_distances, stored_snp_distances
+        updated = MultipleSeqAlignment(
+            [SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+             [("c", "nCGAAYGTAC"), ("a", "ACGTACGT--"), ("b", "TCGAACGTAC")]]
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = Path(tmpdir).joinpath("store.npz")
+            self.assertEqual(stored_snp_distances(self.alignment, store, "a")[3], 3)
+            ids, snps, sites, computed = stored_snp_distances(updated, store, "a")
+            full_ids, full_snps, full_sites = snp_distances(updated)
+            self.assertEqual(computed, 1)
+            self.assertEqual(ids, full_ids)
+            self.assertEqual(snps.tolist(), full_snps.tolist())
+            self.assertEqual(sites.tolist(), full_sites.tolist())
+            updated[1].seq = updated[1].seq.replace("--", "AC")  # a new window
+            self.assertEqual(stored_snp_distances(updated, store, "a")[3], 3)
+
+    def store_keeper(self):
+        """
+        Keep the distance store when the outputs of a run are cleared.
+        """
+        from ..utils.pipeline_runner import clear_outputs
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for suffix in ["map.stack.trimmed.fa_SNPstore.npz", "map.stack.fa"]:
+                Path(tmpdir, f"run_{suffix}").write_text("")
+            clear_outputs(tmpdir, "run_")
+            self.assertEqual([fname.name for fname in Path(tmpdir).iterdir()],
+                             ["run_map.stack.trimmed.fa_SNPstore.npz"])
+
+class Bam2fastaTestCase(TempDirTestCase):
+    def setUp(self):
+        import pysam
+        super().setUp()
+        self.bam = Path(self.tmpdir.name).joinpath("stack.bam").as_posix()
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+                  "SQ": [{"SN": "ref", "LN": 12}]}
+        with pysam.AlignmentFile(self.bam, "wb", header=header) as bam_h:
+            for name, start, cigar, seq in [("q1", 2, "3M1I2M2D1M", "ACGTTCA"),
+                                            ("q2", 5, "2S4M", "GGTTAC")]:
+                read = pysam.AlignedSegment()
+                read.query_name = name
+                read.reference_id = 0
+                read.reference_start = start
+                read.cigarstring = cigar
+                read.query_sequence = seq
+                bam_h.write(read)
+        pysam.index(self.bam)
+
+    def stacker(self):
+        """
+        Stack bam records onto reference coordinates.
+        """
+        from ..mapping.bam2fasta import stack_strings_from_bam
+        self.assertEqual(list(stack_strings_from_bam(self.bam, "ref", 0, 12)),
+                         [("q1", "--ACGTC--A--"), ("q2", "-----TTAC---")])
+
+class StageCacheTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.infile = Path(self.tmpdir.name).joinpath("in.fa")
+        self.outfile = Path(self.tmpdir.name).joinpath("out.txt")
+        self.infile.write_text(">a\nACGT\n")
+
+    def cacher(self):
+        """
+        Restore stage outputs on a cache hit, miss when settings change.
+        """
+        from ..utils.stage_cache import StageCache
+        cache = StageCache(Path(self.tmpdir.name).joinpath("cache"))
+        key = cache.key("stage", [self.infile], {"k_mer": "-k 5"})
+        self.assertFalse(cache.fetch(key, {"out": self.outfile}))
+        self.outfile.write_text("result")
+        cache.store(key, {"out": self.outfile})
+        self.outfile.unlink()
+        self.assertTrue(cache.fetch(key, {"out": self.outfile}))
+        self.assertEqual(self.outfile.read_text(), "result")
+        self.assertNotEqual(key, cache.key("stage", [self.infile], {"k_mer": "-k 7"}))
+        cache.directory.joinpath(key, "out").unlink()  # evicted by another run
+        self.assertFalse(cache.fetch(key, {"out": self.outfile}))
+        index = cache.directory.joinpath("mmi", "ref.mmi")
+        index.parent.mkdir()
+        index.write_text("index")  # not a cache entry
+        cache.max_bytes = 0
+        cache.evict()
+        self.assertFalse(cache.directory.joinpath(key).exists())
+        self.assertTrue(index.is_file())
+
+class TrimmedAlignmentTestCase(unittest.TestCase):
+    def setUp(self):
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        self.alignment = MultipleSeqAlignment(
+            [SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+             [("ref", "---ACGTAC---"), ("long", "TTTACGAACGGG"),
+              ("short", "----CGTA----"), ("outside", "TT----------")]]
+        )
+
+    def trimmer(self):
+        """
+        Trim requested sequences to the guide and depad the alignment.
+        """
+        from ..utils.trim_alignment import Trimmed_alignment
+        aln_trim = Trimmed_alignment(self.alignment, "ref", "-", ["long", "outside"])
+        aln_trim.get_refseq_boundary()
+        self.assertEqual(aln_trim.boundary, [3, 9])
+        aln_trim.trim_seqs_to_ref()
+        aln_trim.depad_alignment()
+        self.assertEqual([(seq.id, str(seq.seq)) for seq in aln_trim.alignment],
+                         [("ref", "ACGTAC"), ("long", "ACGAAC"), ("short", "-CGTA-")])
+
+class HaplotypesTestCase(unittest.TestCase):
+    def setUp(self):
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        self.alignment = MultipleSeqAlignment(
+            [SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+             [("a", "ACGT"), ("b", "ACGT"), ("c", "ACTT"), ("d", "acgt"), ("e", "TCTT")]]
+        )
+
+    def haplotyper(self):
+        """
+        Collapse identical sequences and expand them back into a tree.
+        """
+        from ete3 import Tree
+        from ..utils.haplotypes import collapse_haplotypes, expand_tree
+        representatives, members = collapse_haplotypes(self.alignment, keep=["b"])
+        self.assertEqual([seq.id for seq in representatives], ["b", "c", "e"])
+        self.assertEqual(members, {"b": ["a", "d"]})
+        tree = expand_tree(Tree("(Clust1_b:0.1,c:0.2);", format=1), members)
+        self.assertEqual(sorted(tree.get_leaf_names()),
+                         ["Clust1_a", "Clust1_b", "Clust1_d", "c"])
+        representatives, members = collapse_haplotypes(self.alignment[:4])
+        self.assertEqual((len(representatives), members), (4, {}))
+
+    def log_expander(self):
+        """
+        List every member of a collapsed group in the cluster log.
+        """
+        from ..utils.haplotypes import collapse_haplotypes, expand_cluster_log
+        _, members = collapse_haplotypes(self.alignment, keep=["b"])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            log = Path(tmpdir).joinpath("clusterPicks_log.txt")
+            log.write_text("ClusterNumber\tNumberOfTips\tTipNames\t"
+                           "MaxGeneticDistance\tBootstrap\n"
+                           "1\t2\t[b, c]\t0.25\t99.0\n")
+            expand_cluster_log(log, members)
+            self.assertEqual(log.read_text().splitlines()[1],
+                             "1\t4\t[b, a, d, c]\t0.25\t99.0")
+
+class ExecutorTestCase(unittest.TestCase):
+    def executor(self):
+        """
+        Pipe commands, capture output and raise on failures and timeouts.
+        """
+        from ..utils.executor import Executor, ToolError
+        executor = Executor()
+        self.assertEqual(executor.run(["printf", "b\\na\\n"], ["sort"], capture=True),
+                         "a\nb\n")
+        self.assertRaises(ToolError, executor.run, ["false"])
+        self.assertRaises(ToolError, executor.run, ["havic_no_such_tool"])
+        self.assertRaises(ToolError, executor.run, ["sleep", "5"], timeout=0.1)
+
+class MappyMapperTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.subject = package_path("data/NC_001489.fa")
+
+    def mapper(self):
+        """
+        Stack mappy hits as they would be stacked from the written bam file.
+        """
+        from Bio import SeqIO
+        from ..mapping.bam2fasta import stack_strings_from_bam
+        from ..mapping.mappy_mapper import (load_aligner, map_records,
+                                            stack_mapped, write_bam)
+        refseq = SeqIO.read(self.subject, "fasta")
+        records = list(SeqIO.parse(package_path("data/example2.fa"), "fasta"))
+        for record in records:
+            record.seq = record.seq.replace("-", "")
+        aligner = load_aligner(self.subject, 5, self.tmpdir.name, 2)
+        mapped = map_records(aligner, records, 2)
+        self.assertEqual([record.id for record, _ in mapped],
+                         [record.id for record in records])
+        bam = Path(self.tmpdir.name).joinpath("map.bam").as_posix()
+        write_bam(mapped, refseq.id, len(refseq), bam)
+        self.assertEqual(list(stack_mapped(mapped, 0, len(refseq))),
+                         list(stack_strings_from_bam(bam, refseq.id, 0, len(refseq))))
+
+class SeqStoreTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fasta = Path(self.tmpdir.name).joinpath("in.fa")
+        self.fasta.write_text(">a desc\nAC-GT\nTT\n>b\nacgttt\n>a\nGGGG\n>c\nCCC\n")
+        self.store = Path(self.tmpdir.name).joinpath("in.hvs").as_posix()
+
+    def storer(self):
+        """
+        Build a sequence store and stream a subset from it.
+        """
+        from ..utils.seq_store import build_store, SeqStore
+        self.assertEqual(build_store([self.fasta], self.store), (3, 1))
+        store = SeqStore(self.store)
+        self.assertEqual(store.fetch("a"), "AC-GTTT")
+        self.assertEqual(store.digest("a"), store.digest("b"))
+        self.assertEqual([(record.id, str(record.seq)) for record in
+                          store.records(["c", "xyz", "b"])],
+                         [("c", "CCC"), ("b", "acgttt")])
+        store.close()
+        with open(self.store, "ab") as store_h:  # a store rebuilt under its index
+            store_h.write(b"ACGT")
+        with self.assertRaises(ValueError):
+            SeqStore(self.store)
+
+class ClusterPickerTestCase(TempDirTestCase):
+    def setUp(self):
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        super().setUp()
+        self.alignment = MultipleSeqAlignment(
+            [SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+             [("a", "ACGTACGTAC"), ("b", "ACGTACGTAA"), ("c", "ACGTACGTAN"),
+              ("d", "TTTTACGAAA"), ("e", "TTTTACG-AA")]]
+        )
+
+    def picker(self):
+        """
+        Pick clusters by support and distance and write ClusterPicker outputs.
+        """
+        from ete3 import Tree
+        from ..utils.cluster_picker import pick_clusters, write_cluster_picks
+        tree = Tree("(((a:0.1,b:0.1)99:0.1,c:0.2)98:0.3,(d:0.1,e:0.1)97:0.3);")
+        clusters = pick_clusters(tree, self.alignment, 70, 95, 0.1, "valid")
+        self.assertEqual([sorted(node.get_leaf_names()) for node, _ in clusters],
+                         [["a", "b", "c"], ["d", "e"]])
+        self.assertEqual(len(pick_clusters(tree, self.alignment, 70, 95, 0, "gap")), 0)
+        outfiles = {role: Path(self.tmpdir.name).joinpath(role).as_posix() for role in
+                    ["nwk", "figtree", "list", "log", "fas"]}
+        outfiles["large_cluster"] = Path(self.tmpdir.name).joinpath("large{}").as_posix()
+        write_cluster_picks(tree, self.alignment, clusters, 2, outfiles)
+        self.assertEqual(sorted(Tree(outfiles["nwk"]).get_leaf_names()),
+                         ["Clust1_a", "Clust1_b", "Clust1_c", "Clust2_d", "Clust2_e"])
+        self.assertTrue(Path(outfiles["large_cluster"].format(1)).is_file())
+        self.assertFalse(Path(outfiles["large_cluster"].format(2)).is_file())
+
+    def sweeper(self):
+        """
+        Pick clusters for several thresholds from one set of clade distances.
+        """
+        from ete3 import Tree
+        from ..utils.cluster_picker import sweep_clusters, write_sweep
+        tree = Tree("(((a:0.1,b:0.1)99:0.1,c:0.2)90:0.3,(d:0.1,e:0.1)97:0.3);")
+        results = list(sweep_clusters(tree, self.alignment, 70, [80, 95], [0, 0.1]))
+        self.assertEqual([(fine, dist, len(clusters))
+                          for fine, dist, clusters in results],
+                         [(80, 0, 1), (80, 0.1, 2), (95, 0, 1), (95, 0.1, 2)])
+        self.assertEqual(sorted(results[3][2][0][0].get_leaf_names()), ["a", "b"])
+        prefix = Path(self.tmpdir.name).joinpath("run").as_posix()
+        write_sweep(results, tree.get_leaf_names(), prefix)
+        with open(f"{prefix}_sweep_stability.tsv") as stability_h:
+            self.assertIn("c\t0.25\t3\t3\n", stability_h.read())
+
+class ValidateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.yaml = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
+
+    def validator(self):
+        """
+        Check the pre-packaged config and catch a bad tree root.
+        """
+        from ..utils.validate import validate
+        errors, warnings = validate(self.yaml)
+        self.assertFalse([error for error in errors if "TREE_ROOT" in error])
+        self.assertIn("TRIM_SEQS entry 'xyxyx' is not in QUERY_FILES.", warnings)
+        self.yaml["TREE_ROOT"] = "not_a_sample"
+        self.assertTrue([error for error in validate(self.yaml)[0]
+                         if "TREE_ROOT" in error])
+        self.yaml["MAPPER_SETTINGS"]["workers"] = "many"
+        self.assertIn("MAPPER_SETTINGS workers must be AUTO or at least 1.",
+                      validate(self.yaml)[0])
+
+class CheckpointTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manifest = Path(self.tmpdir.name).joinpath("checkpoint.json")
+        self.infile = Path(self.tmpdir.name).joinpath("in.fa")
+        self.outfile = Path(self.tmpdir.name).joinpath("out.txt")
+        self.infile.write_text(">a\nACGT\n")
+
+    def checkpointer(self):
+        """
+        Skip a recorded stage until its inputs, settings or outputs change.
+        """
+        from ..utils.checkpoint import Checkpoint, atomic_path
+        inputs, outputs = [self.infile], [self.outfile]
+        checkpoint = Checkpoint(self.manifest)
+        self.assertFalse(checkpoint.done("stage", inputs, outputs, {"k": 5}))
+        with atomic_path(self.outfile) as tmp:
+            Path(tmp).write_text("result")
+        checkpoint.record("stage", inputs, outputs, {"k": 5})
+        checkpoint = Checkpoint(self.manifest)
+        self.assertTrue(checkpoint.done("stage", inputs, outputs, {"k": 5}))
+        self.assertFalse(checkpoint.done("stage", inputs, outputs, {"k": 7}))
+        self.outfile.write_text("partial")
+        self.assertFalse(checkpoint.done("stage", inputs, outputs, {"k": 5}))
+        checkpoint.refresh("stage")
+        self.assertTrue(checkpoint.done("stage", inputs, outputs, {"k": 5}))
+        self.infile.write_text(">a\nACGA\n")
+        self.assertFalse(checkpoint.done("stage", inputs, outputs, {"k": 5}))
+        self.assertEqual(list(Path(self.tmpdir.name).glob("*.tmp")), [])
+
+    def iqtree_resumer(self):
+        """
+        Resume an unfinished IQ-TREE checkpoint, redo a finished one whose
+        treefile is missing.
+        """
+        import gzip
+        config = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
+        pipeline = Pipeline(dict(config, OUTDIR=self.tmpdir.name))
+        inputs = [self.infile]
+        ckp = f"{pipeline.outfiles['fasta_from_bam_trimmed']}.ckp.gz"
+        with gzip.open(ckp, "wt") as ckp_h:
+            ckp_h.write("iqtree:\n  version: 2\n")
+        self.assertEqual(pipeline._iqtree_resume(["iqtree"], inputs), ["iqtree", "-redo"])
+        self.assertEqual(pipeline._iqtree_resume(["iqtree"], inputs), ["iqtree"])
+        with gzip.open(ckp, "at") as ckp_h:
+            ckp_h.write("finished: true\n")
+        self.assertEqual(pipeline._iqtree_resume(["iqtree"], inputs), ["iqtree", "-redo"])
+        Path(pipeline.outfiles["treefile"]).write_text("(a,b);\n")
+        self.assertIsNone(pipeline._iqtree_resume(["iqtree"], inputs))
+
+class MatplotlibPlotsTestCase(TempDirTestCase):
+    def plotter(self):
+        """
+        Draw the tree with alignment and the SNP heatmap.
+        """
+        import numpy as np
+        from ete3 import Tree
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+        from ..plotters.matplotlib_plots import (cluster_assignments, encode_msa,
+                                                 plot_tree_msa, plot_snp_heatmap)
+        tree = Tree("((a:0.1,b:0.1)95:0.2,c:0.3);")
+        alignment = MultipleSeqAlignment(
+            SeqRecord(Seq(seq), id=seqid) for seqid, seq in
+            [("a", "ACGT-"), ("b", "ACGTN"), ("c", "TCGA-")])
+        clusters = cluster_assignments(Tree("((Clust1_a,Clust1_b),c);"))
+        self.assertEqual(encode_msa(alignment, ["c", "a"]).tolist(),
+                         [[4, 2, 3, 1, 0], [1, 2, 3, 4, 0]])
+        tree_pdf = Path(self.tmpdir.name).joinpath("tree.pdf")
+        heatmap_pdf = Path(self.tmpdir.name).joinpath("heatmap.pdf")
+        plot_tree_msa(tree, alignment, clusters, ["c"], "subtitle", tree_pdf)
+        plot_snp_heatmap(["c", "b", "a"], np.array([[0, 2, 2], [2, 0, 0], [2, 0, 0]]),
+                         tree.get_leaf_names(), clusters, heatmap_pdf)
+        self.assertTrue(tree_pdf.stat().st_size and heatmap_pdf.stat().st_size)
+        empty_pdf = Path(self.tmpdir.name).joinpath("empty.pdf")
+        plot_snp_heatmap([], np.zeros((0, 0), dtype=int), [], {}, empty_pdf)
+        self.assertTrue(empty_pdf.stat().st_size)
+
+class BenchmarkTestCase(unittest.TestCase):
+    def bencher(self):
+        """
+        Simulate an outbreak and find a slower stage in the results.
+        """
+        from ..utils.benchmark import simulate_outbreak, compare_results
+        names, seqs, tree = simulate_outbreak("ACGT" * 50, 20, 0.01, 2)
+        self.assertEqual(seqs.shape, (20, 200))
+        self.assertEqual(sorted(tree.get_leaf_names()), names)
+        self.assertTrue(set(seqs.tobytes()) <= set(b"ACGT"))
+        self.assertTrue(all(0 <= float(node.support) <= 100 for node in tree.traverse()))
+        rows = [{"havic_version": version, "dataset": "wgs", "sequences": "100",
+                 "stage": stage, "status": "ok", "wall_secs": secs}
+                for version, stage, secs in [("0.1", "snp_dists", "2.0"),
+                                             ("0.2", "snp_dists", "2.1"),
+                                             ("0.1", "clusterpick", "1.0"),
+                                             ("0.2", "clusterpick", "4.0")]]
+        self.assertEqual(compare_results(rows, "0.1", "0.2"),
+                         [("wgs", "100", "clusterpick", 1.0, 4.0)])
+
+class PartitionTestCase(unittest.TestCase):
+    def partitioner(self):
+        """
+        Group two distant families into neighbourhoods and join their trees.
+        """
+        import numpy as np
+        from ete3 import Tree
+        from ..utils.partition import neighbourhoods, pool_small, merge_trees
+        rng = np.random.default_rng(3)
+        founders = ["".join(rng.choice(list("ACGT"), 400)) for _ in range(2)]
+        ids, seqs = [], []
+        for family, founder in enumerate(founders):
+            for member in range(5):
+                seq = list(founder)
+                for site in rng.choice(400, 2, replace=False):
+                    seq[site] = "ACGT"[("ACGT".index(seq[site]) + 1) % 4]
+                ids.append(f"f{family}_{member}")
+                seqs.append("".join(seq))
+        ids.append("loner")
+        seqs.append("".join(rng.choice(list("ACGT"), 400)))
+        groups = neighbourhoods(ids, seqs, 0.02)
+        self.assertEqual(groups, [ids[:5], ids[5:10], ["loner"]])
+        self.assertEqual(pool_small(groups), [ids[:5] + ["loner"], ids[5:10]])
+        merged = merge_trees([Tree("((a,b),(c,d));"), Tree("((e,f),(g,(h,o)));")])
+        self.assertEqual(sorted(len(node) for node in merged.children), [4, 5])
+
+class ServiceTestCase(unittest.TestCase):
+    def servicer(self):
+        """
+        Coalesce concurrent submissions into one update.
+        """
+        import time
+        from ..utils.service import JobQueue, parse_fasta
+        calls = []
+
+        def update(records):
+            calls.append([name for name, _ in records])
+            return {name: 1 for name, _ in records if name != "b"}
+
+        queue = JobQueue(update, coalesce_secs=0.5)
+        first = queue.submit(parse_fasta(">a\nACGT\n>b\nACGA\n"))
+        second = queue.submit(parse_fasta(">c\nACGG\n"))
+        while queue.status(second)["status"] != "done":
+            time.sleep(0.1)
+        self.assertEqual(calls, [["a", "b", "c"]])
+        self.assertEqual(queue.status(first)["clusters"], {"a": 1, "b": None})
+        self.assertEqual(queue.status(second)["update"], 1)
+        with self.assertRaises(ValueError):
+            parse_fasta("ACGT")
+
+    def rollbacker(self):
+        """
+        Remove a failed update's batch from the query file and known ids.
+        """
+        import threading
+        from ..utils.service import Service
+
+        class Pipeline:
+            def update(self):
+                sys.exit("bad input")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            service = Service.__new__(Service)
+            service.query_file = Path(tmpdir, "service_queries.fa")
+            service.query_file.write_text(">a\nACGT\n")
+            service.known, service._lock = {"a", "b"}, threading.Lock()
+            service.pipeline = Pipeline()
+            with self.assertRaises(SystemExit):
+                service.update([("b", "ACGA")])
+            self.assertEqual(service.query_file.read_text(), ">a\nACGT\n")
+            self.assertEqual(service.known, {"a"})
+
+class TreeProfilesTestCase(unittest.TestCase):
+    def profiler(self):
+        """
+        Recover a tree from its path lengths, rewrite the fast profile
+        options and measure alignment drift.
+        """
+        import numpy as np
+        from ete3 import Tree
+        from ..utils.tree_profiles import (alignment_fingerprint, fingerprint_drift,
+                                           neighbour_joining, support_threshold,
+                                           tree_options)
+        tree = Tree("(((a:1,b:2):1,(c:1,d:3):2):1,(e:2,(f:1,g:1):1):1);")
+        leaves = tree.get_leaves()
+        dists = np.array([[a.get_distance(b) for b in leaves] for a in leaves])
+        joined = Tree(neighbour_joining([leaf.name for leaf in leaves], dists))
+        self.assertEqual(tree.robinson_foulds(joined, unrooted_trees=True)[0], 0)
+        self.assertEqual(
+            tree_options("-T 4 -m MFP --ufboot 2000 -t x.nwk", "alrt", 1000, "HKY+F"),
+            "-T 4 -alrt 1000 -m HKY+F")
+        self.assertEqual(support_threshold(95, "alrt"), 80.0)
+        fingerprint = alignment_fingerprint(["ACGTAC", "ACGAAC", "AC-AAC"])
+        self.assertEqual(fingerprint_drift(fingerprint, fingerprint), 0.0)
+        self.assertGreater(fingerprint_drift(
+            fingerprint, alignment_fingerprint(["ACGTAC", "TTTTTT"])), 0.05)
+
+class ShardedMappingTestCase(unittest.TestCase):
+    def sharder(self):
+        """
+        Split the queries into shards, keeping every sequence once in order.
+        """
+        from Bio import SeqIO
+        from ..utils.pipeline_runner import shard_fasta
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fasta = str(Path(tmpdir, "queries.fa"))
+            with open(fasta, "w") as fasta_h:
+                fasta_h.write("".join(f">s{idx}\nACGT\n" for idx in range(5)))
+            shards = shard_fasta(fasta, 2)
+            self.assertEqual([Path(shard).name for shard in shards],
+                             [f"queries.shard{idx}.fa" for idx in range(3)])
+            self.assertEqual([record.id for shard in shards
+                              for record in SeqIO.parse(shard, "fasta")],
+                             [f"s{idx}" for idx in range(5)])
+
+class BatchTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.yaml = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
+
+    def thread_budgeter(self):
+        """
+        Rewrite the IQ-TREE -T and minimap2 -t options to the job's share.
+        """
+        from ..utils.batch import apply_thread_budget
+        self.yaml["MAPPER_SETTINGS"]["other"] = "-c -t 16 --cs"
+        self.yaml["MAPPER_SETTINGS"]["workers"] = 8
+        self.yaml["PARTITION_SETTINGS"]["workers"] = 8
+        budget = apply_thread_budget(self.yaml, 3)
+        self.assertEqual(budget["MAPPER_SETTINGS"]["workers"], 3)
+        self.assertEqual(budget["PARTITION_SETTINGS"]["workers"], 3)
+        self.assertEqual(budget["IQTREE2_SETTINGS"]["other"].split()[-2:], ["-T", "3"])
+        self.assertNotIn("-ntmax", budget["IQTREE2_SETTINGS"]["other"])
+        self.assertEqual(budget["MAPPER_SETTINGS"]["other"], "-c --cs -t 3")
+        self.assertEqual(budget["SNP_DISTS_SETTINGS"]["threads"], 3)
+
+    def batcher(self):
+        """
+        Report a failed job with its tool error while the other jobs finish,
+        keeping each job's log and the parent's output streams.
+        """
+        from unittest import mock
+        from ruffus.ruffus_exceptions import RethrownJobError
+        from ..utils.batch import run_batch, run_job
+
+        def run(pipeline):
+            if pipeline.outdir.endswith("fail"):
+                raise RethrownJobError([("map", "job", "havic.utils.executor.ToolError",
+                                         "(Unable to start minimap2)", "stack")])
+            print("pipeline ran")
+
+        paths = []
+        for name in ["ok", "fail"]:
+            paths.append(Path(self.tmpdir.name).joinpath(f"{name}.yaml"))
+            paths[-1].write_text(yaml.dump(dict(
+                self.yaml, OUTDIR=Path(self.tmpdir.name).joinpath(name).as_posix())))
+        stdout = os.fstat(1)
+        with mock.patch.object(Pipeline, "_run", run):
+            self.assertEqual(run_batch([self.tmpdir.name], threads=2), 1)
+            result = run_job(paths[1], 1)
+        self.assertTrue(os.path.samestat(os.fstat(1), stdout))
+        self.assertEqual(result[1:3], ("FAILED", "ToolError(Unable to start minimap2)"))
+        log = Path(self.tmpdir.name, "ok", f"{self.yaml['RUN_PREFIX']}batch.log")
+        self.assertIn("pipeline ran", log.read_text())
+
+class InstrumentationTestCase(TempDirTestCase):
+    def reporter(self):
+        """
+        Add each tool's CPU time and peak RSS to the stages that ran it,
+        including from worker threads, and report the run's peak RSS.
+        """
+        import json
+        from concurrent.futures import ThreadPoolExecutor
+        from ..utils.executor import Executor
+        from ..utils.instrumentation import RunReport
+        report = RunReport(Path(self.tmpdir.name).joinpath("report.json"),
+                           Path(self.tmpdir.name).joinpath("report.tsv"))
+        executor = Executor(on_exit=report.child_exited)
+        burn = [sys.executable, "-c",
+                "x = bytearray(64 * 1024 ** 2); sum(range(10 ** 6))"]
+        with report.stage("outer"):
+            with report.stage("inner"):
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    pool.submit(report.bind(executor.run), burn).result()
+            with report.stage("python_only"):
+                pass
+        stages = {entry["stage"]: entry for entry in report.stages}
+        self.assertGreaterEqual(stages["inner"]["children_peak_rss_mb"], 64)
+        self.assertGreater(stages["inner"]["children_user_cpu_secs"]
+                           + stages["inner"]["children_sys_cpu_secs"], 0)
+        self.assertEqual(stages["outer"]["children_peak_rss_mb"],
+                         stages["inner"]["children_peak_rss_mb"])
+        self.assertIsNone(stages["python_only"]["children_peak_rss_mb"])
+        report.write()
+        run = json.loads(report.json_path.read_text())["run"]
+        self.assertGreater(run["peak_rss_mb"], 0)
+        last_row = report.tsv_path.read_text().splitlines()[-1]
+        self.assertEqual(last_row.split("\t")[0], "run")
+
+class IncrementalTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.yaml = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
+        self.yaml.update({"OUTDIR": self.tmpdir.name, "INCREMENTAL": True,
+                          "FORCE_OVERWRITE_AND_RE_RUN": False, "TREE_ROOT": "midpoint"})
+        self.yaml["MAPPER_SETTINGS"].update(
+            {"engine": "mappy", "index_dir": self.tmpdir.name, "threads": 2})
+
+    def state_keeper(self):
+        """
+        Save a run's state and load it back, keeping unchanged sequences.
+        """
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.Seq import Seq
+        from Bio.SeqRecord import SeqRecord
+        from ..utils.incremental import RunState, sequence_hash
+        records = [SeqRecord(Seq(seq), id=name) for name, seq in
+                   [("a", "ACGT"), ("b", "AC-GG"), ("c", "TTTT")]]
+        stacked = MultipleSeqAlignment(
+            SeqRecord(Seq(seq), id=name) for name, seq in
+            [("a", "-ACGT-"), ("b", "-ACGG-"), ("c", "TTTT--")])
+        state = RunState(self.tmpdir.name, "run_")
+        self.assertFalse(state.exists())
+        self.assertEqual(state.split_new(records), (records, set()))
+        state.save(records, stacked)
+        self.assertTrue(state.exists())
+        self.assertEqual(state.hashes(), {record.id: sequence_hash(record)
+                                          for record in records})
+        records[2] = SeqRecord(Seq("TTTA"), id="c")
+        records.append(SeqRecord(Seq("GGGG"), id="d"))
+        new, kept = state.split_new(records)
+        self.assertEqual([record.id for record in new], ["c", "d"])
+        self.assertEqual(kept, {"a", "b"})
+        self.assertEqual([(record.id, str(record.seq)) for record in
+                          state.stacked_records(kept)],
+                         [("a", "-ACGT-"), ("b", "-ACGG-")])
+        self.assertFalse(RunState(self.tmpdir.name, "run_", "another").exists())
+
+    def second_runner(self):
+        """
+        Map every query on the first run, then only the new ones on the next.
+        """
+        from Bio import SeqIO
+        from ..utils.pipeline_runner import clear_outputs
+
+        def compile_and_map(query_files):
+            self.yaml["QUERY_FILES"] = query_files
+            pipeline = Pipeline(self.yaml)
+            pipeline._compile_input_fasta()
+            pipeline._map_in_process()
+            return pipeline
+
+        first = compile_and_map(["data/example1.fa"])
+        self.assertFalse(Path(first.outfiles["tmp_fasta_new"]).exists())
+        first_ids = {record.id for record in
+                     SeqIO.parse(first.outfiles["tmp_fasta"], "fasta")}
+        first_stacked = {record.id for record in
+                         SeqIO.parse(first.outfiles["fasta_from_bam"], "fasta")}
+        clear_outputs(self.tmpdir.name, self.yaml["RUN_PREFIX"])  # FORCE Yes
+        second = compile_and_map(["data/example1.fa", "data/example2.fa"])
+        all_ids = [record.id for record in
+                   SeqIO.parse(second.outfiles["tmp_fasta"], "fasta")]
+        new_ids = [record.id for record in
+                   SeqIO.parse(second.outfiles["tmp_fasta_new"], "fasta")]
+        self.assertTrue(new_ids)
+        self.assertEqual(new_ids, [seqid for seqid in all_ids if seqid not in first_ids])
+        stacked = {record.id for record in
+                   SeqIO.parse(second.outfiles["fasta_from_bam"], "fasta")}
+        self.assertTrue(first_stacked < stacked)
+
+class QueryCompilerTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        first = Path(self.tmpdir.name).joinpath("first.fa")
+        first.write_text(">a\nAC-GT\n>b\nCCCC\n>a\nGGGG\n>c\nACGT\n>d#1\nTTTT\n")
+        second = Path(self.tmpdir.name).joinpath("second.fa")
+        second.write_text(">b\nCCCC\n>e\nAACC\n>d_1\nTTGG\n>a\nACGT\n")
+        self.yaml = yaml.load(open(package_path(__havic_yaml__)), Loader=yaml.FullLoader)
+        self.yaml.update({"OUTDIR": self.tmpdir.name, "TREE_ROOT": "midpoint",
+                          "DEFAULT_QUERIES": False, "REPORT_IDENTICAL_SEQS": True,
+                          "QUERY_FILES": [str(first), str(second)]})
+
+    def compiler(self):
+        """
+        Keep the first of each id within and across query files, report the
+        duplicates and identical sequences, and list each input id once.
+        """
+        from Bio import SeqIO
+        pipeline = Pipeline(self.yaml)
+        pipeline._compile_input_fasta()
+        records = list(SeqIO.parse(pipeline.outfiles["tmp_fasta"], "fasta"))
+        self.assertEqual([(record.id, str(record.seq)) for record in records[1:]],
+                         [("a", "ACGT"), ("b", "CCCC"), ("c", "ACGT"),
+                          ("d_1", "TTTT"), ("e", "AACC")])
+        with open(pipeline.outfiles["duplicates"]) as duplicates_h:
+            self.assertEqual(duplicates_h.read().split(), ["a", "b", "d_1", "a"])
+        with open(pipeline.outfiles["identical_seqs"]) as identical_h:
+            self.assertEqual(identical_h.read().splitlines()[1:], ["c\ta"])
+        with open(pipeline.outfiles["seq_header_replacements"]) as header_h:
+            rows = [line.split("\t") for line in header_h.read().splitlines()[1:]]
+        self.assertEqual([row[0] for row in rows], ["a", "b", "c", "d#1", "e", "d_1"])
+        self.assertEqual(dict(rows)["d#1"], "d_1")
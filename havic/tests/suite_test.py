@@ -10,7 +10,28 @@ from ..tests.havic_test import (HavAmpliconTestCase,
                                HavWgsTestCase,
                                HavPmcTestCase,
                                MeaslesAmpliconTestCase,
-                               HivAmpliconTestCase)
+                               HivAmpliconTestCase,
+                               SnpDistsTestCase,
+                               Bam2fastaTestCase,
+                               StageCacheTestCase,
+                               TrimmedAlignmentTestCase,
+                               HaplotypesTestCase,
+                               ExecutorTestCase,
+                               MappyMapperTestCase,
+                               SeqStoreTestCase,
+                               ClusterPickerTestCase,
+                               ValidateTestCase,
+                               CheckpointTestCase,
+                               MatplotlibPlotsTestCase,
+                               BenchmarkTestCase,
+                               PartitionTestCase,
+                               ServiceTestCase,
+                               TreeProfilesTestCase,
+                               ShardedMappingTestCase,
+                               BatchTestCase,
+                               InstrumentationTestCase,
+                               IncrementalTestCase,
+                               QueryCompilerTestCase)
 
 
 def suite():
@@ -20,6 +41,36 @@ def suite():
     suite_ = unittest.TestSuite()
     suite_.addTest(HavAmpliconTestCase("versioner"))
     suite_.addTest(HavAmpliconTestCase("yamler"))
+    suite_.addTest(SnpDistsTestCase("snp_counter"))
+    suite_.addTest(SnpDistsTestCase("snp_writer"))
+    suite_.addTest(SnpDistsTestCase("snp_storer"))
+    suite_.addTest(SnpDistsTestCase("store_keeper"))
+    suite_.addTest(Bam2fastaTestCase("stacker"))
+    suite_.addTest(StageCacheTestCase("cacher"))
+    suite_.addTest(TrimmedAlignmentTestCase("trimmer"))
+    suite_.addTest(HaplotypesTestCase("haplotyper"))
+    suite_.addTest(HaplotypesTestCase("log_expander"))
+    suite_.addTest(ExecutorTestCase("executor"))
+    suite_.addTest(MappyMapperTestCase("mapper"))
+    suite_.addTest(SeqStoreTestCase("storer"))
+    suite_.addTest(ClusterPickerTestCase("picker"))
+    suite_.addTest(ClusterPickerTestCase("sweeper"))
+    suite_.addTest(ValidateTestCase("validator"))
+    suite_.addTest(CheckpointTestCase("checkpointer"))
+    suite_.addTest(CheckpointTestCase("iqtree_resumer"))
+    suite_.addTest(MatplotlibPlotsTestCase("plotter"))
+    suite_.addTest(BenchmarkTestCase("bencher"))
+    suite_.addTest(PartitionTestCase("partitioner"))
+    suite_.addTest(ServiceTestCase("servicer"))
+    suite_.addTest(ServiceTestCase("rollbacker"))
+    suite_.addTest(TreeProfilesTestCase("profiler"))
+    suite_.addTest(ShardedMappingTestCase("sharder"))
+    suite_.addTest(BatchTestCase("thread_budgeter"))
+    suite_.addTest(BatchTestCase("batcher"))
+    suite_.addTest(InstrumentationTestCase("reporter"))
+    suite_.addTest(IncrementalTestCase("state_keeper"))
+    suite_.addTest(IncrementalTestCase("second_runner"))
+    suite_.addTest(QueryCompilerTestCase("compiler"))
     # suite_.addTest(HavAmpliconTestCase("dependency_checker"))
     suite_.addTest(HavAmpliconTestCase("suite_runner"))
     suite_.addTest(HavAmpliconTestCase("csvs_checker"))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""Run many yaml configs concurrently on one node.
+
+Jobs run in a process pool.  The thread budget is divided between the
+concurrent jobs, and each job's IQ-TREE, minimap2 and SNP distance settings
+are rewritten to use its share, so that the node is not oversubscribed.
+"""
+
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+# IQ-TREE and minimap2 thread options replaced by the batch thread share.
+IQTREE_THREAD_OPTS = re.compile(r"(?<!\S)(-T|-nt|-ntmax|--threads-max)\s+\S+")
+MAPPER_THREAD_OPTS = re.compile(r"(?<!\S)-t\s+\S+")
+
+
+def collect_yamls(paths):
+    """Expand yaml files and directories of yaml files.
+
+    Args:
+        paths (list): paths to yaml files or directories.
+
+    Returns:
+        list: paths to yaml files.
+    """
+    yamls = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            yamls.extend(sorted(list(path.glob("*.yaml")) + list(path.glob("*.yml"))))
+        elif path.is_file():
+            yamls.append(path)
+        else:
+            print(f"\nWarning, '{path}' is not a valid file path.\n")
+    return yamls
+
+
+def configured_threads(options, pattern):
+    """The total threads given by a tool's thread options.
+
+    Args:
+        options (str): the tool's command line options.
+        pattern (re.Pattern): IQTREE_THREAD_OPTS or MAPPER_THREAD_OPTS.
+
+    Returns:
+        int: the smallest thread count given, capped at os.cpu_count() if a
+            count is AUTO or none is given.
+
+    >>> configured_threads("-T 4 -m MFP", IQTREE_THREAD_OPTS)
+    4
+    >>> configured_threads("-T AUTO -ntmax 1", IQTREE_THREAD_OPTS)
+    1
+    """
+    values = [match.group().split()[1] for match in pattern.finditer(str(options))]
+    counts = [int(value) for value in values if value.isdigit()]
+    if len(counts) < len(values) or not counts:
+        counts.append(os.cpu_count())
+    return min(counts)
+
+
+def apply_thread_budget(yaml_in, threads):
+    """Limit a job's tools to a number of threads.
+
+    Args:
+        yaml_in (dict): the parsed yaml config, modified in place.
+        threads (int): threads available to the job.
+
+    Returns:
+        dict: the modified yaml config.
+
+    >>> budgeted = apply_thread_budget(
+    ...     {"IQTREE2_SETTINGS": {"other": "-T AUTO -ntmax 24 -m MFP"},
+    ...      "MAPPER_SETTINGS": {"other": "-c --cs"}}, 4)
+    >>> budgeted["IQTREE2_SETTINGS"]
+    {'other': '-m MFP -T 4'}
+    """
+    iqtree = yaml_in["IQTREE2_SETTINGS"]
+    iqtree["other"] = " ".join(
+        IQTREE_THREAD_OPTS.sub("", str(iqtree["other"])).split() + ["-T", str(threads)])
+    mapper = yaml_in["MAPPER_SETTINGS"]
+    mapper["other"] = " ".join(
+        MAPPER_THREAD_OPTS.sub("", str(mapper["other"])).split() + ["-t", str(threads)])
+    mapper["threads"] = threads
+    if str(mapper.get("workers", 1)).upper() != "AUTO":
+        mapper["workers"] = min(int(mapper.get("workers", 1)), threads)
+    snp_dists = yaml_in.get("SNP_DISTS_SETTINGS") or {}
+    snp_dists["threads"] = threads
+    yaml_in["SNP_DISTS_SETTINGS"] = snp_dists
+    partition = yaml_in.get("PARTITION_SETTINGS")
+    if partition and str(partition.get("workers", "AUTO")).upper() != "AUTO":
+        partition["workers"] = min(int(partition["workers"]), threads)
+    return yaml_in
+
+
+def job_error(exc):
+    """A one-line message for a failed job.
+
+    The errors of the pipeline stages are unwrapped from the ruffus
+    RethrownJobError, which only prints its stack traces.
+
+    Args:
+        exc (BaseException): the exception raised by the job.
+
+    Returns:
+        str: the error message.
+
+    >>> job_error(ValueError("bad input"))
+    'ValueError: bad input'
+    """
+    errors = getattr(exc, "job_exceptions", None)
+    if errors:
+        return "; ".join(f"{name.rsplit('.', 1)[-1]}{value}"
+                         for _, _, name, value, _ in errors)
+    return f"{type(exc).__name__}: {exc}"
+
+
+def run_job(yaml_path, threads):
+    """Run one pipeline, logging its output to OUTDIR.
+
+    Args:
+        yaml_path (Path): path to the yaml config.
+        threads (int): threads available to the job.
+
+    Returns:
+        tuple: (yaml path, status, message, runtime)
+    """
+    import yaml
+    start = datetime.now()
+    saved = [os.dup(1), os.dup(2)]
+    try:
+        yaml_in = apply_thread_budget(
+            yaml.load(open(yaml_path, "r"), Loader=yaml.FullLoader), threads)
+        Path(yaml_in["OUTDIR"]).mkdir(parents=True, exist_ok=True)
+        from .pipeline_runner import Pipeline, clear_outputs
+        # clear the outputs before the log is opened, as 'havic serve' does
+        if yaml_in["FORCE_OVERWRITE_AND_RE_RUN"]:
+            clear_outputs(yaml_in["OUTDIR"], yaml_in["RUN_PREFIX"])
+            yaml_in["FORCE_OVERWRITE_AND_RE_RUN"] = False
+        log = Path(yaml_in["OUTDIR"]).joinpath(f"{yaml_in['RUN_PREFIX']}batch.log")
+        # redirect at the file descriptor level to also capture external tools
+        with open(log, "w") as log_h:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(log_h.fileno(), 1)
+            os.dup2(log_h.fileno(), 2)
+            Pipeline(yaml_in)._run()
+        status, message = "OK", log.as_posix()
+    except SystemExit as exc:
+        status, message = "FAILED", str(exc)
+    except Exception as exc:  # report, and let the other jobs carry on
+        status, message = "FAILED", job_error(exc)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, copy in enumerate(saved, start=1):
+            os.dup2(copy, fd)
+            os.close(copy)
+    return yaml_path.as_posix(), status, message, str(datetime.now() - start)
+
+
+def run_batch(paths, threads=None, jobs=None):
+    """Run the pipelines concurrently and report per-job status.
+
+    Args:
+        paths (list): paths to yaml files or directories.
+        threads (int): total thread budget, default os.cpu_count().
+        jobs (int): maximum concurrent jobs, default all.
+
+    Returns:
+        int: the number of failed jobs.
+    """
+    yamls = collect_yamls(paths)
+    if not yamls:
+        sys.exit("Unable to continue without yaml files.")
+    threads = threads or os.cpu_count()
+    jobs = min(jobs or len(yamls), len(yamls), threads)
+    job_threads = max(1, threads // jobs)
+    print(f"Running {len(yamls)} jobs, {jobs} at a time, "
+          f"with {job_threads} threads each.")
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_job, yaml_path, job_threads) for yaml_path in yamls]
+        for future in as_completed(futures):
+            yaml_path, status, message, runtime = future.result()
+            failed += status != "OK"
+            print(f"{status}\t{runtime}\t{yaml_path}\t{message}")
+    print(f"\n{len(yamls) - failed} of {len(yamls)} jobs completed successfully.")
+    return failed
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+"""Benchmark the pipeline stages on synthetic outbreaks.
+
+An outbreak of n sequences is simulated by evolving the HAV amplicon
+(havnet_amplicon.fa) or genome (NC_001489.fa) along a random tree: at each
+step a sequence is picked at random and split in two, and both daughters
+gain point mutations.  The query fasta and the true tree are written once
+per dataset, size and seed, and reused by later benchmarks.
+
+Each stage (compile, mapping, trimming, SNP distances and cluster picking)
+is then run on its own, in a fresh process, on the outputs of the stage
+before, using the stage methods of Pipeline.  IQ-TREE is not run; the
+simulated tree, with random supports, stands in for it.  Mapping uses the
+mappy engine if mappy is installed, and is skipped otherwise (the simulated
+sequences are already aligned).  The wall time, CPU time and peak memory of
+each stage are appended to 'bench_results.tsv' with the havic version, so
+that results from different versions can be compared.
+"""
+
+import io
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from importlib.util import find_spec
+from pathlib import Path
+import numpy as np
+from Bio import SeqIO
+from .. import __havic_yaml__, __havic_wgs_yaml__, __version__
+from .paths import package_path
+from .instrumentation import RSS_TO_MB
+
+DATASETS = {
+    "amplicon": (__havic_yaml__, "data/havnet_amplicon.fa"),
+    "wgs": (__havic_wgs_yaml__, "data/wgs_hav_seqs/NC_001489.fa"),
+}
+SIZES = [100, 1000, 10000, 50000]
+STAGES = ["compile_input_fasta", "map_input_fasta_to_ref", "get_cleaned_fasta",
+          "snp_dists", "clusterpick"]
+RESULT_FIELDS = ["havic_version", "started", "dataset", "sequences", "stage",
+                 "status", "wall_secs", "user_cpu_secs", "sys_cpu_secs",
+                 "peak_rss_mb"]
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def simulate_outbreak(reference, n_seqs, mutation_rate, seed):
+    """Evolve sequences from a reference along a random tree.
+
+    Args:
+        reference (str): the ancestral sequence.
+        n_seqs (int): number of sequences to simulate.
+        mutation_rate (float): expected mutations per site on each branch.
+        seed (int): random seed.
+
+    Returns:
+        tuple: sequence names, (n_seqs x length) uint8 sequences, and the
+            true tree (ete3.Tree) with random supports of 60 to 100.
+
+    >>> names, seqs, tree = simulate_outbreak("ACGTACGTAC", 5, 0.1, 1)
+    >>> names[:2], seqs.shape, sorted(tree.get_leaf_names()) == sorted(names)
+    (['sim000000', 'sim000001'], (5, 10), True)
+    """
+    from ete3 import Tree
+
+    rng = np.random.default_rng(seed)
+    length = len(reference)
+    names = [f"sim{idx:06d}" for idx in range(n_seqs)]
+    seqs = np.empty((n_seqs, length), dtype=np.uint8)
+    seqs[0] = np.frombuffer(reference.upper().encode("ascii"), dtype=np.uint8)
+    tree = Tree(name=names[0])
+    leaves = {0: tree}
+
+    def mutate(row):
+        sites = rng.integers(length, size=rng.poisson(mutation_rate * length))
+        seqs[row, sites] = BASES[rng.integers(4, size=len(sites))]
+        return len(sites) / length
+
+    for idx in range(1, n_seqs):
+        parent = int(rng.integers(idx))
+        seqs[idx] = seqs[parent]
+        node = leaves[parent]
+        node.name = ""
+        node.support = int(rng.integers(60, 101))
+        leaves[parent] = node.add_child(name=names[parent], dist=mutate(parent))
+        leaves[idx] = node.add_child(name=names[idx], dist=mutate(idx))
+    return names, seqs, tree
+
+
+def write_dataset(dataset, n_seqs, seed, data_dir, mutation_rate=0.002):
+    """Simulate an outbreak once, writing its fasta and true tree.
+
+    Args:
+        dataset (str): a key of DATASETS.
+        n_seqs (int): number of sequences.
+        seed (int): random seed.
+        data_dir (Path): directory for the simulated data.
+        mutation_rate (float): expected mutations per site on each branch.
+
+    Returns:
+        tuple: paths to the query fasta and the tree.
+    """
+    fasta = Path(data_dir).joinpath(f"{dataset}_{n_seqs}_seed{seed}.fa")
+    treefile = fasta.with_suffix(".treefile")
+    if fasta.is_file() and treefile.is_file():
+        return fasta, treefile
+    fasta.parent.mkdir(parents=True, exist_ok=True)
+    reference = str(SeqIO.read(package_path(DATASETS[dataset][1]), "fasta").seq)
+    names, seqs, tree = simulate_outbreak(reference.replace("-", ""), n_seqs,
+                                          mutation_rate, seed)
+    tree.write(outfile=str(treefile), dist_formatter="%0.16f")
+    with open(fasta, "w") as fasta_h:
+        for name, seq in zip(names, seqs):
+            fasta_h.write(f">{name}\n{seq.tobytes().decode('ascii')}\n")
+    return fasta, treefile
+
+
+def bench_config(dataset, fasta, outdir):
+    """The packaged yaml config of a dataset, pointed at the simulated data.
+
+    Args:
+        dataset (str): a key of DATASETS.
+        fasta (Path): the simulated query fasta.
+        outdir (Path): output directory for the stages.
+
+    Returns:
+        dict: the config.
+    """
+    import yaml
+
+    yaml_in = yaml.load(open(package_path(DATASETS[dataset][0])), Loader=yaml.FullLoader)
+    yaml_in.update({
+        "OUTDIR": str(outdir),
+        "DEFAULT_QUERIES": False,
+        "QUERY_FILES": [str(fasta)],
+        "TREE_ROOT": "midpoint",
+        "TRIM_SEQS": [],
+        "HIGHLIGHT_TIP": [],
+        "PLOTS": False,
+        "INCREMENTAL": False,
+        "COLLAPSE_HAPLOTYPES": False,
+        "CACHE_SETTINGS": None,
+    })
+    yaml_in["MAPPER_SETTINGS"]["engine"] = "mappy"
+    yaml_in["MAPPER_SETTINGS"]["index_dir"] = str(Path(outdir).parent.joinpath("mmi"))
+    yaml_in["CLUSTER_PICKER_SETTINGS"]["engine"] = "native"
+    return yaml_in
+
+
+def run_stage(yaml_in, stage, treefile):
+    """Run one pipeline stage, measuring it (called in a fresh process).
+
+    Args:
+        yaml_in (dict): the benchmark config.
+        stage (str): one of STAGES.
+        treefile (Path): the simulated tree, used as the rooted tree.
+
+    Returns:
+        dict: the stage record, with 'status' and the peak RSS of the
+            process.
+    """
+    import shutil
+    from .pipeline_runner import Pipeline
+
+    with redirect_stdout(io.StringIO()):
+        pipeline = Pipeline(yaml_in)
+        Path(pipeline.outdir).mkdir(parents=True, exist_ok=True)
+        status = "ok"
+        with pipeline.report.stage(stage) as entry:
+            try:
+                if stage == "compile_input_fasta":
+                    pipeline._compile_input_fasta()
+                elif stage == "map_input_fasta_to_ref" and find_spec("mappy"):
+                    pipeline._map_in_process()
+                elif stage == "map_input_fasta_to_ref":
+                    stack_unmapped(pipeline)
+                    status = "unmapped: mappy is not installed"
+                elif stage == "get_cleaned_fasta":
+                    pipeline._get_clean_fasta_alignment()
+                elif stage == "snp_dists":
+                    pipeline._snp_dists()
+                else:
+                    shutil.copyfile(treefile, pipeline.outfiles["rooted_treefile"])
+                    pipeline._pick_clusters()
+            except SystemExit as exc:
+                status = f"failed: {exc}"
+    entry.update({"status": status, "peak_rss_mb": round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_TO_MB, 1)})
+    return entry
+
+
+def stack_unmapped(pipeline):
+    """Pad the compiled queries into reference coordinates, in place of
+    mapping them.
+
+    The simulated sequences only carry substitutions, so they align to the
+    reference where the simulated region (the target region) starts.
+
+    Args:
+        pipeline (Pipeline): the pipeline of the benchmark.
+    """
+    start = str(pipeline.refseq.seq).upper().find(
+        str(pipeline.target_region.seq).upper().replace("-", ""))
+    if start < 0:
+        sys.exit("The target region is not in the reference sequence.")
+    with open(pipeline.outfiles["fasta_from_bam"], "w") as out_h:
+        for record in SeqIO.parse(pipeline.outfiles["tmp_fasta"], "fasta"):
+            seq = str(record.seq)
+            out_h.write(f">{record.id}\n{'-' * start}{seq}"
+                        f"{'-' * (pipeline.reflen - start - len(seq))}\n")
+
+
+def run_benchmarks(outdir, datasets, sizes, stages, seed=1, max_matrix_gb=4.0):
+    """Benchmark the stages for each dataset and size.
+
+    Args:
+        outdir (str): directory for the data, stage outputs and results.
+        datasets (list): keys of DATASETS.
+        sizes (list): numbers of sequences.
+        stages (list): stages to measure, in pipeline order; stages before
+            them are run unmeasured if their outputs are missing.
+        seed (int): random seed.
+        max_matrix_gb (float): SNP distances are skipped if their matrices
+            would be larger than this.
+
+    Returns:
+        list: result rows, as dicts with RESULT_FIELDS keys.
+    """
+    started = datetime.now().isoformat(timespec="seconds")
+    results = []
+    for dataset in datasets:
+        for n_seqs in sizes:
+            fasta, treefile = write_dataset(dataset, n_seqs, seed,
+                                            Path(outdir).joinpath("data"))
+            yaml_in = bench_config(dataset, fasta,
+                                   Path(outdir).joinpath(f"{dataset}_{n_seqs}"))
+            for stage in STAGES[:max(STAGES.index(name) for name in stages) + 1]:
+                row = {"havic_version": __version__, "started": started,
+                       "dataset": dataset, "sequences": n_seqs, "stage": stage}
+                if stage == "snp_dists" and \
+                        2 * 4 * n_seqs ** 2 > max_matrix_gb * 1024 ** 3:
+                    row["status"] = "skipped: matrices larger than max_matrix_gb"
+                else:
+                    # a fresh process per stage, so peak memory is the stage's own
+                    with ProcessPoolExecutor(max_workers=1) as pool:
+                        row.update(pool.submit(run_stage, yaml_in, stage,
+                                               treefile).result())
+                    row["stage"] = stage
+                if stage in stages:
+                    print("\t".join(str(row.get(field, "")) for field in
+                                    ["dataset", "sequences", "stage", "status",
+                                     "wall_secs", "peak_rss_mb"]))
+                    results.append(row)
+    return results
+
+
+def write_results(results, tsv):
+    """Append result rows to the results table.
+
+    Args:
+        results (list): rows from run_benchmarks().
+        tsv (str): path to the results table.
+    """
+    new = not Path(tsv).is_file()
+    with open(tsv, "a") as tsv_h:
+        if new:
+            tsv_h.write("\t".join(RESULT_FIELDS) + "\n")
+        for row in results:
+            tsv_h.write("\t".join("" if row.get(field) is None else str(row[field])
+                                  for field in RESULT_FIELDS) + "\n")
+
+
+def read_results(tsv):
+    """Read the results table.
+
+    Returns:
+        list: rows as dicts.
+    """
+    with open(tsv, "r") as tsv_h:
+        header = next(tsv_h).rstrip("\n").split("\t")
+        return [dict(zip(header, line.rstrip("\n").split("\t"))) for line in tsv_h]
+
+
+def compare_results(rows, baseline, current, tolerance=1.25, min_secs=0.5):
+    """Find the stages that slowed down between two havic versions.
+
+    The latest result of each dataset, size and stage is used for each
+    version.
+
+    Args:
+        rows (list): rows from read_results().
+        baseline (str): the havic version to compare against.
+        current (str): the havic version to check.
+        tolerance (float): a stage regressed if its wall time grew by more
+            than this factor...
+        min_secs (float): ...and by more than this many seconds.
+
+    Returns:
+        list: (dataset, sequences, stage, baseline secs, current secs) of
+            each regressed stage.
+
+    >>> rows = [{"havic_version": v, "dataset": "amplicon", "sequences": "100",
+    ...          "stage": "snp_dists", "status": "ok", "wall_secs": s}
+    ...         for v, s in [("0.1", "1.0"), ("0.2", "3.0")]]
+    >>> compare_results(rows, "0.1", "0.2")
+    [('amplicon', '100', 'snp_dists', 1.0, 3.0)]
+    """
+    latest = {}
+    for row in rows:
+        if row["status"] == "ok" and row["havic_version"] in (baseline, current):
+            latest[(row["havic_version"], row["dataset"], row["sequences"],
+                    row["stage"])] = float(row["wall_secs"])
+    regressed = []
+    for (version, *key), secs in latest.items():
+        before = latest.get((baseline, *key))
+        if version == current and before is not None and \
+                secs > before * tolerance and secs - before > min_secs:
+            regressed.append((*key, before, secs))
+    return regressed
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
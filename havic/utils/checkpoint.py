@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""Record completed pipeline stages so that interrupted runs can resume.
+
+The manifest ('{RUN_PREFIX}checkpoint.json' in the OUTDIR) holds, for each
+completed stage, the sha256 of its input and output files and of its
+settings.  A stage is skipped on the next run if its inputs and settings are
+unchanged and its outputs are still as written.  A stage interrupted part
+way through was never recorded, so it runs again.  Stages that keep their
+own checkpoint (IQ-TREE) are also recorded when they start, so that a rerun
+can tell whether the tool's checkpoint belongs to the same inputs.
+
+The manifest, and the outputs written by havic itself, are replaced
+atomically, so a preempted job never leaves a truncated file behind that
+looks complete.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from .stage_cache import file_digest
+
+
+@contextmanager
+def atomic_path(fname):
+    """Write to a temporary path that replaces fname on success.
+
+    Args:
+        fname (str): the final output path.
+
+    Yields:
+        str: the temporary path to write to.
+    """
+    tmp = f"{fname}.{os.getpid()}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, fname)
+    finally:
+        if Path(tmp).exists():
+            Path(tmp).unlink()
+
+
+def iqtree_finished(ckp_gz):
+    """IQ-TREE's own checkpoint records a finished run.
+
+    Args:
+        ckp_gz (str): path to the IQ-TREE '.ckp.gz' checkpoint.
+
+    Returns:
+        bool: True if the checkpoint holds 'finished: true'.
+    """
+    import gzip
+
+    try:
+        with gzip.open(ckp_gz, "rt") as ckp_h:
+            return any(line.strip() == "finished: true" for line in ckp_h)
+    except (OSError, EOFError, UnicodeDecodeError):  # absent or truncated
+        return False
+
+
+def settings_digest(settings):
+    """The sha256 of json-serialisable stage settings.
+
+    >>> settings_digest({"b": 1, "a": 2}) == settings_digest({"a": 2, "b": 1})
+    True
+    """
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Checkpoint:
+    """A manifest of completed stages."""
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.stages = {}
+        if Path(manifest).is_file():
+            with open(manifest, "r") as manifest_h:
+                self.stages = json.load(manifest_h).get("stages", {})
+        self._digests = {}
+        # stages in parallel ruffus threads update the manifest
+        self._lock = threading.Lock()
+
+    def _digest(self, fname):
+        """sha256 of a file, or None if missing; rehashed only on change."""
+        path = Path(fname)
+        if not path.is_file():
+            return None
+        stat = path.stat()
+        key = (str(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._digests:
+            self._digests[key] = file_digest(path)
+        return self._digests[key]
+
+    def _digests_of(self, fnames):
+        return {str(fname): self._digest(fname) for fname in fnames}
+
+    def _write(self):
+        with atomic_path(self.manifest) as tmp:
+            with open(tmp, "w") as manifest_h:
+                json.dump({"stages": self.stages}, manifest_h, indent=1)
+
+    def done(self, stage, inputs, outputs, settings=None):
+        """The stage completed with these inputs and its outputs are intact.
+
+        Args:
+            stage (str): stage name.
+            inputs (list): paths to the files read by the stage.
+            outputs (list): paths to the files written by the stage.
+            settings (dict): yaml settings used by the stage.
+
+        Returns:
+            bool: True if the stage can be skipped.
+        """
+        entry = self.stages.get(stage)
+        return bool(entry) and entry.get("status") == "done" \
+            and entry["settings"] == settings_digest(settings) \
+            and entry["inputs"] == self._digests_of(inputs) \
+            and entry["outputs"] == self._digests_of(outputs) \
+            and None not in entry["outputs"].values()
+
+    def started(self, stage, inputs, settings=None):
+        """The stage was started (and maybe finished) with these inputs.
+
+        Returns:
+            bool: True if a previous attempt used the same inputs and
+                settings.
+        """
+        entry = self.stages.get(stage)
+        return bool(entry) \
+            and entry["settings"] == settings_digest(settings) \
+            and entry["inputs"] == self._digests_of(inputs)
+
+    def start(self, stage, inputs, settings=None):
+        """Record that a stage has started."""
+        entry = {
+            "status": "started",
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "settings": settings_digest(settings),
+            "inputs": self._digests_of(inputs),
+            "outputs": {},
+        }
+        with self._lock:
+            self.stages[stage] = entry
+            self._write()
+
+    def record(self, stage, inputs, outputs, settings=None):
+        """Record that a stage has completed."""
+        entry = {
+            "status": "done",
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "settings": settings_digest(settings),
+            "inputs": self._digests_of(inputs),
+            "outputs": self._digests_of(outputs),
+        }
+        with self._lock:
+            self.stages[stage] = entry
+            self._write()
+
+    def refresh(self, stage):
+        """Re-record the outputs of a completed stage after a later stage
+        rewrote them on purpose (e.g., expanding collapsed haplotypes)."""
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry and entry.get("status") == "done":
+                entry["outputs"] = self._digests_of(entry["outputs"])
+                self._write()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
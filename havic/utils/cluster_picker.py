@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+"""Pick transmission clusters from a rooted tree and its alignment.
+
+A built-in replacement for the ClusterPicker jar (Ragonnet-Cronin et al.
+2013, https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4228337/).  Clusters
+are the largest clades with branch support at or above
+fine_cluster_support, that lie within a subtree supported at or above
+coarse_subtree_support, and whose maximum pairwise genetic distance is at
+or below distance_fraction.  Clusters with more than
+large_cluster_threshold tips are also listed in their own files.
+
+Genetic distances follow the ClusterPicker distance methods:
+
+    valid      mismatches over the sites where both sequences have A, C, G
+               or T
+    abs        the absolute number of such mismatches
+    gap        as valid, but a gap is a fifth state (sites where both
+               sequences have a gap are ignored)
+    ambiguity  sites with IUPAC ambiguity codes are compared, and only
+               count as mismatches if the codes share no base
+
+Pairwise distances are computed as blocked matrix products of the
+alignment encoding, once per pair of sibling clades from the tips up, and
+a clade is no longer compared once it is known to be too diverse.  A
+threshold sweep reuses the clade distances for every combination of
+fine_cluster_support and distance_fraction.
+
+Input:
+    ete3 Tree, MultipleSeqAlignment
+"""
+
+import numpy as np
+from .snp_dists import encode_alignment
+
+# Nucleotide bit masks, with IUPAC codes as the union of their bases.
+BASE_MASKS = {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8, "R": 5, "Y": 10,
+              "S": 6, "W": 9, "K": 12, "M": 3, "B": 14, "D": 13, "H": 11,
+              "V": 7, "N": 15, "?": 15, "-": 16}
+GAP = 16
+UNAMBIGUOUS = (1, 2, 4, 8)
+METHODS = ("valid", "abs", "gap", "ambiguity")
+MASK_TABLE = np.zeros(256, dtype=np.uint8)
+for char, mask in BASE_MASKS.items():
+    MASK_TABLE[ord(char)] = mask
+
+
+def encode_masks(alignment):
+    """Encode an alignment as nucleotide bit masks.
+
+    Args:
+        alignment (MultipleSeqAlignment): the input alignment.
+
+    Returns:
+        tuple: list of sequence ids, (n x L) uint8 mask matrix.
+    """
+    ids, matrix = encode_alignment(alignment)
+    return ids, MASK_TABLE[matrix]
+
+
+def pair_counts(rows, cols, method):
+    """Mismatches and compared sites between two sets of sequences.
+
+    Args:
+        rows (np.ndarray): (a x L) mask matrix.
+        cols (np.ndarray): (b x L) mask matrix.
+        method (str): one of METHODS.
+
+    Returns:
+        tuple: (a x b) mismatch counts, (a x b) compared site counts.
+
+    >>> masks = MASK_TABLE[np.frombuffer(b"ACGTRACGACCTA-CN", np.uint8)].reshape(2, 8)
+    >>> for method in ["valid", "gap", "ambiguity"]:
+    ...     print(method, [int(count[0, 0]) for count in
+    ...                    pair_counts(masks[:1], masks[1:], method)])
+    valid [1, 5]
+    gap [2, 6]
+    ambiguity [1, 7]
+    """
+    def onehot(masks, code):
+        return (masks == code).astype(np.float32)
+
+    if method == "ambiguity":
+        row_ok = ((rows > 0) & (rows < GAP)).astype(np.float32)
+        col_ok = ((cols > 0) & (cols < GAP)).astype(np.float32)
+        sites = row_ok @ col_ok.T
+        diffs = np.zeros_like(sites)
+        for code in np.unique(rows[(rows > 0) & (rows < GAP)]):
+            diffs += onehot(rows, code) @ (((cols & code) == 0) * col_ok).T
+        return diffs, sites
+    states = UNAMBIGUOUS + ((GAP,) if method == "gap" else ())
+    row_ok = np.isin(rows, states).astype(np.float32)
+    col_ok = np.isin(cols, states).astype(np.float32)
+    sites = row_ok @ col_ok.T
+    matches = sum(onehot(rows, code) @ onehot(cols, code).T for code in UNAMBIGUOUS)
+    if method == "gap":  # sites where both have a gap are not compared
+        sites -= onehot(rows, GAP) @ onehot(cols, GAP).T
+    return sites - matches, sites
+
+
+def max_distance(rows, cols, method, limit=None, block_size=256):
+    """Maximum genetic distance between two sets of sequences.
+
+    Args:
+        rows (np.ndarray): (a x L) mask matrix.
+        cols (np.ndarray): (b x L) mask matrix.
+        method (str): one of METHODS.
+        limit (float): stop as soon as a distance above this is found.
+        block_size (int): rows compared per matrix product.
+
+    Returns:
+        float: the maximum distance (pairs without compared sites are 0).
+    """
+    furthest = 0.0
+    for start in range(0, rows.shape[0], block_size):
+        diffs, sites = (count.astype(np.float64) for count in
+                        pair_counts(rows[start:start + block_size], cols, method))
+        if method == "abs":
+            dists = diffs
+        else:
+            dists = np.divide(diffs, sites, out=np.zeros_like(diffs), where=sites > 0)
+        furthest = max(furthest, float(dists.max(initial=0.0)))
+        if limit is not None and furthest > limit:
+            break
+    return furthest
+
+
+def clade_distances(tree, index, masks, method, limit):
+    """Maximum pairwise distance within each clade, from the tips up.
+
+    Each pair of tips is compared once, at their most recent common ancestor.
+    Clades above a clade known to exceed the limit are not compared.
+
+    Args:
+        tree (ete3.Tree): the rooted tree.
+        index (dict): mask matrix row keyed on tip name.
+        masks (np.ndarray): (n x L) mask matrix.
+        method (str): one of METHODS.
+        limit (float): the cluster distance threshold.
+
+    Returns:
+        dict: maximum distance keyed on node, inf if above the limit.
+    """
+    furthest = {}
+    members = {}
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            furthest[node] = 0.0
+            members[node] = [index[node.name]]
+            continue
+        children = node.children
+        distance = max(furthest[child] for child in children)
+        for pos, child in enumerate(children):
+            for other in children[pos + 1:]:
+                if distance > limit:
+                    break
+                distance = max(distance, max_distance(
+                    masks[members[child]], masks[members[other]], method, limit))
+        furthest[node] = distance if distance <= limit else np.inf
+        members[node] = [] if distance > limit else \
+            [row for child in children for row in members[child]]
+        for child in children:
+            del members[child]
+    return furthest
+
+
+def pick_clusters(tree, alignment, coarse_subtree_support, fine_cluster_support,
+                  distance_fraction, method="valid"):
+    """Pick the clusters of a tree.
+
+    Args:
+        tree (ete3.Tree): rooted tree with branch supports.
+        alignment (MultipleSeqAlignment): alignment of the tips.
+        coarse_subtree_support (float): support defining the subtrees
+            searched for clusters.
+        fine_cluster_support (float): minimum support of a cluster.
+        distance_fraction (float): maximum genetic distance within a
+            cluster (a count of differences for the abs method).
+        method (str): one of METHODS.
+
+    Returns:
+        list: (node, maximum distance) tuples, one per cluster, in tree
+            order.
+
+    >>> from ete3 import Tree
+    >>> from Bio.Align import MultipleSeqAlignment
+    >>> from Bio.SeqRecord import SeqRecord
+    >>> from Bio.Seq import Seq
+    >>> aln = MultipleSeqAlignment([SeqRecord(Seq(seq), id=name) for name, seq in
+    ...     [("a", "ACGTACGTAC"), ("b", "ACGTACGTAA"), ("c", "TTTTACGTAA"),
+    ...      ("d", "TTTTACGAAA")]])
+    >>> tree = Tree("((a:0.1,b:0.1)99:0.3,(c:0.1,d:0.1)80:0.3);")
+    >>> [(sorted(node.get_leaf_names()), dist) for node, dist in
+    ...  pick_clusters(tree, aln, 70, 95, 0.1)]
+    [(['a', 'b'], 0.1)]
+    """
+    furthest = tree_distances(tree, alignment, method, float(distance_fraction))
+    return select_clusters(tree, furthest, coarse_subtree_support,
+                           fine_cluster_support, distance_fraction)
+
+
+def tree_distances(tree, alignment, method, limit):
+    """Maximum pairwise distance within each clade of a tree.
+
+    Args:
+        tree (ete3.Tree): the rooted tree.
+        alignment (MultipleSeqAlignment): alignment of the tips.
+        method (str): one of METHODS.
+        limit (float): distances above this are not resolved.
+
+    Returns:
+        dict: maximum distance keyed on node, inf if above the limit.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown distance method {method}, choose from {METHODS}")
+    ids, masks = encode_masks(alignment)
+    index = {seqid: row for row, seqid in enumerate(ids)}
+    missing = set(tree.get_leaf_names()) - set(index)
+    if missing:
+        raise ValueError(f"Tips missing from the alignment: {', '.join(sorted(missing))}")
+    return clade_distances(tree, index, masks, method, limit)
+
+
+def select_clusters(tree, furthest, coarse_subtree_support, fine_cluster_support,
+                    distance_fraction):
+    """Pick the clusters of a tree from precomputed clade distances.
+
+    Args:
+        tree (ete3.Tree): rooted tree with branch supports.
+        furthest (dict): maximum distance keyed on node, from
+            tree_distances() with a limit of at least distance_fraction.
+        coarse_subtree_support (float): support defining the subtrees
+            searched for clusters.
+        fine_cluster_support (float): minimum support of a cluster.
+        distance_fraction (float): maximum genetic distance within a
+            cluster.
+
+    Returns:
+        list: (node, maximum distance) tuples, one per cluster, in tree
+            order.
+    """
+    clusters = []
+    stack = [(tree, False)]
+    while stack:  # preorder, not descending into picked clusters
+        node, in_subtree = stack.pop()
+        if node.is_leaf():
+            continue
+        in_subtree = in_subtree or node.support >= coarse_subtree_support
+        if in_subtree and node.support >= fine_cluster_support \
+                and furthest[node] <= distance_fraction:
+            clusters.append((node, furthest[node]))
+            continue  # the largest clade wins
+        stack.extend((child, in_subtree) for child in reversed(node.children))
+    return clusters
+
+
+def sweep_clusters(tree, alignment, coarse_subtree_support, fine_cluster_supports,
+                   distance_fractions, method="valid"):
+    """Pick clusters for every combination of support and distance threshold.
+
+    The clade distances are computed once, up to the largest threshold.
+
+    Args:
+        tree (ete3.Tree): rooted tree with branch supports.
+        alignment (MultipleSeqAlignment): alignment of the tips.
+        coarse_subtree_support (float): support defining the subtrees
+            searched for clusters.
+        fine_cluster_supports (list): minimum cluster supports to try.
+        distance_fractions (list): distance thresholds to try.
+        method (str): one of METHODS.
+
+    Yields:
+        tuple: (fine_cluster_support, distance_fraction, clusters), with
+            clusters as from pick_clusters().
+    """
+    furthest = tree_distances(tree, alignment, method, max(distance_fractions))
+    for fine_cluster_support in fine_cluster_supports:
+        for distance_fraction in distance_fractions:
+            yield fine_cluster_support, distance_fraction, select_clusters(
+                tree, furthest, coarse_subtree_support, fine_cluster_support,
+                distance_fraction)
+
+
+def write_sweep(results, tips, prefix):
+    """Write the cluster memberships of a sweep and their stability.
+
+    Three tab-separated files are written:
+
+        PREFIX_sweep.tsv            one row per setting and sequence, with
+                                    its cluster number and size (empty if
+                                    not clustered)
+        PREFIX_sweep_summary.tsv    the number of clusters, clustered
+                                    sequences and the largest cluster per
+                                    setting
+        PREFIX_sweep_stability.tsv  per sequence, the fraction of settings
+                                    in which it is clustered and the
+                                    smallest and largest cluster it joins
+
+    Args:
+        results (iterable): (fine_cluster_support, distance_fraction,
+            clusters) from sweep_clusters().
+        tips (list): tip names in tree order.
+        prefix (str): output path prefix.
+    """
+    sequences = list(tips)
+    clustered = {name: 0 for name in sequences}
+    sizes = {name: [] for name in sequences}
+    n_settings = 0
+    with open(f"{prefix}_sweep.tsv", "w") as sweep_h, \
+            open(f"{prefix}_sweep_summary.tsv", "w") as summary_h:
+        sweep_h.write("fine_cluster_support\tdistance_fraction\tsequence\t"
+                      "cluster\tcluster_size\n")
+        summary_h.write("fine_cluster_support\tdistance_fraction\tclusters\t"
+                        "clustered_sequences\tlargest_cluster\n")
+        for fine, distance, clusters in results:
+            n_settings += 1
+            assignments = {}
+            for number, (node, _) in enumerate(clusters, start=1):
+                names = node.get_leaf_names()
+                for name in names:
+                    assignments[name] = (number, len(names))
+            for name in sequences:
+                number, size = assignments.get(name, ("", ""))
+                sweep_h.write(f"{fine}\t{distance}\t{name}\t{number}\t{size}\n")
+                if name in assignments:
+                    clustered[name] += 1
+                    sizes[name].append(size)
+            largest = max((size for _, size in assignments.values()), default=0)
+            summary_h.write(f"{fine}\t{distance}\t{len(clusters)}\t"
+                            f"{len(assignments)}\t{largest}\n")
+    with open(f"{prefix}_sweep_stability.tsv", "w") as stability_h:
+        stability_h.write("sequence\tfraction_of_settings_clustered\t"
+                          "min_cluster_size\tmax_cluster_size\n")
+        for name in sequences:
+            stability_h.write(
+                f"{name}\t{round(clustered[name] / max(n_settings, 1), 4)}\t"
+                f"{min(sizes[name], default='')}\t{max(sizes[name], default='')}\n")
+
+
+def write_figtree(tree, fname):
+    """Write a tree as a FigTree NEXUS file.
+
+    Args:
+        tree (ete3.Tree): the tree.
+        fname (str): output path.
+    """
+    with open(fname, "w") as out_h:
+        out_h.write("#NEXUS\nbegin trees;\n\ttree tree_1 = [&R] "
+                    f"{tree.write(format=1, dist_formatter='%0.16f')}\nend;\n")
+
+
+def write_cluster_picks(tree, alignment, clusters, large_cluster_threshold,
+                        outfiles):
+    """Write the outputs in the ClusterPicker layout.
+
+    Args:
+        tree (ete3.Tree): the rooted tree (tips are renamed in place).
+        alignment (MultipleSeqAlignment): alignment of the tips.
+        clusters (list): (node, maximum distance) from pick_clusters().
+        large_cluster_threshold (int): clusters with more tips are also
+            written to their own sequence list.
+        outfiles (dict): paths keyed on 'nwk', 'figtree', 'list', 'log',
+            'fas' and 'large_cluster' (a format string taking the cluster
+            number).
+    """
+    assignments = {}
+    with open(outfiles["log"], "w") as log_h:
+        log_h.write("ClusterNumber\tNumberOfTips\tTipNames\t"
+                    "MaxGeneticDistance\tBootstrap\n")
+        for number, (node, dist) in enumerate(clusters, start=1):
+            names = node.get_leaf_names()
+            for name in names:
+                assignments[name] = number
+            log_h.write(f"{number}\t{len(names)}\t[{', '.join(names)}]\t"
+                        f"{dist}\t{node.support}\n")
+            if len(names) > large_cluster_threshold:
+                with open(outfiles["large_cluster"].format(number), "w") as large_h:
+                    large_h.write("\n".join(names) + "\n")
+    with open(outfiles["list"], "w") as list_h:
+        list_h.write("SequenceName\tClusterNumber\n")
+        for name in tree.get_leaf_names():
+            if name in assignments:
+                list_h.write(f"{name}\t{assignments[name]}\n")
+    with open(outfiles["fas"], "w") as fas_h:
+        for seq in alignment:
+            prefix = f"Clust{assignments[seq.id]}_" if seq.id in assignments else ""
+            fas_h.write(f">{prefix}{seq.id}\n{seq.seq}\n")
+    for leaf in tree.iter_leaves():
+        if leaf.name in assignments:
+            leaf.name = f"Clust{assignments[leaf.name]}_{leaf.name}"
+    tree.write(outfile=outfiles["nwk"], dist_formatter="%0.16f")
+    write_figtree(tree, outfiles["figtree"])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
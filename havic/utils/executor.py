@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""Run external tools without a shell, with logging, timeouts and checks.
+
+Commands are argument lists.  Pipelines are wired with pipes between the
+processes, stderr (and stdout, unless it is redirected or captured) is
+streamed line by line to the terminal and to a log file, each stage may be
+given a timeout, and a non-zero exit status raises ToolError so that a
+failed stage stops the run instead of feeding empty files downstream.
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+
+class ToolError(RuntimeError):
+    """An external tool failed or timed out."""
+
+
+class Executor:
+    """Run external commands and pipelines."""
+
+    def __init__(self, log_path=None, on_exit=None):
+        """
+        Args:
+            log_path (str): file the tool output is appended to.
+            on_exit (callable): called with the resource usage of each
+                finished process (e.g. RunReport.child_exited).
+        """
+        self.log_path = log_path
+        self.on_exit = on_exit
+        self._lock = threading.Lock()
+
+    def _log(self, line):
+        with self._lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            if self.log_path:
+                with open(self.log_path, "a") as log_h:
+                    log_h.write(line)
+
+    def _wait(self, proc, deadline):
+        """Reap a process with os.wait4, to collect its resource usage.
+
+        Raises:
+            subprocess.TimeoutExpired: if the deadline passes first.
+        """
+        while True:
+            pid, status, usage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+            if pid:
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                if self.on_exit is not None:
+                    self.on_exit(usage)
+                return
+            if time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(proc.args, 0)
+            time.sleep(0.01)
+
+    def _stream(self, name, pipe):
+        for line in iter(pipe.readline, b""):
+            self._log(f"[{name}] {line.decode('utf-8', 'replace')}")
+        pipe.close()
+
+    def run(self, *commands, stdout=None, capture=False, timeout=None):
+        """Run a command, or several commands piped into each other.
+
+        Args:
+            commands (list): one or more argument lists.
+            stdout (str): path to write the final stdout to.
+            capture (bool): return the final stdout instead of logging it.
+            timeout (float): seconds before all processes are killed.
+
+        Returns:
+            str: the captured stdout if capture is True, else None.
+
+        >>> Executor().run(["printf", "a\\\\nb\\\\n"], ["sort", "-r"], capture=True)
+        $ printf 'a\\nb\\n' | sort -r
+        'b\\na\\n'
+        """
+        self._log("$ " + " | ".join(shlex.join(args) for args in commands)
+                  + (f" > {stdout}" if stdout else "") + "\n")
+        procs, threads, captured = [], [], []
+        out_h = open(stdout, "wb") if stdout else None
+        try:
+            for idx, args in enumerate(commands):
+                last = idx == len(commands) - 1
+                try:
+                    proc = subprocess.Popen(
+                        args,
+                        stdin=procs[-1].stdout if procs else subprocess.DEVNULL,
+                        stdout=(out_h or subprocess.PIPE) if last else subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                    )
+                except OSError as exc:
+                    raise ToolError(f"Unable to start {args[0]}: {exc}") from exc
+                if procs:
+                    procs[-1].stdout.close()  # let the upstream process get SIGPIPE
+                procs.append(proc)
+                name = args[0].split("/")[-1]
+                threads.append(threading.Thread(
+                    target=self._stream, args=(name, proc.stderr), daemon=True))
+                if last and capture:
+                    threads.append(threading.Thread(
+                        target=lambda pipe: captured.append(pipe.read()),
+                        args=(proc.stdout,), daemon=True))
+                elif last and not out_h:
+                    threads.append(threading.Thread(
+                        target=self._stream, args=(name, proc.stdout), daemon=True))
+            for thread in threads:
+                thread.start()
+            deadline = None if timeout is None else time.monotonic() + float(timeout)
+            for proc, args in zip(procs, commands):
+                try:
+                    self._wait(proc, deadline)
+                except subprocess.TimeoutExpired:
+                    for other in procs:
+                        other.kill()
+                    raise ToolError(
+                        f"{shlex.join(args)} timed out after {timeout} seconds")
+            for thread in threads:
+                thread.join()
+        finally:
+            if out_h:
+                out_h.close()
+        for proc, args in zip(procs, commands):
+            if proc.returncode != 0:
+                raise ToolError(
+                    f"{shlex.join(args)} failed with exit status {proc.returncode}")
+        return b"".join(captured).decode("utf-8") if capture else None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""Collapse identical aligned sequences into haplotypes, and expand them.
+
+Identical sequences in the trimmed alignment are represented by a single
+sequence during tree inference and cluster picking.  Afterwards, the
+collapsed members are added back to the trees and cluster lists as
+zero-length sister tips of their representative.
+"""
+
+import re
+from Bio.Align import MultipleSeqAlignment
+
+CLUSTER_PREFIX = re.compile(r"^(Clust\d+_)?(.*)$")
+
+
+def collapse_haplotypes(alignment, keep=(), min_haplotypes=3):
+    """Group identical aligned sequences.
+
+    Args:
+        alignment (MultipleSeqAlignment): the trimmed alignment.
+        keep (iterable): ids that must be used as representatives if they
+            are part of a group (e.g., the tree root).
+        min_haplotypes (int): nothing is collapsed if fewer haplotypes
+            remain (IQ-TREE needs at least 3 sequences).
+
+    Returns:
+        tuple: MultipleSeqAlignment of representatives, dict of member ids
+            keyed on representative id (groups of one are omitted).
+    """
+    keep = set(keep)
+    alignment = list(alignment)
+    groups = {}
+    for seq in alignment:
+        groups.setdefault(str(seq.seq).upper(), []).append(seq)
+    if len(groups) < min_haplotypes:
+        return MultipleSeqAlignment(alignment), {}
+    representatives = []
+    members = {}
+    for group in groups.values():
+        group.sort(key=lambda seq: seq.id not in keep)
+        representatives.append(group[0])
+        if len(group) > 1:
+            members[group[0].id] = [seq.id for seq in group[1:]]
+    return MultipleSeqAlignment(representatives), members
+
+
+def write_haplotype_map(members, fname):
+    """Write the representative to member mapping as a tsv.
+
+    Args:
+        members (dict): member ids keyed on representative id.
+        fname (str): output path.
+    """
+    with open(fname, "w") as out_h:
+        out_h.write("REPRESENTATIVE\tMEMBER\n")
+        for rep, member_ids in members.items():
+            for member in member_ids:
+                out_h.write(f"{rep}\t{member}\n")
+
+
+def read_haplotype_map(fname):
+    """Read the representative to member mapping.
+
+    Args:
+        fname (str): path written by write_haplotype_map().
+
+    Returns:
+        dict: member ids keyed on representative id.
+    """
+    members = {}
+    with open(fname, "r") as input_h:
+        next(input_h)
+        for line in input_h:
+            rep, member = line.rstrip("\n").split("\t")
+            members.setdefault(rep, []).append(member)
+    return members
+
+
+def expand_tree(tree, members):
+    """Add collapsed members as zero-length sisters of their representative.
+
+    Tip names carrying a ClusterPicker 'ClustN_' prefix pass it on to the
+    expanded members.
+
+    Args:
+        tree (ete3.Tree): tree with representative tips.
+        members (dict): member ids keyed on representative id.
+
+    Returns:
+        ete3.Tree: the expanded tree (modified in place).
+    """
+    for leaf in tree.get_leaves():
+        prefix, rep = CLUSTER_PREFIX.match(leaf.name).groups()
+        prefix = prefix or ""
+        if rep not in members:
+            continue
+        leaf.name = ""
+        for tip in [rep] + members[rep]:
+            leaf.add_child(name=prefix + tip, dist=0.0)
+    return tree
+
+
+def expand_cluster_list(fname, members):
+    """Expand a ClusterPicker '_clusterPicks_list.txt' file in place.
+
+    Args:
+        fname (str): path to the cluster list (tab-separated, sequence name
+            in the first column).
+        members (dict): member ids keyed on representative id.
+    """
+    with open(fname, "r") as input_h:
+        lines = input_h.read().splitlines()
+    with open(fname, "w") as out_h:
+        for line in lines:
+            out_h.write(line + "\n")
+            fields = line.split("\t")
+            for member in members.get(fields[0], []):
+                out_h.write("\t".join([member] + fields[1:]) + "\n")
+
+
+def expand_cluster_log(fname, members):
+    """Expand a ClusterPicker '_clusterPicks_log.txt' file in place.
+
+    The collapsed members are added to the TipNames of their
+    representative's cluster, and NumberOfTips is updated.
+
+    Args:
+        fname (str): path to the cluster log (tab-separated, with the
+            NumberOfTips and '[a, b]' TipNames in the second and third
+            columns).
+        members (dict): member ids keyed on representative id.
+    """
+    with open(fname, "r") as input_h:
+        lines = input_h.read().splitlines()
+    with open(fname, "w") as out_h:
+        out_h.write(lines[0] + "\n")
+        for line in lines[1:]:
+            fields = line.split("\t")
+            if len(fields) > 2 and fields[2].startswith("["):
+                names = []
+                for name in filter(None, fields[2].strip("[]").split(", ")):
+                    prefix, rep = CLUSTER_PREFIX.match(name).groups()
+                    names += [name] + [(prefix or "") + member
+                                       for member in members.get(rep, [])]
+                fields[1:3] = [str(len(names)), f"[{', '.join(names)}]"]
+            out_h.write("\t".join(fields) + "\n")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""Keep the state of a run so that later runs only process new samples.
+
+The state, stored in OUTDIR, consists of:
+    - a json file of sequence ids and content hashes of the compiled queries,
+    - the stacked (untrimmed, reference coordinate) alignment,
+    - the unrooted IQ-TREE treefile.
+
+Sequences that are new or whose content has changed since the stored run
+are mapped and stacked, then appended to the stored alignment.  The stored
+tree, pruned to the remaining sequences, constrains the next tree search so
+that new sequences are placed on the existing topology.
+
+The state is kept when FORCE_OVERWRITE_AND_RE_RUN clears the OUTDIR.  It
+records a digest of the reference and mapping settings, and a state stored
+against another reference or k-mer size is ignored.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from Bio import SeqIO
+
+
+def sequence_hash(record):
+    """Hash the ungapped, upper-case sequence of a SeqRecord.
+
+    Args:
+        record (SeqRecord): input sequence.
+
+    Returns:
+        str: hex digest.
+    """
+    return hashlib.sha1(
+        str(record.seq).replace("-", "").upper().encode()
+    ).hexdigest()
+
+
+class RunState:
+    """Load and save the state of a previous run."""
+
+    def __init__(self, outdir, prefix, reference=""):
+        """
+        Args:
+            outdir (str): the output directory.
+            prefix (str): the RUN_PREFIX of the state files.
+            reference (str): digest of the reference and mapping settings
+                the stacked alignment depends on.
+        """
+        self.reference = reference
+        self.json = Path(outdir).joinpath(f"{prefix}run_state.json")
+        self.stack = Path(outdir).joinpath(f"{prefix}run_state.stack.fa")
+        self.treefile = Path(outdir).joinpath(f"{prefix}run_state.treefile")
+        self.constraint = Path(outdir).joinpath(
+            f"{prefix}run_state.constraint.treefile")
+
+    def _load(self):
+        """The stored state, or None if absent or for another reference."""
+        if not (self.json.is_file() and self.stack.is_file()):
+            return None
+        with open(self.json, "r") as json_h:
+            state = json.load(json_h)
+        return state if state.get("reference") == self.reference else None
+
+    def exists(self):
+        """A previous run against the same reference has stored its alignment."""
+        return self._load() is not None
+
+    def hashes(self):
+        """Sequence hashes of the previous run, keyed on sequence id."""
+        state = self._load()
+        return {} if state is None else state["hashes"]
+
+    def split_new(self, records):
+        """Separate records that need mapping from those already stacked.
+
+        Args:
+            records (iterable): SeqRecords of the compiled queries.
+
+        Returns:
+            tuple: list of new or changed SeqRecords, set of unchanged ids.
+        """
+        previous = self.hashes()
+        new, kept = [], set()
+        for record in records:
+            if previous.get(record.id) == sequence_hash(record):
+                kept.add(record.id)
+            else:
+                new.append(record)
+        return new, kept
+
+    def stacked_records(self, kept):
+        """Yield the stored stacked sequences still present in the input.
+
+        Args:
+            kept (set): ids of unchanged sequences.
+        """
+        for record in SeqIO.parse(self.stack, "fasta"):
+            if record.id in kept:
+                yield record
+
+    def save(self, records, alignment):
+        """Store the compiled query hashes and the stacked alignment.
+
+        Args:
+            records (iterable): SeqRecords of the compiled queries.
+            alignment (MultipleSeqAlignment): stacked alignment.
+        """
+        SeqIO.write(alignment, self.stack, "fasta")
+        with open(self.json, "w") as json_h:
+            json.dump(
+                {"reference": self.reference,
+                 "hashes": {record.id: sequence_hash(record) for record in records}},
+                json_h,
+                indent=1,
+            )
+
+    def save_tree(self, treefile):
+        """Store the unrooted treefile of this run."""
+        shutil.copyfile(treefile, self.treefile)
+
+    def constraint_tree(self, taxa):
+        """Prune the stored tree to taxa still in the alignment.
+
+        Args:
+            taxa (iterable): sequence ids in the current alignment.
+
+        Returns:
+            Path: the constraint treefile, or None if fewer than four taxa of
+                the stored tree remain.
+        """
+        if not self.treefile.is_file():
+            return None
+        from ete3 import Tree
+        tree = Tree(self.treefile.as_posix(), format=0)
+        keep = set(tree.get_leaf_names()) & set(taxa)
+        if len(keep) < 4:
+            return None
+        tree.prune(keep, preserve_branch_length=True)
+        tree.write(outfile=self.constraint.as_posix(), format=9)
+        return self.constraint
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
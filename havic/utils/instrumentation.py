@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""Record per-stage resource usage and write a machine-readable run report.
+
+For each stage, the report holds the wall time, the user and system CPU time
+of havic and of its child processes (minimap2, samtools, IQ-TREE,
+ClusterPicker, R), the peak resident set size of the children, and any stage
+metrics such as sequence counts or alignment width.
+
+The usage of each child process is collected by the Executor when it reaps
+the child (os.wait4), and is added to the stage that launched it.  The CPU
+time of havic itself is process-wide, so it includes the stages that run at
+the same time (snp_dists runs alongside the tree stages) and their worker
+threads.  The peak RSS of havic is reported once for the whole run, as the
+operating system only keeps the maximum over the life of the process.
+"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from .. import __version__
+
+# ru_maxrss is reported in bytes on macOS and kilobytes elsewhere.
+RSS_TO_MB = 1 / 1024 ** 2 if sys.platform == "darwin" else 1 / 1024
+
+
+class RunReport:
+    """Collect stage records and write them as json and tsv."""
+
+    FIELDS = [
+        "stage",
+        "parent",
+        "wall_secs",
+        "user_cpu_secs",
+        "sys_cpu_secs",
+        "children_user_cpu_secs",
+        "children_sys_cpu_secs",
+        "peak_rss_mb",
+        "children_peak_rss_mb",
+    ]
+
+    def __init__(self, json_path, tsv_path):
+        self.json_path = json_path
+        self.tsv_path = tsv_path
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.stages = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # stages may run in parallel threads
+
+    @property
+    def _stack(self):
+        """The running stages of the calling thread, outermost first."""
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current(self):
+        """The innermost running stage of the calling thread."""
+        return self._stack[-1] if self._stack else None
+
+    def record(self, **metrics):
+        """Attach metrics (e.g., sequences=10) to the current stage."""
+        if self.current is not None:
+            self.current.setdefault("metrics", {}).update(metrics)
+
+    def bind(self, func):
+        """Run func in a worker thread as part of the calling thread's stages.
+
+        Args:
+            func (callable): the function submitted to a thread pool.
+
+        Returns:
+            callable: func, run with the caller's stages.
+        """
+        stack = list(self._stack)
+
+        def bound(*args, **kwargs):
+            self._local.stack = list(stack)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.stack = []
+        return bound
+
+    def child_exited(self, usage):
+        """Add the usage of a reaped child process to the running stages.
+
+        Args:
+            usage (resource.struct_rusage): from os.wait4.
+        """
+        with self._lock:
+            for entry in self._stack:
+                entry["children_user_cpu_secs"] += usage.ru_utime
+                entry["children_sys_cpu_secs"] += usage.ru_stime
+                entry["children_peak_rss_mb"] = max(
+                    entry["children_peak_rss_mb"] or 0, usage.ru_maxrss * RSS_TO_MB)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the resource usage of a stage.
+
+        Args:
+            name (str): the stage name.
+        """
+        before_self = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        entry = {"stage": name, "children_user_cpu_secs": 0.0,
+                 "children_sys_cpu_secs": 0.0, "children_peak_rss_mb": None}
+        if self.current is not None:  # nested stages are part of their parent
+            entry["parent"] = self.current["stage"]
+        self._stack.append(entry)
+        try:
+            yield entry
+        finally:
+            after_self = resource.getrusage(resource.RUSAGE_SELF)
+            self._stack.pop()
+            with self._lock:
+                entry.update({
+                    "wall_secs": round(time.perf_counter() - start, 3),
+                    "user_cpu_secs": round(after_self.ru_utime - before_self.ru_utime, 3),
+                    "sys_cpu_secs": round(after_self.ru_stime - before_self.ru_stime, 3),
+                    "children_user_cpu_secs": round(entry["children_user_cpu_secs"], 3),
+                    "children_sys_cpu_secs": round(entry["children_sys_cpu_secs"], 3),
+                    "children_peak_rss_mb": None if entry["children_peak_rss_mb"] is None
+                    else round(entry["children_peak_rss_mb"], 1),
+                })
+                self.stages.append(entry)
+
+    def totals(self):
+        """The usage of the whole run so far.
+
+        Returns:
+            dict: a record of the 'run' with the peak RSS of havic and of its
+                largest child.
+        """
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {
+            "stage": "run",
+            "wall_secs": round(time.perf_counter() - self._start, 3),
+            "user_cpu_secs": round(usage_self.ru_utime, 3),
+            "sys_cpu_secs": round(usage_self.ru_stime, 3),
+            "children_user_cpu_secs": round(usage_children.ru_utime, 3),
+            "children_sys_cpu_secs": round(usage_children.ru_stime, 3),
+            "peak_rss_mb": round(usage_self.ru_maxrss * RSS_TO_MB, 1),
+            "children_peak_rss_mb": round(usage_children.ru_maxrss * RSS_TO_MB, 1),
+        }
+
+    def write(self):
+        """Write the report as json and tsv."""
+        run = self.totals()
+        with open(self.json_path, "w") as json_h:
+            json.dump({"havic_version": __version__,
+                       "started": self.started,
+                       "run": run,
+                       "stages": self.stages},
+                      json_h, indent=1)
+        metric_names = sorted({name for entry in self.stages
+                               for name in entry.get("metrics", {})})
+        with open(self.tsv_path, "w") as tsv_h:
+            tsv_h.write("\t".join(self.FIELDS + metric_names) + "\n")
+            for entry in self.stages + [run]:
+                values = [entry.get(field) for field in self.FIELDS] + \
+                         [entry.get("metrics", {}).get(name) for name in metric_names]
+                tsv_h.write("\t".join("" if value is None else str(value)
+                                      for value in values) + "\n")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""Partition very large runs into neighbourhoods of similar sequences.
+
+Clusters are clades whose sequences are all within distance_fraction of
+each other, so a cluster never joins sequences that are further apart than
+that.  Sequences are grouped into neighbourhoods such that any two
+sequences within a distance bound share a neighbourhood; a tree is then
+inferred for each neighbourhood, and the neighbourhood trees are joined at
+a common root.
+
+Distances are estimated from b-bit MinHash sketches with one-permutation
+hashing (Li et al. 2012): the canonical k-mers of each ungapped sequence
+are hashed into sketch_size bins, and the sketch keeps the lowest two bits
+of the smallest hash in each bin.  Sketches are one-hot encoded, so that
+the matching bins of many pairs of sequences are counted by blocked matrix
+products.  The proportion of matching bins, less chance matches, estimates
+the Jaccard index of two k-mer sets, and the Mash distance (Ondov et al.
+2016, https://doi.org/10.1186/s13059-016-0997-x) derived from it
+approximates the proportion of differing sites; the distance bound is
+compared as the equivalent proportion of matching bins.
+
+Sequences are first assigned to the nearest leader within half the bound
+(a new leader is made if there is none), and leaders within twice the bound
+are then linked, so that any two sequences within the bound end up in the
+same neighbourhood.
+"""
+
+import numpy as np
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+BITS = 2  # bits of the minimum hash kept per sketch bin
+BLOCK_SIZE = 1024  # sketches compared per matrix product
+CHUNK_BASES = 2 ** 22  # bases hashed at a time
+MIN_NEIGHBOURHOOD = 4  # IQ-TREE bootstraps need four sequences
+
+
+def kmer_hashes(seq, k):
+    """Hash the canonical k-mers of a sequence, skipping ambiguous bases.
+
+    Args:
+        seq (str): an ungapped nucleotide sequence.
+        k (int): k-mer size, at most 31.
+
+    Returns:
+        tuple: uint64 hashes and start positions of the k-mers.
+
+    >>> hashes, starts = kmer_hashes("ACGTNACGTAC", 4)
+    >>> starts.tolist(), len(kmer_hashes("ACG", 4)[0])
+    ([0, 5, 6, 7], 0)
+    >>> set(kmer_hashes("AACC", 4)[0]) == set(kmer_hashes("GGTT", 4)[0])
+    True
+    """
+    codes = BASE_CODES[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.intp)
+    ambiguous = np.concatenate([[0], np.cumsum(codes > 3)])
+    bases = np.where(codes > 3, 0, codes).astype(np.uint64)
+    forward = np.zeros(n_kmers, dtype=np.uint64)
+    reverse = np.zeros(n_kmers, dtype=np.uint64)
+    for offset in range(k):
+        window = bases[offset:offset + n_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * offset)
+    starts = np.flatnonzero(ambiguous[k:] == ambiguous[:-k])
+    kmers = np.minimum(forward, reverse)[starts]
+    # splitmix64 finaliser, so that any range of hashes is a random sample
+    kmers = (kmers ^ (kmers >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    kmers = (kmers ^ (kmers >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return kmers ^ (kmers >> np.uint64(31)), starts
+
+
+def sketch(seqs, k, size):
+    """The one-hot b-bit MinHash sketches of sequences.
+
+    Rows are scaled to unit length, so that the product of two sketches is
+    the proportion of matching bins among those filled in both.
+
+    Args:
+        seqs (list): ungapped nucleotide sequences.
+        k (int): k-mer size, at most 31.
+        size (int): number of bins.
+
+    Returns:
+        np.ndarray: (n x size * 2^BITS) float32 matrix.
+
+    >>> sketches = sketch(["ACGTTGCA", "ACG"], 4, 8)
+    >>> sketches.shape, (sketches > 0).sum(axis=1).tolist()  # 5 distinct 4-mers
+    ((2, 32), [4, 0])
+    """
+    codes = 2 ** BITS
+    sketches = np.zeros((len(seqs), size * codes), dtype=np.float32)
+    first = 0
+    while first < len(seqs):  # hash many short sequences at a time
+        last, bases = first, 0
+        while last < len(seqs) and (last == first or bases < CHUNK_BASES) \
+                and (last - first + 1) * size < 2 ** 32:
+            bases += len(seqs[last]) + 1
+            last += 1
+        chunk = seqs[first:last]
+        # the N between sequences breaks the k-mers that would span them
+        offsets = np.cumsum([0] + [len(seq) + 1 for seq in chunk[:-1]])
+        hashes, starts = kmer_hashes("N".join(chunk), k)
+        rows = np.searchsorted(offsets, starts, side="right") - 1
+        # bins from the low bits of each hash, ordered on the high bits
+        cells = rows.astype(np.uint64) * np.uint64(size) + hashes % np.uint64(size)
+        keys = np.sort((cells << np.uint64(32)) | (hashes >> np.uint64(32)))
+        if len(keys):
+            cell_keys = keys >> np.uint64(32)
+            keys = keys[np.concatenate([[True], cell_keys[1:] != cell_keys[:-1]])]
+        cells = (keys >> np.uint64(32)).astype(np.intp)
+        sketches[first + cells // size, (cells % size) * codes
+                 + (keys % np.uint64(codes)).astype(np.intp)] = 1
+        first = last
+    filled = sketches.sum(axis=1, keepdims=True)
+    return np.divide(sketches, np.sqrt(filled), out=sketches, where=filled > 0)
+
+
+def similarity_bound(dist, k):
+    """The sketch similarity of sequences at a Mash distance.
+
+    Args:
+        dist (float): distance, as a proportion of sites.
+        k (int): k-mer size.
+
+    Returns:
+        float: the expected product of their sketches.
+
+    >>> sketches = sketch(["ACGTACGGTACCAGTTACAG", "GGGGGGGGGGGGG"], 4, 16)
+    >>> (sketches @ sketches.T >= similarity_bound(0.05, 4)).tolist()
+    [[True, False], [False, True]]
+    """
+    jaccard = 1 / (2 * np.exp(k * dist) - 1)
+    chance = 1 / 2 ** BITS  # bins with different minima match by chance
+    return chance + (1 - chance) * jaccard
+
+
+def neighbourhoods(ids, seqs, bound, k=15, sketch_size=128):
+    """Group sequences so that any two within the bound share a group.
+
+    Args:
+        ids (list): sequence ids.
+        seqs (list): the aligned or unaligned sequences (gaps are ignored).
+        bound (float): distance, as a proportion of sites.
+        k (int): k-mer size, at most 31.
+        sketch_size (int): number of MinHash bins per sequence.
+
+    Returns:
+        list: lists of sequence ids, one per neighbourhood, in input order.
+
+    >>> rng = np.random.default_rng(1)
+    >>> a, b = ("".join(rng.choice(list("ACGT"), 300)) for _ in range(2))
+    >>> neighbourhoods(["a1", "b1", "a2"], [a, b, a[:150] + "-" + a[151:]], 0.02)
+    [['a1', 'a2'], ['b1']]
+    """
+    unique = {}  # identical sequences share a sketch
+    for seqid, seq in zip(ids, seqs):
+        unique.setdefault(seq.replace("-", "").upper(), []).append(seqid)
+    sketches = sketch(list(unique), k, sketch_size)
+    leader_bound = similarity_bound(bound / 2, k)
+    link_bound = similarity_bound(2 * bound, k)
+
+    # leaders, for a block at a time
+    leaders = []
+    leader_of = np.empty(len(sketches), dtype=np.intp)
+    for start in range(0, len(sketches), BLOCK_SIZE):
+        block = sketches[start:start + BLOCK_SIZE]
+        nearest = np.full(len(block), -1)
+        if leaders:
+            similar = block @ sketches[leaders].T
+            nearest = np.where(similar.max(axis=1) >= leader_bound,
+                               similar.argmax(axis=1), -1)
+        new = np.flatnonzero(nearest < 0)
+        within = block[new] @ block[new].T >= leader_bound
+        first_leader = len(leaders)
+        block_leaders = []  # positions in new
+        for idx, row in enumerate(new):
+            joined = np.flatnonzero(within[idx, block_leaders])
+            if len(joined):
+                nearest[row] = first_leader + joined[0]
+            else:
+                nearest[row] = first_leader + len(block_leaders)
+                block_leaders.append(idx)
+                leaders.append(start + row)
+        leader_of[start:start + len(block)] = nearest
+
+    # leaders within twice the bound share the smallest label
+    leader_sketches = sketches[leaders]
+    adjacency = [np.packbits(leader_sketches[start:start + BLOCK_SIZE]
+                             @ leader_sketches.T >= link_bound, axis=1)
+                 for start in range(0, len(leaders), BLOCK_SIZE)]
+    labels = np.arange(len(leaders))
+    while True:
+        linked = labels.copy()
+        for start, packed in zip(range(0, len(leaders), BLOCK_SIZE), adjacency):
+            near = np.unpackbits(packed, axis=1, count=len(leaders)).astype(bool)
+            linked[start:start + len(near)] = np.minimum(
+                labels[start:start + len(near)],
+                np.where(near, labels, len(labels)).min(axis=1))
+        linked = linked[linked]
+        if (linked == labels).all():
+            break
+        labels = linked
+
+    groups = {}
+    for members, leader in zip(unique.values(), leader_of):
+        groups.setdefault(labels[leader], []).extend(members)
+    order = {seqid: idx for idx, seqid in enumerate(ids)}
+    return sorted((sorted(group, key=order.get) for group in groups.values()),
+                  key=lambda group: order[group[0]])
+
+
+def pool_small(groups, min_size=MIN_NEIGHBOURHOOD):
+    """Pool the neighbourhoods too small for a tree of their own.
+
+    The pooled sequences are far apart, so they stay apart in the tree.
+
+    Args:
+        groups (list): lists of sequence ids.
+        min_size (int): the smallest neighbourhood kept.
+
+    Returns:
+        list: lists of sequence ids.
+
+    >>> pool_small([["a", "b", "c", "d"], ["e"], ["f", "g"], ["h"]])
+    [['a', 'b', 'c', 'd'], ['e', 'f', 'g', 'h']]
+    >>> pool_small([["a", "b", "c", "d"], ["e"]])
+    [['a', 'b', 'c', 'd', 'e']]
+    """
+    kept = [group for group in groups if len(group) >= min_size]
+    pooled = [seqid for group in groups if len(group) < min_size for seqid in group]
+    if len(pooled) >= min_size or not kept:
+        kept.append(pooled)
+    elif pooled:
+        min(kept, key=len).extend(pooled)
+    return [group for group in kept if group]
+
+
+def merge_trees(trees, root=None, dist=0.0):
+    """Root the neighbourhood trees and join them at a common root.
+
+    Args:
+        trees (list): unrooted ete3 trees, one per neighbourhood.
+        root (str): the outgroup tip, present in every tree, or None to
+            midpoint root each tree.
+        dist (float): branch length from the common root to each
+            neighbourhood.
+
+    Returns:
+        ete3.Tree: the merged tree.
+
+    >>> from ete3 import Tree
+    >>> trees = [Tree("(a:1,b:1,(c:1,o:5):1);"), Tree("(d:1,o:5,e:1);")]
+    >>> merged = merge_trees(trees, "o")
+    >>> sorted(merged.get_leaf_names()), len(merged.children)
+    (['a', 'b', 'c', 'd', 'e', 'o'], 3)
+    """
+    from ete3 import Tree
+
+    merged = Tree()
+    outgroup = None
+    for tree in trees:
+        if root is None:
+            if len(tree) > 2:
+                tree.set_outgroup(tree.get_midpoint_outgroup())
+            node = tree
+        else:
+            outgroup = tree & root
+            tree.set_outgroup(outgroup)
+            node = next(child for child in tree.children if child is not outgroup)
+            node.detach()
+        node.dist = dist
+        merged.add_child(node)
+    if outgroup is not None:
+        merged.add_child(outgroup.detach())
+    return merged
+
+
+def write_partitions(groups, fname):
+    """Write the neighbourhood of each sequence.
+
+    Args:
+        groups (list): lists of sequence ids, from neighbourhoods().
+        fname (str): output path.
+    """
+    with open(fname, "w") as out_h:
+        out_h.write("SequenceName\tNeighbourhood\n")
+        for number, group in enumerate(groups, start=1):
+            for seqid in group:
+                out_h.write(f"{seqid}\t{number}\n")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Light-weight path and name helpers.
+
+These are kept free of heavy imports (Biopython, ruffus, ete3) so that the
+command line can validate a config quickly.
+"""
+
+import re
+from pathlib import Path
+from .. import __parent_dir__
+
+
+def package_path(fname):
+    """
+    Path to a data file packaged with havic
+    :param fname: path relative to the havic package
+    :return: the installed filepath
+    """
+    from importlib.resources import files
+    return str(files(__parent_dir__).joinpath(fname))
+
+
+def make_path(parentdir, filename):
+    """
+    Make a filepath
+    :param parentdir: a parent directory
+    :param filename: a file in the parent dir
+    :return: joined filepath
+    """
+    return Path(parentdir).joinpath(filename).as_posix()
+
+
+def absolute_path(fname_in, default_path):
+    """Get absolute paths for filename.
+
+    Args:
+        fname (string): filename
+        test_status(boolean): This file is a pre-packaged havic datafile.
+
+    Returns:
+        valid absolute file path if it is a file, else None
+    """
+    fname_out = None
+    if default_path:
+        fname_in = package_path(fname_in)
+    else:
+        pass
+    if Path(fname_in).is_file():
+        fname_out = Path(fname_in).resolve(strict=True)
+    else:
+        print(f"\nWarning, '{fname_in}' is not a valid file path.\n")
+    return fname_out
+
+
+def correct_characters(input_string):
+    """Remove non alphanumeric characters from string.
+
+    Args:
+        input_string (string)
+
+    Returns:
+        string: output string with non alpha-numeric characters removed.
+    """
+    output_string = re.sub(
+        "[^A-Za-z0-9]+",
+        "_",
+        input_string.replace("_(reversed)", "")
+        .replace("(", "")
+        .replace(")", "")
+        .replace(":", "_")
+        .rstrip(),
+    )
+    return output_string
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
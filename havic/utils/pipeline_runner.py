@@ -6,76 +6,78 @@ Run the pipeline.
 Go
 """
 
-from .. import __parent_dir__  # , __nextflow_nf__
-from pkg_resources import resource_filename as rf
-import re
 import sys
 import os
 from pathlib import Path
-import shutil
-from subprocess import Popen, PIPE
 import shlex
 from Bio import SeqIO
-from ruffus import (
-    mkdir,
-    follows,
-    files,
-    pipeline_run,
-    pipeline_printout_graph as pipeprintgraph,
-)
+from .paths import make_path, absolute_path, correct_characters  # re-exported
 
+# Output files written by IQ-TREE, as suffixes of the alignment file name.
+IQTREE_SUFFIXES = [
+    ".bionj",
+    ".ckp.gz",
+    ".contree",
+    ".iqtree",
+    ".log",
+    ".mldist",
+    ".model.gz",
+    ".splits.nex",
+    ".treefile",
+    ".ufboot",
+    ".uniqueseq.phy",
+]
+# Outputs kept by clear_outputs, as suffixes of the RUN_PREFIX.  They are
+# checked against the current run when they are read.
+PERSISTENT_OUTPUTS = [
+    "map.stack.trimmed.fa_SNPstore.npz",
+    "run_state.json",
+    "run_state.stack.fa",
+    "run_state.treefile",
+]
 
-def make_path(parentdir, filename):
-    """
-    Make a filepath
-    :param parentdir: a parent directory
-    :param filename: a file in the parent dir
-    :return: joined filepath
-    """
-    return Path(parentdir).joinpath(filename).as_posix()
 
+def clear_outputs(outdir, run_prefix):
+    """Delete the outputs of previous runs (FORCE_OVERWRITE_AND_RE_RUN).
 
-def absolute_path(fname_in, default_path):
-    """Get absolute paths for filename.
+    The SNP distance store and incremental run state (PERSISTENT_OUTPUTS)
+    are kept, so that later runs only process new sequences.
 
     Args:
-        fname (string): filename
-        test_status(boolean): This file is a pre-packaged havic datafile.
-
-    Returns:
-        valid absolute file path if it is a file, else None
+        outdir (str): the output directory.
+        run_prefix (str): the RUN_PREFIX of the output files.
     """
-    fname_out = None
-    if default_path:
-        fname_in = rf(__parent_dir__, fname_in)
-    else:
-        pass
-    if Path(fname_in).is_file():
-        fname_out = Path(fname_in).resolve(strict=True)
-    else:
-        print(f"\nWarning, '{fname_in}' is not a valid file path.\n")
-    return fname_out
+    import shutil
+
+    keep = {f"{run_prefix}{suffix}" for suffix in PERSISTENT_OUTPUTS}
+    for fname in Path(outdir).glob(f"{run_prefix}*"):
+        if fname.name in keep:
+            continue
+        if fname.is_dir():  # the neighbourhood trees
+            shutil.rmtree(fname)
+        else:
+            Path.unlink(fname)
 
 
-def correct_characters(input_string):
-    """Remove non alphanumeric characters from string.
+def shard_fasta(fasta, chunk_size):
+    """Split a fasta file into shards of chunk_size sequences.
+
+    The shards are written next to the fasta file, as '<stem>.shard<n>.fa'.
 
     Args:
-        input_string (string)
+        fasta (str): path to the fasta file.
+        chunk_size (int): number of sequences per shard.
 
     Returns:
-        string: output string with non alpha-numeric characters removed.
+        list: paths to the shards, in input order.
     """
-    output_string = re.sub(
-        "[^A-Za-z0-9]+",
-        "_",
-        input_string.replace("_(reversed)", "")
-        .replace("(", "")
-        .replace(")", "")
-        .replace(":", "_")
-        .rstrip(),
-    )
-    return output_string
+    shards, records = [], SeqIO.parse(fasta, "fasta")
+    while True:
+        chunk = [record for _, record in zip(range(chunk_size), records)]
+        if not chunk:
+            return shards
+        shards.append(str(Path(fasta).with_suffix(f".shard{len(shards)}.fa")))
+        SeqIO.write(chunk, shards[-1], "fasta")
 
 
 class Pipeline:
@@ -110,25 +112,35 @@ class Pipeline:
         self.header = self.refseq.id
         self.outdir = yaml_in["OUTDIR"]
         repstr = yaml_in["RUN_PREFIX"]
+        divergence = float(yaml_in["CLUSTER_PICKER_SETTINGS"]["distance_fraction"]) * 100
         self.outfiles = {
+            "log": make_path(self.outdir, f"{repstr}havic.log"),
             "tmp_fasta": make_path(self.outdir, f"{repstr}tmpfasta.fa"),
+            "tmp_fasta_new": make_path(self.outdir, f"{repstr}tmpfasta.new.fa"),
             "seq_header_replacements": make_path(
                 self.outdir, f"{repstr}seq_id_replace.tsv"
             ),
             "duplicates": make_path(self.outdir, f"{repstr}duplicate_seqs.txt"),
+            "identical_seqs": make_path(self.outdir, f"{repstr}identical_seqs.tsv"),
             "tmp_bam": make_path(self.outdir, f"{repstr}map.bam"),
             "tmp_bam_idx": make_path(self.outdir, f"{repstr}map.bam.bai"),
-            "bam2fasta": make_path(self.outdir, f"{repstr}map.bam2fasta.R"),
-            "bam2fasta_Rout": make_path(
-                self.outdir, f"{repstr}map.bam2fasta.Rout"
-            ),
             "fasta_from_bam": make_path(self.outdir, f"{repstr}map.stack.fa"),
             "fasta_from_bam_trimmed": make_path(
                 self.outdir, f"{repstr}map.stack.trimmed.fa"
             ),
+            "haplotypes": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.haplotypes.fa"
+            ),
+            "haplotype_map": make_path(
+                self.outdir, f"{repstr}haplotype_members.tsv"
+            ),
             "treefile": make_path(
                 self.outdir, f"{repstr}map.stack.trimmed.fa.treefile"
             ),
+            "start_tree": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.fa.nj.nwk"
+            ),
+            "partitions": make_path(self.outdir, f"{repstr}partitions.tsv"),
             "rooted_treefile": make_path(
                 self.outdir, f"{repstr}map.stack.trimmed.fa.rooted.treefile"
             ),
@@ -136,97 +148,420 @@ class Pipeline:
                 self.outdir,
                 f"{repstr}map.stack.trimmed.fa.rooted_clusterPicks.nwk.figTree",
             ),
+            "clusterpicked_nwk": make_path(
+                self.outdir,
+                f"{repstr}map.stack.trimmed.fa.rooted_clusterPicks.nwk",
+            ),
+            "cluster_list": make_path(
+                self.outdir,
+                f"{repstr}map.stack.trimmed.fa.rooted_clusterPicks_list.txt",
+            ),
             "cluster_assignments": make_path(
                 self.outdir,
                 f"{repstr}map.stack.trimmed.fa.rooted_clusterPicks_log.txt",
             ),
+            "snp_dists": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.fa_SNPdists.csv"
+            ),
+            "snp_counts_over_align_length": make_path(
+                self.outdir,
+                f"{repstr}map.stack.trimmed.fa_SNPcountsOverAlignLength.csv",
+            ),
+            "snp_npz": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.fa_SNPdists.npz"
+            ),
+            "snp_store": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.fa_SNPstore.npz"
+            ),
             "treeplotr": make_path(
                 self.outdir, f"{repstr}map.stack.trimmed.fa.Rplot.R"
             ),
             "treeplotr_out": make_path(
                 self.outdir, f"{repstr}map.stack.trimmed.fa.Rplot.Rout"
             ),
+            "tree_msa_pdf": make_path(
+                self.outdir,
+                f"{repstr}map.stack.trimmed.fa.rooted.treefile_"
+                f"{divergence:g}percent_divergence_"
+                f"{yaml_in['CLUSTER_PICKER_SETTINGS']['distance_method']}_msa.pdf",
+            ),
+            "snp_heatmap_pdf": make_path(
+                self.outdir, f"{repstr}map.stack.trimmed.fa_SNPdists.pdf"
+            ),
         }
 
-        self.map_cmd = (
-            f"{yaml_in['MAPPER_SETTINGS']['executable']} {yaml_in['MAPPER_SETTINGS']['other']} {yaml_in['MAPPER_SETTINGS']['k_mer']} "
-            f"-a {self.subject} "
-            f"{self.outfiles['tmp_fasta']} "
-            f"| samtools view -h -F 256 -F 2048 | samtools sort > {self.outfiles['tmp_bam']}"
-        )
-        self.clusterpick_cmd = (
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['executable']} "
-            f"{self.outfiles['fasta_from_bam_trimmed']} "
-            f"{self.outfiles['rooted_treefile']} "
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['coarse_subtree_support']} "
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['fine_cluster_support']} "
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['distance_fraction']} "
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['large_cluster_threshold']} "
-            f"{yaml_in['CLUSTER_PICKER_SETTINGS']['distance_method']}"
-        )
-        self.iqtree_cmd = str(
-            f"{yaml_in['IQTREE2_SETTINGS']['executable']} "
-            f"-s {self.outfiles['fasta_from_bam_trimmed']} "
-            f"{yaml_in['IQTREE2_SETTINGS']['other']}"
-        )
-        self.target_region = SeqIO.read(
-            open(absolute_path(yaml_in["SUBJECT_TARGET_REGION"], yaml_in["DEFAULT_SUBJECT"]), "r"), "fasta"
-        )
+        # minimap2 (external, via bam) or mappy (in-process) mapping
+        self.in_process_mapping = str(
+            yaml_in["MAPPER_SETTINGS"].get("engine", "minimap2")).lower() == "mappy"
+        self.mapped_output = self.outfiles[
+            "fasta_from_bam" if self.in_process_mapping else "tmp_bam"]
+        # Identical sequences may be collapsed to haplotypes for the tree
+        self.collapse = bool(yaml_in.get("COLLAPSE_HAPLOTYPES"))
+        # R (ggtree, via R CMD BATCH) or matplotlib (in-process) plots
+        self.plots_engine = str(yaml_in.get("PLOTS_ENGINE", "R")).lower()
+        self.plot_outputs = [self.outfiles["treeplotr"], self.outfiles["treeplotr_out"]]
+        if self.plots_engine == "matplotlib":
+            self.plot_outputs = [
+                self.outfiles["tree_msa_pdf"], self.outfiles["snp_heatmap_pdf"]
+            ] if yaml_in["PLOTS"] else []
+        # the SNP matrix, kept for the plots if computed in this run
+        self.snp_matrix = None
+        # dense csv matrices, or a compressed numpy archive for large runs
+        self.snp_format = str(
+            (yaml_in.get("SNP_DISTS_SETTINGS") or {}).get("format", "csv")).lower()
+        self.snp_outputs = {"snp_npz": self.outfiles["snp_npz"]} \
+            if self.snp_format == "npz" else \
+            {"snp_dists": self.outfiles["snp_dists"],
+             "snp_counts": self.outfiles["snp_counts_over_align_length"]}
+        if self.snp_format == "npz" and yaml_in["PLOTS"] \
+                and self.plots_engine != "matplotlib":
+            sys.exit("The SNP_DISTS_SETTINGS npz format requires PLOTS_ENGINE "
+                     "matplotlib, as the R plots read the csv matrix.")
+        self.tree_alignment = self.outfiles[
+            "haplotypes" if self.collapse else "fasta_from_bam_trimmed"]
+        # Trees may be inferred per neighbourhood of similar sequences
+        self.partition_settings = yaml_in.get("PARTITION_SETTINGS")
+        self.partition_dir = make_path(self.outdir, f"{repstr}partitions")
+        self.tree_sequences = None
+        # The tree profile (full or fast) and its branch support metric
+        from ..utils.tree_profiles import ModelCache, support_metric, support_threshold
+        iqtree_settings = yaml_in["IQTREE2_SETTINGS"]
+        self.tree_profile = str(iqtree_settings.get("profile", "full")).lower()
+        self.support = support_metric(iqtree_settings)
+        self.model_cache = ModelCache(
+            iqtree_settings.get("model_cache", "~/.cache/havic/models.json")) \
+            if self.tree_profile == "fast" or iqtree_settings.get("reuse_model") else None
+        # the cached model used by this run, and the alignment fingerprint
+        self.reused_model = None
+        self.fingerprint = None
+        # fine_cluster_support is given for UFBoot, and scaled to the metric
+        self.fine_cluster_support = support_threshold(
+            yaml_in["CLUSTER_PICKER_SETTINGS"]["fine_cluster_support"], self.support)
+        if self.support != "ufboot":
+            print(f"fine_cluster_support of "
+                  f"{yaml_in['CLUSTER_PICKER_SETTINGS']['fine_cluster_support']} "
+                  f"(UFBoot) is {self.fine_cluster_support:g} for {self.support} "
+                  f"support.")
+        self.clusterpick_cmd = shlex.split(
+            str(yaml_in['CLUSTER_PICKER_SETTINGS']['executable'])) + [
+            self.tree_alignment,
+            self.outfiles['rooted_treefile'],
+            str(yaml_in['CLUSTER_PICKER_SETTINGS']['coarse_subtree_support']),
+            f"{self.fine_cluster_support:g}",
+            str(yaml_in['CLUSTER_PICKER_SETTINGS']['distance_fraction']),
+            str(yaml_in['CLUSTER_PICKER_SETTINGS']['large_cluster_threshold']),
+            str(yaml_in['CLUSTER_PICKER_SETTINGS']['distance_method']),
+        ]
+        self.target_region_file = absolute_path(
+            yaml_in["SUBJECT_TARGET_REGION"], yaml_in["DEFAULT_SUBJECT"])
+        self.target_region = SeqIO.read(open(self.target_region_file, "r"), "fasta")
         self.target_region.id = correct_characters(self.target_region.id)
         self.target_region.seq = self.target_region.seq.ungap("-")
         self.root = correct_characters(self.yaml_in["TREE_ROOT"])
-        self.replacedheaders = None
+        from ..utils.executor import Executor
+        # the usage of each tool is added to the stage that ran it
+        self.executor = Executor(self.outfiles["log"],
+                                 on_exit=lambda usage: self.report.child_exited(usage))
+        # Seconds before an external tool is killed, keyed on stage name
+        self.timeouts = yaml_in.get("STAGE_TIMEOUTS") or {}
+        from ..utils.instrumentation import RunReport
+        self.report = RunReport(
+            make_path(self.outdir, f"{repstr}run_report.json"),
+            make_path(self.outdir, f"{repstr}run_report.tsv"),
+        )
+        self.cache = None
+        if yaml_in.get("CACHE_SETTINGS"):
+            from ..utils.stage_cache import StageCache
+            self.cache = StageCache(
+                yaml_in["CACHE_SETTINGS"].get("directory", "~/.cache/havic"),
+                yaml_in["CACHE_SETTINGS"].get("max_size_gb", 10),
+            )
+        # the mappy index, kept loaded between updates
+        self.aligner = None
+        self.run_state = None
+        if yaml_in.get("INCREMENTAL"):
+            import hashlib
+            from ..utils.incremental import RunState
+            reference = hashlib.sha1(
+                f"{self.refseq.seq}\t{yaml_in['MAPPER_SETTINGS']['k_mer']}".encode()
+            ).hexdigest()
+            self.run_state = RunState(self.outdir, repstr, reference)
+        from ..utils.checkpoint import Checkpoint
+        self.checkpoint = Checkpoint(make_path(self.outdir, f"{repstr}checkpoint.json"))
+
+    def _partitioned(self):
+        """Trees are inferred per neighbourhood (PARTITION_SETTINGS).
+
+        Returns:
+            bool: True if PARTITION_SETTINGS is set, the run is not
+                incremental, and the tree alignment holds at least
+                min_sequences sequences.
+        """
+        if not self.partition_settings or self.run_state is not None:
+            return False
+        if self.tree_sequences is None:
+            with open(self.tree_alignment, "r") as fasta_h:
+                self.tree_sequences = sum(line.startswith(">") for line in fasta_h)
+        return self.tree_sequences >= int(
+            self.partition_settings.get("min_sequences", 5000))
+
+    def _tree_settings(self):
+        """The settings of the tree inference stage."""
+        if not self.partition_settings:
+            return self.yaml_in["IQTREE2_SETTINGS"]
+        return {key: self.yaml_in.get(key) for key in
+                ["IQTREE2_SETTINGS", "PARTITION_SETTINGS", "CLUSTER_PICKER_SETTINGS"]}
+
+    def _incremental(self):
+        """The run only maps new samples onto a stored previous run.
+
+        Returns:
+            bool: True if INCREMENTAL is set and a previous run was stored.
+        """
+        return self.run_state is not None and self.run_state.exists()
+
+    def _cached(self, stage, inputs, settings, outputs, func):
+        """Run a stage, or restore its outputs from the cache.
+
+        Args:
+            stage (str): stage name.
+            inputs (list): paths to the files read by the stage.
+            settings (dict): yaml settings used by the stage.
+            outputs (dict): output file paths keyed on role.
+            func (callable): runs the stage.
+        """
+        if self.cache is None:
+            func()
+            return
+        key = self.cache.key(stage, inputs, settings)
+        if self.cache.fetch(key, outputs):
+            print(f"{stage}: reusing cached results ({key[:12]}).")
+            self.report.record(cache_hit=True)
+        else:
+            func()
+            self.cache.store(key, outputs)
+
+    def _checkpointed(self, stage, inputs, outputs, settings, func):
+        """Run a stage, unless a previous run completed it with the same
+        inputs and settings and its outputs are intact.
+
+        Args:
+            stage (str): stage name.
+            inputs (list): paths to the files read by the stage.
+            outputs (list): paths to the files written by the stage.
+            settings (dict): yaml settings used by the stage.
+            func (callable): runs the stage.
+        """
+        if self.checkpoint.done(stage, inputs, outputs, settings):
+            print(f"{stage}: completed in a previous run, skipping.")
+            self.report.record(checkpoint_hit=True)
+            return
+        func()
+        self.checkpoint.record(stage, inputs, outputs, settings)
+
+    def _map_cmd(self, query_fasta, bam=None, workers=1):
+        """Build the minimap2 | samtools mapping pipeline.
+
+        Args:
+            query_fasta (str): path to the fasta file to map.
+            bam (str): path to the sorted bam file, default tmp_bam.
+            workers (int): number of pipelines run at once; a minimap2 -t
+                option in MAPPER_SETTINGS other is divided between them.
+
+        Returns:
+            list: argument lists of the piped commands.
+        """
+        from .batch import MAPPER_THREAD_OPTS
+
+        settings = self.yaml_in['MAPPER_SETTINGS']
+        other = str(settings['other'])
+        if workers > 1:
+            other = MAPPER_THREAD_OPTS.sub(
+                lambda match: f"-t {max(1, int(match.group().split()[1]) // workers)}",
+                other)
+        return [
+            shlex.split(str(settings['executable']))
+            + shlex.split(other)
+            + shlex.split(str(settings['k_mer']))
+            + ["-a", str(self.subject), query_fasta],
+            ["samtools", "view", "-h", "-F", "256", "-F", "2048"],
+            ["samtools", "sort", "-o", bam or self.outfiles['tmp_bam']],
+        ]
+
+    def _map_shards(self, query_fasta, chunk_size, workers):
+        """Map the queries in shards on a worker pool and merge the bam files.
+
+        Args:
+            query_fasta (str): path to the fasta file to map.
+            chunk_size (int): number of sequences per shard.
+            workers (int): number of shards mapped at once.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        shards = shard_fasta(query_fasta, chunk_size)
+        bams = [str(Path(self.outfiles["tmp_bam"]).with_suffix(f".shard{idx}.bam"))
+                for idx in range(len(shards))]
+        print(f"Mapping {len(shards)} shards of up to {chunk_size} sequences "
+              f"with {workers} workers.")
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for future in [pool.submit(
+                        self.report.bind(self.executor.run),
+                        *self._map_cmd(shard, bam, workers),
+                        timeout=self.timeouts.get("map_input_fasta_to_ref"))
+                        for shard, bam in zip(shards, bams)]:
+                    future.result()
+            self.executor.run(
+                ["samtools", "merge", "-f", self.outfiles["tmp_bam"]] + bams)
+        finally:
+            for fname in shards + bams:
+                Path(fname).unlink(missing_ok=True)
+
+    def _parse_query(self, query_file):
+        """Stream the records of a query fasta file or sequence store.
+
+        Args:
+            query_file (Path): path to a fasta file or '.hvs' store.
+
+        Yields:
+            SeqRecord: the query records; from a store, only those listed in
+                QUERY_STORE_IDS if it is set.
+        """
+        from ..utils.seq_store import is_store, SeqStore
+        if not is_store(query_file):
+            yield from SeqIO.parse(query_file, "fasta")
+            return
+        seqids = None
+        if self.yaml_in.get("QUERY_STORE_IDS"):
+            with open(self.yaml_in["QUERY_STORE_IDS"], "r") as ids_h:
+                seqids = [line.strip() for line in ids_h if line.strip()]
+        store = SeqStore(query_file)
+        try:
+            print(f"Reading {len(store) if seqids is None else len(seqids)} "
+                  f"sequences from {query_file}")
+            yield from store.records(seqids)
+        finally:
+            store.close()
+
+    def _query_records(self, header_h, duplicates_h, identical_h=None):
+        """Stream quality-controlled query records.
+
+        Args:
+            header_h (file): handle for the header replacement table, which
+                lists each input id once.
+            duplicates_h (file): handle for the duplicate id report.
+            identical_h (file): handle for the identical sequence report, or
+                None to skip the check.
+
+        Yields:
+            SeqRecord: the target region, then each query with a corrected,
+                previously unseen id and gaps removed.
+        """
+        import hashlib
 
-    def _compile_input_fasta(self):
-        # 1 Compile the fasta files to single file
-        quality_controlled_seqs = []
         # 1.01 Append the reference amplicon
-        quality_controlled_seqs.append(self.target_region)
-        keyval_ids = {}
-        dups = []
+        seen_ids = {self.target_region.id}
+        seen_headers = set()
+        seen_seqs = {}
+        yield self.target_region
         for query_file in self.query_files:
-            for record in SeqIO.parse(query_file, "fasta"):
+            for record in self._parse_query(query_file):
                 input_id = record.id
                 record.id = correct_characters(record.id)
-                # if str(record.id) != str(input_id):
-                keyval_ids[str(input_id)] = str(record.id)
+                if input_id not in seen_headers:
+                    seen_headers.add(input_id)
+                    header_h.write(f"{input_id}\t{record.id}\n")
                 # 1.02 Remove duplicates.
-                if record.id not in [record.id for record in quality_controlled_seqs]:
-                    record.seq = record.seq.ungap("-")
-                    quality_controlled_seqs.append(record)
-                else:
-                    dups.append(str(record.id))
-        if keyval_ids: #this will print all the seqids, even if not corrected
-            self.replacedheaders = keyval_ids
-            with open(self.outfiles["seq_header_replacements"], "w") as out_h:
-                out_h.write("INPUT_SEQ_HEADER\tOUTPUT_SEQ_HEADER\n")
-                for key, val in keyval_ids.items():
-                    out_h.write(key + "\t" + val + "\n")
-        else:
-            print("Zero seq headers were modified.")
-        if dups:
-            with open(self.outfiles["duplicates"], "w") as out_h:
-                out_h.write("\n".join(dups))
-        else:
+                if record.id in seen_ids:
+                    duplicates_h.write(f"{record.id}\n")
+                    continue
+                seen_ids.add(record.id)
+                record.seq = record.seq.ungap("-")
+                if identical_h is not None:
+                    digest = record.annotations.get("sha1") or hashlib.sha1(
+                        str(record.seq).upper().encode()).hexdigest()
+                    if digest in seen_seqs:
+                        identical_h.write(f"{record.id}\t{seen_seqs[digest]}\n")
+                    else:
+                        seen_seqs[digest] = record.id
+                yield record
+
+    def _compile_input_fasta(self):
+        """Compile the query fasta files to a single file.
+
+        Records are streamed from QUERY_FILES to tmp_fasta, and the header
+        replacement table and duplicate report are written as they go.
+        """
+        from ..utils.checkpoint import atomic_path
+
+        # 1 Compile the fasta files to single file
+        report_identical = self.yaml_in.get("REPORT_IDENTICAL_SEQS")
+        root_found = self.root == "midpoint"
+        n_seqs = 0
+        with atomic_path(self.outfiles["tmp_fasta"]) as tmp_fasta, \
+                open(tmp_fasta, "w") as fasta_h, \
+                open(self.outfiles["seq_header_replacements"], "w") as header_h, \
+                open(self.outfiles["duplicates"], "w") as duplicates_h, \
+                open(self.outfiles["identical_seqs"] if report_identical
+                     else os.devnull, "w") as identical_h:
+            header_h.write("INPUT_SEQ_HEADER\tOUTPUT_SEQ_HEADER\n")
+            identical_h.write("SEQ_HEADER\tIDENTICAL_TO\n")
+            for record in self._query_records(
+                    header_h, duplicates_h, identical_h if report_identical else None):
+                root_found = root_found or record.id == self.root
+                fasta_h.write(record.format("fasta"))
+                n_seqs += 1
+        self.report.record(sequences=n_seqs)
+        if Path(self.outfiles["duplicates"]).stat().st_size == 0:
+            Path(self.outfiles["duplicates"]).unlink()
             print("Zero duplicate sequences were found.")
-        if self.root != 'midpoint' and self.root not in [record.id for record in quality_controlled_seqs]:
-            lbreak = "\n"
-            sys.exit(f"Incorrect specification of tree root (Hint: must be either 'midpoint' or sample from input fasta, but was {self.root}.  Choices are:{lbreak}{lbreak.join([record.id for record in quality_controlled_seqs])}")
-        else:
-            SeqIO.write(quality_controlled_seqs, self.outfiles["tmp_fasta"], "fasta")
+        if not root_found:
+            Path(self.outfiles["tmp_fasta"]).unlink()
+            sys.exit(f"Incorrect specification of tree root (Hint: must be either "
+                     f"'midpoint' or sample from input fasta, but was {self.root}.  "
+                     f"Choices are listed in {self.outfiles['seq_header_replacements']}")
 
     def _map_input_fasta_to_ref(self):
-        cmd = self.map_cmd
-        print(cmd)
-        os.system(cmd)
-        cmd = f"samtools index {self.outfiles['tmp_bam']}"
-        os.system(cmd)
+        query_fasta = self.outfiles["tmp_fasta"]
+        if self._incremental():
+            new, kept = self.run_state.split_new(
+                SeqIO.parse(self.outfiles["tmp_fasta"], "fasta"))
+            print(f"Incremental run: mapping {len(new)} new or changed "
+                  f"sequences, reusing {len(kept)} stacked sequences.")
+            SeqIO.write(new, self.outfiles["tmp_fasta_new"], "fasta")
+            query_fasta = self.outfiles["tmp_fasta_new"]
+        settings = self.yaml_in["MAPPER_SETTINGS"]
+        chunk_size = int(settings.get("chunk_size") or 0)
+        workers = settings.get("workers", 1)
+        if str(workers).upper() == "AUTO":  # one per thread of the -t option
+            from .batch import MAPPER_THREAD_OPTS, configured_threads
+            workers = configured_threads(settings["other"], MAPPER_THREAD_OPTS)
+        workers = int(workers)
+
+        def map_and_index():
+            with self.report.stage("minimap2_mapping"):
+                if chunk_size and workers > 1:
+                    self._map_shards(query_fasta, chunk_size, workers)
+                else:
+                    self.executor.run(*self._map_cmd(query_fasta),
+                                      timeout=self.timeouts.get("map_input_fasta_to_ref"))
+            with self.report.stage("samtools_index"):
+                self.executor.run(["samtools", "index", self.outfiles['tmp_bam']])
+
+        # chunk_size and workers do not change the result
+        self._cached(
+            "map_input_fasta_to_ref",
+            [query_fasta, self.subject],
+            {key: value for key, value in settings.items()
+             if key not in ("chunk_size", "workers")},
+            {"bam": self.outfiles["tmp_bam"], "bai": self.outfiles["tmp_bam_idx"]},
+            map_and_index,
+        )
         # Find and print the unmapped sequences.
-        cmd = f"samtools view -f 4 {self.outfiles['tmp_bam']}"
-        cmd2 = "cut -f 1"
-        proc = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE)
-        proc2 = Popen(shlex.split(cmd2), stdin=proc.stdout, stdout=PIPE, stderr=PIPE)
-        result = proc2.communicate()[0].decode("UTF-8").split("\n")
+        result = [line.split("\t", 1)[0] for line in self.executor.run(
+            ["samtools", "view", "-f", "4", self.outfiles['tmp_bam']],
+            capture=True).split("\n")]
+        self.report.record(unmapped=len(list(filter(None, result))))
         if result:
             print(
                 f"\nUnmapped reads at k-mer "
@@ -236,25 +571,96 @@ class Pipeline:
         else:
             pass
 
+    def _map_in_process(self):
+        """Map the queries with mappy and stack them on the reference.
+
+        The stacked MSA is written to fasta_from_bam for the next stage, and
+        the bam file only if MAPPER_SETTINGS write_bam is set.
+        """
+        from ..mapping.mappy_mapper import (kmer_size, load_aligner,
+                                            map_records, stack_mapped,
+                                            write_bam)
+
+        settings = self.yaml_in["MAPPER_SETTINGS"]
+        threads = settings.get("threads", "AUTO")
+        threads = os.cpu_count() if str(threads).upper() == "AUTO" else int(threads)
+        records = list(SeqIO.parse(self.outfiles["tmp_fasta"], "fasta"))
+        query_fasta, queries = self.outfiles["tmp_fasta"], records
+        if self._incremental():
+            queries, kept = self.run_state.split_new(records)
+            print(f"Incremental run: mapping {len(queries)} new or changed "
+                  f"sequences, reusing {len(kept)} stacked sequences.")
+            SeqIO.write(queries, self.outfiles["tmp_fasta_new"], "fasta")
+            query_fasta = self.outfiles["tmp_fasta_new"]
+        outputs = {"stack": self.outfiles["fasta_from_bam"]}
+        if settings.get("write_bam"):
+            outputs.update({"bam": self.outfiles["tmp_bam"],
+                            "bai": self.outfiles["tmp_bam_idx"]})
+
+        def map_and_stack():
+            with self.report.stage("mappy_mapping"):
+                if self.aligner is None:
+                    self.aligner = load_aligner(
+                        self.subject, kmer_size(settings["k_mer"]),
+                        settings.get("index_dir", "~/.cache/havic-mmi"), threads)
+                mapped = map_records(self.aligner, queries, threads)
+            with self.report.stage("bam_stacking"):
+                with open(self.outfiles["fasta_from_bam"], "w") as out_h:
+                    for name, seq in stack_mapped(mapped, 0, self.reflen):
+                        out_h.write(f">{name}\n{seq}\n")
+            if "bam" in outputs:
+                write_bam(mapped, self.header, self.reflen, self.outfiles["tmp_bam"])
+
+        self._cached("map_input_fasta_to_ref", [query_fasta, self.subject],
+                     settings, outputs, map_and_stack)
+        alignment = self._stack_alignment(
+            (seq.id, str(seq.seq)) for seq in
+            SeqIO.parse(self.outfiles["fasta_from_bam"], "fasta"))
+        SeqIO.write(alignment, self.outfiles["fasta_from_bam"], "fasta")
+        self.report.record(sequences=len(alignment))
+        stacked = {seq.id for seq in alignment}
+        unmapped = [record.id for record in queries if record.id not in stacked]
+        self.report.record(unmapped=len(unmapped))
+        if unmapped:
+            print(f"\nUnmapped reads at k-mer {settings['k_mer']}:")
+            print("\n".join(unmapped))
+
     def _bam2fasta(self):
         """
         Convert the bam file to fasta by stacking strings on ref to get MSA.
-        :return: MSA fasta from input bam file
-        """
-        with open(self.outfiles["bam2fasta"], "w") as out_r:
-            from ..mapping.bam2fasta import bam2fasta
-
-            cmd = bam2fasta % (
-                self.outfiles["tmp_bam"],
-                self.outfiles["tmp_bam_idx"],
-                self.header,
-                1,
-                self.reflen,
-                self.outfiles["fasta_from_bam"],
-            )
-            out_r.write(cmd)
-        # print(cmd)
-        os.system(f"R CMD BATCH {self.outfiles['bam2fasta']} {self.outfiles['bam2fasta_Rout']}")
+        :return: MSA from input bam file
+        """
+        from ..mapping.bam2fasta import stack_strings_from_bam
+
+        alignment = self._stack_alignment(stack_strings_from_bam(
+            self.outfiles["tmp_bam"], self.header, 0, self.reflen))
+        if self.yaml_in.get("WRITE_STACKED_FASTA"):
+            SeqIO.write(alignment, self.outfiles["fasta_from_bam"], "fasta")
+        return alignment
+
+    def _stack_alignment(self, stacked):
+        """Make the MSA of the stacked queries, adding those kept from the
+        previous run in incremental mode.
+
+        Args:
+            stacked (iterable): (id, projected sequence) tuples.
+
+        Returns:
+            MSA: The Biopython Multiple Sequence Alignment object
+        """
+        from Bio.Align import MultipleSeqAlignment
+        from Bio.SeqRecord import SeqRecord
+        from Bio.Seq import Seq
+
+        alignment = MultipleSeqAlignment(
+            SeqRecord(Seq(seq), id=name, description="") for name, seq in stacked)
+        if self.run_state is not None:
+            records = list(SeqIO.parse(self.outfiles["tmp_fasta"], "fasta"))
+            if self.run_state.exists():
+                _, kept = self.run_state.split_new(records)
+                alignment.extend(self.run_state.stacked_records(kept))
+            self.run_state.save(records, alignment)
+        return alignment
 
     def _get_clean_fasta_alignment(self):
         """Give the alignment a haircut.
@@ -264,9 +670,16 @@ class Pipeline:
         """
         from Bio import AlignIO
 
-        alignment = AlignIO.read(
-            open(self.outfiles["fasta_from_bam"], "r"), "fasta")
+        if self.in_process_mapping:  # stacked while mapping
+            from Bio.Align import MultipleSeqAlignment
+            alignment = MultipleSeqAlignment(
+                SeqIO.parse(self.outfiles["fasta_from_bam"], "fasta"))
+        else:
+            with self.report.stage("bam_stacking"):
+                alignment = self._bam2fasta()
+                self.report.record(sequences=len(alignment))
         from ..utils.trim_alignment import Trimmed_alignment
+        from ..utils.checkpoint import atomic_path
         aln_trim = Trimmed_alignment(
             alignment, self.target_region.id, "-", self.trim_seqs
         )
@@ -276,42 +689,558 @@ class Pipeline:
             for nf in notfound:
                 print(f"Unable to find and trim {self.trim_requests[nf]}")
 
-        if len(aln_trim.alignment) < 3:
+        if len(aln_trim) < 3:
             sys.exit('Not enough sequences to perform analysis.  Exiting now.\n')
-        aln_trim.get_refseq_boundary()
-        aln_trim.trim_seqs_to_ref()
-        aln_trim.depad_alignment()
-        AlignIO.write(
-            aln_trim.alignment, self.outfiles["fasta_from_bam_trimmed"], "fasta"
+        with self.report.stage("trimming"):
+            aln_trim.get_refseq_boundary()
+            aln_trim.trim_seqs_to_ref()
+            aln_trim.depad_alignment()
+            trimmed = aln_trim.alignment
+            with atomic_path(self.outfiles["fasta_from_bam_trimmed"]) as tmp:
+                AlignIO.write(trimmed, tmp, "fasta")
+        self.report.record(sequences=len(trimmed),
+                           alignment_width=trimmed.get_alignment_length())
+        return trimmed
+
+    def _snp_dists(self):
+        """
+        Write the pairwise SNP distance matrices for the trimmed alignment.
+        :return: None
+        """
+        from Bio import AlignIO
+        from ..utils.snp_dists import (snp_distances, stored_snp_distances,
+                                       write_snp_csvs, write_snp_npz)
+        from ..utils.checkpoint import atomic_path
+
+        settings = self.yaml_in.get("SNP_DISTS_SETTINGS") or {}
+        threads = settings.get("threads", "AUTO")
+        threads = None if str(threads).upper() == "AUTO" else int(threads)
+
+        def snp_dists():
+            alignment = AlignIO.read(
+                open(self.outfiles["fasta_from_bam_trimmed"], "r"), "fasta")
+            if settings.get("store"):
+                ids, snps, sites, computed = stored_snp_distances(
+                    alignment, self.outfiles["snp_store"], self.target_region.id,
+                    block_size=int(settings.get("block_size", 512)), threads=threads)
+                print(f"SNP distances: compared {computed} new or changed sequences, "
+                      f"reusing {len(ids) - computed} from the distance store.")
+                self.report.record(snp_rows_computed=computed)
+            else:
+                ids, snps, sites = snp_distances(
+                    alignment, block_size=int(settings.get("block_size", 512)),
+                    threads=threads)
+            if self.snp_format == "npz":
+                with atomic_path(self.outfiles["snp_npz"]) as npz:
+                    write_snp_npz(ids, snps, sites, npz)
+            else:
+                counts = self.outfiles["snp_counts_over_align_length"]
+                with atomic_path(self.outfiles["snp_dists"]) as dists_csv, \
+                        atomic_path(counts) as counts_csv:
+                    write_snp_csvs(ids, snps, sites, dists_csv, counts_csv)
+            self.snp_matrix = (ids, snps)
+
+        # threads and block_size do not change the result
+        self._cached(
+            "snp_dists",
+            [self.outfiles["fasta_from_bam_trimmed"]],
+            {"format": self.snp_format},
+            self.snp_outputs,
+            snp_dists,
         )
-        return aln_trim.alignment
+
+    def _collapse_haplotypes(self):
+        """
+        Collapse identical trimmed sequences to representative haplotypes.
+        :return: None
+        """
+        from ..utils.haplotypes import collapse_haplotypes, write_haplotype_map
+
+        alignment = SeqIO.parse(self.outfiles["fasta_from_bam_trimmed"], "fasta")
+        representatives, members = collapse_haplotypes(
+            alignment, keep=[self.root, self.target_region.id])
+        SeqIO.write(representatives, self.outfiles["haplotypes"], "fasta")
+        write_haplotype_map(members, self.outfiles["haplotype_map"])
+        self.report.record(sequences=len(representatives))
+        if not members:
+            print("Nothing to collapse: no identical sequences, "
+                  "or fewer than 3 haplotypes.")
+            return
+        print(f"Collapsed {sum(len(ids) for ids in members.values())} identical "
+              f"sequences into {len(members)} haplotypes; "
+              f"{len(representatives)} sequences remain for tree inference.")
+
+    def _expand_haplotypes(self):
+        """
+        Add collapsed sequences back to the trees, cluster list and log.
+        :return: None
+        """
+        from ete3 import Tree
+        from ..utils.haplotypes import (read_haplotype_map, expand_tree,
+                                        expand_cluster_list, expand_cluster_log)
+        from ..utils.cluster_picker import write_figtree
+
+        members = read_haplotype_map(self.outfiles["haplotype_map"])
+        if not members:
+            return
+        tree = expand_tree(Tree(self.outfiles["rooted_treefile"], format=0), members)
+        tree.write(outfile=self.outfiles["rooted_treefile"], dist_formatter="%0.16f")
+        if Path(self.outfiles["clusterpicked_nwk"]).is_file():
+            tree = expand_tree(
+                Tree(self.outfiles["clusterpicked_nwk"], format=1), members)
+            tree.write(outfile=self.outfiles["clusterpicked_nwk"], format=1,
+                       dist_formatter="%0.16f")
+            write_figtree(tree, self.outfiles["clusterpicked_tree"])
+        if Path(self.outfiles["cluster_list"]).is_file():
+            expand_cluster_list(self.outfiles["cluster_list"], members)
+        if Path(self.outfiles["cluster_assignments"]).is_file():
+            expand_cluster_log(self.outfiles["cluster_assignments"], members)
+
+    def _iqtree_options(self):
+        """The IQ-TREE options of the tree profile.
+
+        Returns:
+            str: the IQTREE2_SETTINGS 'other' options, with the support
+                metric and, in the fast profile, the cached model of the
+                target region substituted.
+        """
+        from ..utils.tree_profiles import MODEL_OPTS, tree_options
+
+        settings = self.yaml_in["IQTREE2_SETTINGS"]
+        if self.tree_profile != "fast" and not settings.get("support"):
+            if self.reused_model:
+                return " ".join(MODEL_OPTS.sub("", str(settings["other"])).split()
+                                + ["-m", self.reused_model])
+            return str(settings["other"])
+        return tree_options(settings["other"], self.support,
+                            int(settings.get("support_replicates", 1000)),
+                            self.reused_model)
+
+    def _iqtree_cmd(self):
+        """The IQ-TREE command for the tree alignment."""
+        cmd = shlex.split(str(self.yaml_in["IQTREE2_SETTINGS"]["executable"])) + [
+            "-s", self.tree_alignment] + shlex.split(self._iqtree_options())
+        if self.collapse:
+            cmd += ["--prefix", self.outfiles["fasta_from_bam_trimmed"]]
+        return cmd
+
+    def _load_snp_matrix(self):
+        """The SNP counts of the trimmed alignment.
+
+        Returns:
+            tuple: sequence ids, (n x n) SNP counts, from this run or the
+                snp_dists outputs of a previous one.
+        """
+        from ..utils.snp_dists import read_snp_csv, read_snp_npz
+
+        return self.snp_matrix or (
+            read_snp_npz(self.outfiles["snp_npz"]) if self.snp_format == "npz"
+            else read_snp_csv(self.outfiles["snp_dists"]))
+
+    def _start_tree(self, ids, length, fname):
+        """Write a neighbour-joining tree of the SNP distances, as the start
+        tree of the fast profile.
+
+        Args:
+            ids (list): the tips of the tree.
+            length (int): the alignment length, scaling SNP counts to
+                distances per site.
+            fname (str): path to the output newick file.
+
+        Returns:
+            str: fname, or None if a tip is not in the SNP matrix.
+        """
+        import numpy as np
+        from ..utils.tree_profiles import neighbour_joining
+
+        matrix_ids, snps = self._load_snp_matrix()
+        index = {seqid: number for number, seqid in enumerate(matrix_ids)}
+        missing = [seqid for seqid in ids if seqid not in index]
+        if missing:
+            print(f"Starting IQ-TREE without a start tree, as {missing[0]} is "
+                  f"not in the SNP distance matrix.")
+            return None
+        rows = np.array([index[seqid] for seqid in ids])
+        newick = neighbour_joining(ids, snps[np.ix_(rows, rows)] / max(length, 1))
+        with open(fname, "w") as tree_h:
+            tree_h.write(newick + "\n")
+        return fname
+
+    def _reusable_model(self):
+        """The model cached for the target region, if the tree alignment has
+        not drifted from the alignment it was selected on.
+
+        Returns:
+            str: the model, or None to run ModelFinder.
+        """
+        from ..utils.tree_profiles import (alignment_fingerprint, fingerprint_drift,
+                                           region_key, runs_modelfinder)
+
+        settings = self.yaml_in["IQTREE2_SETTINGS"]
+        if self.model_cache is None or not runs_modelfinder(settings["other"]):
+            return None
+        self.fingerprint = alignment_fingerprint(
+            str(seq.seq) for seq in SeqIO.parse(self.tree_alignment, "fasta"))
+        entry = self.model_cache.get(region_key(self.target_region.seq))
+        if entry is None:
+            return None
+        drift = fingerprint_drift(entry.get("fingerprint"), self.fingerprint)
+        self.report.record(model_drift=None if drift == float("inf") else round(drift, 6))
+        if drift > float(settings.get("model_drift", 0.05)):
+            print(f"Running ModelFinder, as the alignment has drifted from the one "
+                  f"the cached {entry['model']} model was selected on.")
+            return None
+        print(f"Reusing the {entry['model']} model cached for {self.target_region.id}.")
+        return entry["model"]
+
+    def _cache_model(self, report):
+        """Cache the model chosen by ModelFinder for the target region.
+
+        Args:
+            report (str): path to the IQ-TREE '.iqtree' report.
+        """
+        from ..utils.tree_profiles import best_model, model_parameters, region_key
+
+        if self.model_cache is None or self.reused_model:
+            return
+        model = best_model(report)
+        if model:
+            self.model_cache.put(region_key(self.target_region.seq), model,
+                                 model_parameters(report), self.fingerprint)
+            print(f"Cached the {model} model for {self.target_region.id}.")
+
+    def _iqtree_resume(self, cmd, inputs):
+        """Decide how to restart IQ-TREE from its own checkpoint.
+
+        IQ-TREE resumes from '.ckp.gz' if it is run again with the same
+        command; the checkpoint is only trusted if this stage was started
+        with the same inputs and settings.  IQ-TREE refuses to resume a
+        checkpoint that says it finished, so a finished run whose treefile
+        is missing is redone.
+
+        Args:
+            cmd (list): the IQ-TREE command.
+            inputs (list): paths to the files read by IQ-TREE.
+
+        Returns:
+            list: the command to run, or None if IQ-TREE had already finished.
+        """
+        from ..utils.checkpoint import iqtree_finished
+
+        prefix = self.outfiles["fasta_from_bam_trimmed"]
+        settings = self._tree_settings()
+        resumable = Path(f"{prefix}.ckp.gz").is_file() and \
+            self.checkpoint.started("run_iqtree", inputs, settings)
+        finished = Path(f"{prefix}.iqtree").is_file() or \
+            iqtree_finished(f"{prefix}.ckp.gz")
+        if resumable and finished and Path(self.outfiles["treefile"]).is_file():
+            print("IQ-TREE finished in a previous run.")
+            return None
+        if resumable and not finished:
+            print(f"Resuming IQ-TREE from {prefix}.ckp.gz")
+        elif "-redo" not in cmd:
+            cmd = cmd + ["-redo"]
+        self.checkpoint.start("run_iqtree", inputs, settings)
+        return cmd
 
     def _run_iqtree(self):
-        os.system(self.iqtree_cmd)
+        self.reused_model = self._reusable_model()
+        if self.model_cache is not None:
+            self.report.record(model_reused=bool(self.reused_model))
+        if self._partitioned():
+            self._cached("run_iqtree", [self.tree_alignment],
+                         dict(self._tree_settings(), options=self._iqtree_options()),
+                         {role: self.outfiles[role]
+                          for role in ["treefile", "partitions"]},
+                         self._run_partitioned_iqtree)
+            return
+        cmd = self._iqtree_cmd()
+        inputs = [self.tree_alignment]
+        constraint = None
+        if self.run_state is not None:
+            constraint = self.run_state.constraint_tree(
+                seq.id for seq in SeqIO.parse(self.tree_alignment, "fasta"))
+            if constraint:
+                print(f"Placing new sequences on the previous tree ({constraint}).")
+                cmd = cmd + ["-g", constraint.as_posix(), "-redo"]
+                inputs.append(constraint)
+        # the fast profile starts from a neighbour-joining tree, unless new
+        # sequences are placed on a constraint tree
+        start_tree = self.tree_profile == "fast" and not constraint
+        if start_tree:
+            cmd = cmd + ["-t", self.outfiles["start_tree"]]
+
+        def run_iqtree():
+            resume_cmd = self._iqtree_resume(cmd, inputs)
+            if resume_cmd is None:
+                return
+            if start_tree:
+                records = list(SeqIO.parse(self.tree_alignment, "fasta"))
+                if not self._start_tree([seq.id for seq in records],
+                                        len(records[0].seq), self.outfiles["start_tree"]):
+                    resume_cmd = resume_cmd[:resume_cmd.index("-t")] + \
+                        resume_cmd[resume_cmd.index("-t") + 2:]
+            self.executor.run(resume_cmd, timeout=self.timeouts.get("run_iqtree"))
+
+        self._cached(
+            "run_iqtree",
+            inputs,
+            dict(self.yaml_in["IQTREE2_SETTINGS"], other=self._iqtree_options()),
+            {suffix: self.outfiles["fasta_from_bam_trimmed"] + suffix
+             for suffix in IQTREE_SUFFIXES},
+            run_iqtree,
+        )
+        self._cache_model(f"{self.outfiles['fasta_from_bam_trimmed']}.iqtree")
+        if self.run_state is not None and Path(self.outfiles["treefile"]).is_file():
+            self.run_state.save_tree(self.outfiles["treefile"])
+
+    def _partition_workers(self):
+        """The neighbourhoods processed at once: PARTITION_SETTINGS workers,
+        or with AUTO one per thread of the IQ-TREE -T option (all cores if
+        it is AUTO).
+        """
+        from ..utils.batch import IQTREE_THREAD_OPTS, configured_threads
+
+        workers = self.partition_settings.get("workers", "AUTO")
+        if str(workers).upper() == "AUTO":
+            return configured_threads(self._iqtree_options(), IQTREE_THREAD_OPTS)
+        return int(workers)
+
+    def _run_partitioned_iqtree(self):
+        """Infer a tree per neighbourhood of similar sequences, in parallel,
+        and join the rooted trees at a common root.
+
+        Neighbourhoods are grouped so that sequences closer than
+        distance_fraction (times distance_factor) share a neighbourhood, so
+        no cluster spans two trees.  IQ-TREE runs in PARTITION_SETTINGS
+        workers at a time, sharing the cores.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from ete3 import Tree
+        from ..utils.batch import IQTREE_THREAD_OPTS, configured_threads
+        from ..utils.checkpoint import atomic_path
+        from ..utils.partition import (neighbourhoods, pool_small, merge_trees,
+                                       write_partitions)
+
+        settings = self.partition_settings
+        picker = self.yaml_in["CLUSTER_PICKER_SETTINGS"]
+        records = {seq.id: seq for seq in SeqIO.parse(self.tree_alignment, "fasta")}
+        bound = float(picker["distance_fraction"])
+        if str(picker["distance_method"]) == "abs":  # a count of differences
+            bound /= max(len(seq.seq) for seq in records.values())
+        bound *= float(settings.get("distance_factor", 1.5))
+        with self.report.stage("partition"):
+            groups = pool_small(neighbourhoods(
+                list(records), [str(seq.seq) for seq in records.values()], bound,
+                int(settings.get("k_mer", 15)), int(settings.get("sketch_size", 128))))
+            self.report.record(sequences=len(records), neighbourhoods=len(groups))
+        print(f"Partitioned {len(records)} sequences into {len(groups)} "
+              f"neighbourhoods (largest {max(len(group) for group in groups)}).")
+        write_partitions(groups, self.outfiles["partitions"])
+
+        threads = configured_threads(self._iqtree_options(), IQTREE_THREAD_OPTS)
+        workers = min(len(groups), self._partition_workers())
+        cmd = shlex.split(str(self.yaml_in["IQTREE2_SETTINGS"]["executable"])) + \
+            IQTREE_THREAD_OPTS.sub("", self._iqtree_options()).split() + [
+            "-T", str(max(1, threads // workers)), "-redo"]
+        root = None if self.root == "midpoint" else self.root
+        # trees of a previous attempt with the same inputs are reused
+        inputs = [self.tree_alignment]
+        resumable = self.checkpoint.started("run_iqtree", inputs, self._tree_settings())
+        self.checkpoint.start("run_iqtree", inputs, self._tree_settings())
+        Path(self.partition_dir).mkdir(exist_ok=True)
+
+        def infer(number, group):
+            fasta = make_path(self.partition_dir, f"neighbourhood{number}.fa")
+            if not (resumable and Path(f"{fasta}.iqtree").is_file()
+                    and Path(f"{fasta}.treefile").is_file()):
+                if root in records and root not in group:
+                    group = group + [root]
+                SeqIO.write([records[seqid] for seqid in group], fasta, "fasta")
+                start_tree = []
+                if self.tree_profile == "fast" and self._start_tree(
+                        group, len(records[group[0]].seq), f"{fasta}.nj.nwk"):
+                    start_tree = ["-t", f"{fasta}.nj.nwk"]
+                self.executor.run(cmd + ["-s", fasta] + start_tree,
+                                  timeout=self.timeouts.get("run_iqtree"))
+            return Tree(f"{fasta}.treefile", format=0)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            trees = list(pool.map(self.report.bind(infer),
+                                  range(1, len(groups) + 1), groups))
+        # the largest neighbourhood gives the best-supported model choice
+        largest = max(range(len(groups)), key=lambda number: len(groups[number]))
+        self._cache_model(
+            make_path(self.partition_dir, f"neighbourhood{largest + 1}.fa.iqtree"))
+        tree = merge_trees(trees, root if root in records else None, bound)
+        with atomic_path(self.outfiles["treefile"]) as tmp:
+            tree.write(outfile=tmp, dist_formatter="%0.16f")
 
     def root_iqtree(self):
         """Midpoint or user-defined root setting of iqtree.
         """
         from ete3 import Tree
+        from ..utils.checkpoint import atomic_path
         tree = Tree(self.outfiles["treefile"], format=0)
         root_ = self.root
         root = None
-        if root_ == 'midpoint':
+        if self._partitioned():
+            pass  # each neighbourhood tree was rooted before they were joined
+        elif root_ == 'midpoint':
             root = tree.get_midpoint_outgroup()
         else:
             root = root_
-        tree.set_outgroup(root)
+        if root is not None:
+            tree.set_outgroup(root)
         tree.ladderize(direction=1)
         # dist_formatter is to prevent scientific notation.
         # with branch lengths in scientific notation, ClusterPicker dies.
-        tree.write(outfile=self.outfiles["rooted_treefile"], dist_formatter="%0.16f")
+        with atomic_path(self.outfiles["rooted_treefile"]) as tmp:
+            tree.write(outfile=tmp, dist_formatter="%0.16f")
+
+    def _pick_clusters(self):
+        """
+        Pick clusters with the built-in cluster picker, writing the
+        ClusterPicker outputs.
+        :return: None
+        """
+        from Bio import AlignIO
+        from ete3 import Tree
+        from ..utils.cluster_picker import pick_clusters, write_cluster_picks
+
+        settings = self.yaml_in["CLUSTER_PICKER_SETTINGS"]
+        tree = Tree(self.outfiles["rooted_treefile"], format=0)
+        alignment = AlignIO.read(self.tree_alignment, "fasta")
+
+        def pick(node, node_alignment):
+            return pick_clusters(
+                node,
+                node_alignment,
+                float(settings["coarse_subtree_support"]),
+                self.fine_cluster_support,
+                float(settings["distance_fraction"]),
+                str(settings["distance_method"]),
+            )
+
+        try:
+            if self._partitioned():
+                clusters = self._pick_neighbourhood_clusters(tree, alignment, pick)
+            else:
+                clusters = pick(tree, alignment)
+        except ValueError as exc:
+            sys.exit(f"Unable to pick clusters: {exc}")
+        self.report.record(clusters=len(clusters))
+        # ClusterPicker names these after both input files
+        prefix = make_path(
+            self.outdir,
+            f"{Path(self.tree_alignment).name}_"
+            f"{Path(self.outfiles['rooted_treefile']).stem}_clusterPicks",
+        )
+        write_cluster_picks(tree, alignment, clusters,
+                            int(settings["large_cluster_threshold"]), {
+                                "nwk": self.outfiles["clusterpicked_nwk"],
+                                "figtree": self.outfiles["clusterpicked_tree"],
+                                "list": self.outfiles["cluster_list"],
+                                "log": self.outfiles["cluster_assignments"],
+                                "fas": f"{prefix}.fas",
+                                "large_cluster": f"{prefix}_cluster{{}}_sequenceList.txt",
+                            })
+
+    def _pick_neighbourhood_clusters(self, tree, alignment, pick):
+        """Pick the clusters of each neighbourhood of a joined tree in
+        parallel.
+
+        Args:
+            tree (ete3.Tree): the joined tree, with a neighbourhood (or the
+                root tip) as each child of the root.
+            alignment (MultipleSeqAlignment): alignment of the tips.
+            pick (callable): picks the clusters of a node and its alignment.
+
+        Returns:
+            list: (node, maximum distance) tuples, in tree order.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from Bio.Align import MultipleSeqAlignment
+
+        records = {seq.id: seq for seq in alignment}
+        nodes = [node for node in tree.children if not node.is_leaf()]
+        with ThreadPoolExecutor(max_workers=self._partition_workers()) as pool:
+            picks = pool.map(lambda node: pick(node, MultipleSeqAlignment(
+                records[name] for name in node.get_leaf_names() if name in records)),
+                nodes)
+            return [cluster for clusters in picks for cluster in clusters]
+
+    def sweep_clusters(self, fine_cluster_supports, distance_fractions):
+        """Pick clusters for many thresholds using the tree of a finished run.
+
+        Args:
+            fine_cluster_supports (list): minimum cluster supports to try.
+            distance_fractions (list): distance thresholds to try.
+
+        Returns:
+            str: the prefix of the sweep output files.
+        """
+        from Bio import AlignIO
+        from ete3 import Tree
+        from ..utils.cluster_picker import sweep_clusters, write_sweep
+        from ..utils.tree_profiles import support_threshold
+
+        # the rooted tree holds every sequence, including collapsed haplotypes
+        for fname in [self.outfiles["fasta_from_bam_trimmed"],
+                      self.outfiles["rooted_treefile"]]:
+            if not Path(fname).is_file():
+                sys.exit(f"Unable to find {fname}.  Run 'havic detect' with "
+                         f"this yaml before sweeping cluster thresholds.")
+        settings = self.yaml_in["CLUSTER_PICKER_SETTINGS"]
+        tree = Tree(self.outfiles["rooted_treefile"], format=0)
+        alignment = AlignIO.read(self.outfiles["fasta_from_bam_trimmed"], "fasta")
+        prefix = make_path(self.outdir, f"{self.yaml_in['RUN_PREFIX']}clusterPicks")
+        try:
+            write_sweep(
+                sweep_clusters(
+                    tree,
+                    alignment,
+                    float(settings["coarse_subtree_support"]),
+                    [support_threshold(value, self.support)
+                     for value in fine_cluster_supports],
+                    [float(value) for value in distance_fractions],
+                    str(settings["distance_method"]),
+                ),
+                tree.get_leaf_names(),
+                prefix,
+            )
+        except ValueError as exc:
+            sys.exit(f"Unable to sweep cluster thresholds: {exc}")
+        return prefix
 
     def _clusterpick(self):
         """
         Run CLUSTER_PICKER on the tree and alignment
         :return: None
         """
-        os.system(self.clusterpick_cmd)
+        settings = self.yaml_in["CLUSTER_PICKER_SETTINGS"]
+        if self.collapse:
+            # a previous pick may have expanded the rooted tree
+            self.root_iqtree()
+        if str(settings.get("engine", "ClusterPicker")).lower() == "native":
+            pick = self._pick_clusters
+        else:
+            def pick():
+                self.executor.run(self.clusterpick_cmd,
+                                  timeout=self.timeouts.get("clusterpick"))
+        self._cached(
+            "clusterpick",
+            [self.tree_alignment, self.outfiles["rooted_treefile"]],
+            settings,
+            {role: self.outfiles[role] for role in
+             ["clusterpicked_tree", "clusterpicked_nwk", "cluster_list",
+              "cluster_assignments"]},
+            pick,
+        )
+        if self.collapse:
+            self._expand_haplotypes()
+            # the rooted tree now holds the collapsed sequences too
+            self.checkpoint.refresh("root_iqtree")
 
     def _plot_results(self):
         """
@@ -319,6 +1248,9 @@ class Pipeline:
 
         :return: None
         """
+        if self.plots_engine == "matplotlib":
+            self._plot_in_process()
+            return
         print("Starting results summaries using R")
         with open(self.outfiles["treeplotr"], "w") as out_r:
             from ..plotters.treeplot_snpplot import plot_functions
@@ -335,10 +1267,7 @@ class Pipeline:
                 )
                 .replace(
                     "supportvals <- b",
-                    "supportvals <- "
-                    + str(
-                        self.yaml_in["CLUSTER_PICKER_SETTINGS"]["fine_cluster_support"]
-                    ),
+                    "supportvals <- " + f"{self.fine_cluster_support:g}",
                 )
                 .replace(
                     "method <- hh",
@@ -361,7 +1290,208 @@ class Pipeline:
             )
             # print(cmd)
             out_r.write(cmd)
-        os.system(f"R CMD BATCH {self.outfiles['treeplotr']} {self.outfiles['treeplotr_out']}")
+        self.executor.run(
+            ["R", "CMD", "BATCH",
+             self.outfiles['treeplotr'], self.outfiles['treeplotr_out']],
+            timeout=self.timeouts.get("plot_results_ggtree"))
+
+    def _plot_in_process(self):
+        """Draw the tree with alignment and the SNP heatmap with matplotlib.
+
+        The two figures are drawn in parallel worker threads.
+        """
+        if not self.yaml_in["PLOTS"]:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        from Bio import AlignIO
+        from ete3 import Tree
+        from ..plotters.matplotlib_plots import (cluster_assignments,
+                                                 plot_tree_msa,
+                                                 plot_snp_heatmap)
+
+        print("Starting results summaries using matplotlib")
+        settings = self.yaml_in["CLUSTER_PICKER_SETTINGS"]
+        tree = Tree(self.outfiles["rooted_treefile"], format=0)
+        clusters = cluster_assignments(Tree(self.outfiles["clusterpicked_nwk"], format=1))
+        alignment = AlignIO.read(self.outfiles["fasta_from_bam_trimmed"], "fasta")
+        ids, snps = self._load_snp_matrix()
+        heatmap = self.yaml_in.get("HEATMAP_SETTINGS") or {}
+        subtitle = (f"Clusters (coloured labels) have been picked as clades with >= "
+                    f"{self.fine_cluster_support:g}% {self.support} support and "
+                    f"divergence <= {float(settings['distance_fraction']) * 100:g}% "
+                    f"(distance method='{settings['distance_method']}')")
+        highlight = [correct_characters(i)
+                     for i in self.yaml_in.get("HIGHLIGHT_TIP") or []]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [
+                pool.submit(plot_tree_msa, tree, alignment, clusters, highlight,
+                            subtitle, self.outfiles["tree_msa_pdf"]),
+                pool.submit(plot_snp_heatmap, ids, snps, tree.get_leaf_names(),
+                            clusters, self.outfiles["snp_heatmap_pdf"],
+                            max_cells=int(heatmap.get("max_cells", 2000)),
+                            max_tiles=int(heatmap.get("cluster_tiles", 20))),
+            ]
+            for future in futures:
+                future.result()
+
+    def _stages(self):
+        """The body of each pipeline stage, in run order.
+
+        Each stage is timed in the run report and skipped if the checkpoint
+        manifest shows it completed with the same inputs and settings.
+
+        Returns:
+            dict: callables keyed on stage name.
+        """
+        def compile_input_fasta():
+            with self.report.stage("compile_input_fasta"):
+                self._checkpointed(
+                    "compile_input_fasta",
+                    self.query_files + [self.target_region_file] + list(
+                        filter(None, [self.yaml_in.get("QUERY_STORE_IDS")])),
+                    [self.outfiles["tmp_fasta"],
+                     self.outfiles["seq_header_replacements"]],
+                    {key: self.yaml_in.get(key) for key in
+                     ["TREE_ROOT", "REPORT_IDENTICAL_SEQS"]},
+                    self._compile_input_fasta,
+                )
+
+        def map_input_fasta_to_ref():
+            with self.report.stage("map_input_fasta_to_ref"):
+                self._checkpointed(
+                    "map_input_fasta_to_ref",
+                    [self.outfiles["tmp_fasta"], self.subject],
+                    [self.mapped_output] if self.in_process_mapping
+                    else [self.outfiles["tmp_bam"], self.outfiles["tmp_bam_idx"]],
+                    self.yaml_in["MAPPER_SETTINGS"],
+                    self._map_in_process if self.in_process_mapping
+                    else self._map_input_fasta_to_ref,
+                )
+
+        def get_cleaned_fasta():
+            def clean():
+                aln = self._get_clean_fasta_alignment()
+                if aln and len(aln) < 3:
+                    exit_statement = (
+                        f"{aln}\n"
+                        f"Need at least three sequences in "
+                        f"alignment to continue (n={len(aln)})"
+                    )
+                    sys.exit(exit_statement)
+
+            with self.report.stage("get_cleaned_fasta"):
+                self._checkpointed(
+                    "get_cleaned_fasta",
+                    [self.mapped_output],
+                    [self.outfiles["fasta_from_bam_trimmed"]],
+                    {key: self.yaml_in.get(key) for key in
+                     ["TRIM_SEQS", "WRITE_STACKED_FASTA"]},
+                    clean,
+                )
+
+        def collapse_haplotypes():
+            with self.report.stage("collapse_haplotypes"):
+                self._checkpointed(
+                    "collapse_haplotypes",
+                    [self.outfiles["fasta_from_bam_trimmed"]],
+                    [self.outfiles["haplotypes"], self.outfiles["haplotype_map"]],
+                    {"TREE_ROOT": self.yaml_in["TREE_ROOT"]},
+                    self._collapse_haplotypes,
+                )
+
+        def run_iqtree():
+            with self.report.stage("run_iqtree"):
+                self._checkpointed(
+                    "run_iqtree",
+                    [self.tree_alignment] + (
+                        list(self.snp_outputs.values()) if self.tree_profile == "fast"
+                        else []),
+                    [self.outfiles["treefile"]] + (
+                        [self.outfiles["partitions"]] if self._partitioned() else []),
+                    self._tree_settings(),
+                    self._run_iqtree,
+                )
+
+        def root_iqtree():
+            with self.report.stage("root_iqtree"):
+                self._checkpointed(
+                    "root_iqtree",
+                    [self.outfiles["treefile"]],
+                    [self.outfiles["rooted_treefile"]],
+                    {"TREE_ROOT": self.yaml_in["TREE_ROOT"]},
+                    self.root_iqtree,
+                )
+
+        def clusterpick():
+            with self.report.stage("clusterpick"):
+                self._checkpointed(
+                    "clusterpick",
+                    [self.tree_alignment, self.outfiles["rooted_treefile"]],
+                    [self.outfiles[role] for role in
+                     ["clusterpicked_tree", "clusterpicked_nwk", "cluster_list",
+                      "cluster_assignments"]],
+                    self.yaml_in["CLUSTER_PICKER_SETTINGS"],
+                    self._clusterpick,
+                )
+
+        def snp_dists():
+            with self.report.stage("snp_dists"):
+                self._checkpointed(
+                    "snp_dists",
+                    [self.outfiles["fasta_from_bam_trimmed"]],
+                    list(self.snp_outputs.values()),
+                    {},
+                    self._snp_dists,
+                )
+
+        def plot_results():
+            with self.report.stage("plot_results"):
+                self._checkpointed(
+                    "plot_results",
+                    [self.outfiles["fasta_from_bam_trimmed"],
+                     self.outfiles["rooted_treefile"], self.outfiles["cluster_list"]]
+                    + list(self.snp_outputs.values()),
+                    self.plot_outputs,
+                    {key: self.yaml_in.get(key) for key in
+                     ["CLUSTER_PICKER_SETTINGS", "MAPPER_SETTINGS", "PLOTS",
+                      "HIGHLIGHT_TIP", "PLOTS_ENGINE", "HEATMAP_SETTINGS"]},
+                    self._plot_results,
+                )
+
+        # snp_dists precedes run_iqtree for the fast profile's start tree
+        stages = {
+            "compile_input_fasta": compile_input_fasta,
+            "map_input_fasta_to_ref": map_input_fasta_to_ref,
+            "get_cleaned_fasta": get_cleaned_fasta,
+            "collapse_haplotypes": collapse_haplotypes,
+            "snp_dists": snp_dists,
+            "run_iqtree": run_iqtree,
+            "root_iqtree": root_iqtree,
+            "clusterpick": clusterpick,
+            "plot_results": plot_results,
+        }
+        if not self.collapse:
+            del stages["collapse_haplotypes"]
+        return stages
+
+    def update(self):
+        """Run the stages in order in this process, without Ruffus.
+
+        Unlike _run(), this may be called repeatedly on the same Pipeline
+        (e.g., by 'havic serve' as sequences arrive): stages whose inputs
+        are unchanged are skipped, and the mapping index stays loaded.
+        """
+        from ..utils.instrumentation import RunReport
+
+        Path(self.outdir).mkdir(parents=True, exist_ok=True)
+        self.report = RunReport(self.report.json_path, self.report.tsv_path)
+        self.tree_sequences = None
+        self.snp_matrix = None
+        try:
+            for stage in self._stages().values():
+                stage()
+        finally:
+            self.report.write()
 
     def _run(self):
         """
@@ -369,6 +1499,15 @@ class Pipeline:
 
         :return: None
         """
+        from ruffus import (
+            mkdir,
+            follows,
+            files,
+            pipeline_run,
+            pipeline_printout_graph as pipeprintgraph,
+        )
+
+        stages = self._stages()
 
         # Pipeline starts here with Ruffus
         @mkdir(self.outdir)
@@ -378,80 +1517,89 @@ class Pipeline:
         @follows(create_outdir)
         @files(self.query_files, self.outfiles["tmp_fasta"], self.target_region)
         def compile_input_fasta(infile, outfile, refamplicon):
-            self._compile_input_fasta()
+            stages["compile_input_fasta"]()
 
         @follows(compile_input_fasta)
-        @files(self.outfiles["tmp_fasta"], self.outfiles["tmp_bam"])
+        @files(self.outfiles["tmp_fasta"], self.mapped_output)
         def map_input_fasta_to_ref(infile, outfile):
-            self._map_input_fasta_to_ref()
+            stages["map_input_fasta_to_ref"]()
 
         @follows(map_input_fasta_to_ref)
-        @files(self.outfiles["tmp_bam"], self.outfiles["fasta_from_bam"])
-        def bam2fasta(infile, outfile):
-            self._bam2fasta()
-
-        @follows(bam2fasta)
-        @files(self.outfiles["fasta_from_bam"], self.outfiles["fasta_from_bam_trimmed"])
+        @files(self.mapped_output, self.outfiles["fasta_from_bam_trimmed"])
         def get_cleaned_fasta(infile, outfile):
-            aln = self._get_clean_fasta_alignment()
-            if aln and len(aln) < 3:
-                exit_statement = (
-                    f"{aln}\n"
-                    f"Need at least three sequences in "
-                    f"alignment to continue (n={len(aln)})"
-                )
-                import sys
+            stages["get_cleaned_fasta"]()
 
-                sys.exit(exit_statement)
+        tasks = [create_outdir, compile_input_fasta, map_input_fasta_to_ref,
+                 get_cleaned_fasta]
+        tree_input_task = get_cleaned_fasta
+        if self.collapse:
+            @follows(get_cleaned_fasta)
+            @files(self.outfiles["fasta_from_bam_trimmed"], self.outfiles["haplotypes"])
+            def collapse_haplotypes(infile, outfile):
+                stages["collapse_haplotypes"]()
+
+            tree_input_task = collapse_haplotypes
+            tasks.append(collapse_haplotypes)
 
         @follows(get_cleaned_fasta)
-        @files(self.outfiles["fasta_from_bam_trimmed"], self.outfiles["rooted_treefile"])
+        @files(self.outfiles["fasta_from_bam_trimmed"], self.outfiles["snp_dists"])
+        def snp_dists(infile, outfile):
+            stages["snp_dists"]()
+
+        # the fast tree profile starts from a tree of the SNP distances
+        @follows(tree_input_task, *([snp_dists] if self.tree_profile == "fast" else []))
+        @files(self.tree_alignment, self.outfiles["rooted_treefile"])
         def run_iqtree(infile, outfile):
-            self._run_iqtree()
+            stages["run_iqtree"]()
 
         @follows(run_iqtree)
         @files(self.outfiles["treefile"], self.outfiles["rooted_treefile"])
         def root_iqtree(infile, outfile):
-            self.root_iqtree()
+            stages["root_iqtree"]()
 
         @follows(root_iqtree)
         @files(
-            [self.outfiles["fasta_from_bam_trimmed"], self.outfiles["rooted_treefile"]],
+            [self.tree_alignment, self.outfiles["rooted_treefile"]],
             self.outfiles["clusterpicked_tree"],
         )
         def clusterpick_from_rooted_iqtree_and_cleaned_fasta(infile, outfile):
-            self._clusterpick()
+            stages["clusterpick"]()
 
-        @follows(clusterpick_from_rooted_iqtree_and_cleaned_fasta)
+        @follows(clusterpick_from_rooted_iqtree_and_cleaned_fasta, snp_dists)
         @files(
             [self.outfiles["fasta_from_bam_trimmed"], self.outfiles["rooted_treefile"]],
             self.outfiles["treeplotr"],
         )
         def plot_results_ggtree(infiles, outfiles):
-            self._plot_results()
+            stages["plot_results"]()
 
-        # Run the pipeline
+        tasks += [run_iqtree, root_iqtree,
+                  clusterpick_from_rooted_iqtree_and_cleaned_fasta, snp_dists,
+                  plot_results_ggtree]
+
+        # Run the pipeline; two threads let snp_dists run alongside the
+        # IQ-TREE and ClusterPicker stages (before them in the fast tree
+        # profile).  Every task is forced to run, and the checkpoint manifest
+        # skips the stages completed by a previous run.  Ruffus still needs a
+        # history file, so it is given a throwaway one that is never read.
         import tempfile
+        from ..utils.checkpoint import Checkpoint
 
-        with tempfile.TemporaryDirectory() as tmpfile:
-            db_name = ".ruffus_history.sqlite"
-            temp_sqlite = Path(tmpfile).joinpath(db_name)
-            perm_sqlite = Path(self.outdir).joinpath(db_name)
-            if self.yaml_in["FORCE_OVERWRITE_AND_RE_RUN"]:
-                for fname in Path(self.outdir).glob(f"{self.yaml_in['RUN_PREFIX']}*"):
-                    Path.unlink(fname)
-                pipeline_run(forcedtorun_tasks=create_outdir, history_file=temp_sqlite)
-                shutil.copyfile(temp_sqlite, perm_sqlite)
-            else:
-                if not perm_sqlite.exists():
-                    sys.exit(f'Unable to find the SQLite database. Please delete or move {self.outdir}, or set "FORCE_OVERWRITE_AND_RE_RUN" to "Yes" in the run.yaml file.')
-                else:
-                    shutil.copyfile(perm_sqlite, temp_sqlite)
-                    pipeline_run(history_file=temp_sqlite)
-                    shutil.copyfile(temp_sqlite, perm_sqlite)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                if self.yaml_in["FORCE_OVERWRITE_AND_RE_RUN"]:
+                    clear_outputs(self.outdir, self.yaml_in["RUN_PREFIX"])
+                    self.checkpoint = Checkpoint(self.checkpoint.manifest)
+                pipeline_run(forcedtorun_tasks=tasks,
+                             history_file=Path(tmpdir).joinpath("ruffus.sqlite"),
+                             multithread=2)
 
-            # Print out the pipeline graph
-            pipeprintgraph(make_path(self.outdir, "pipeline_graph.svg"), "svg")
+                # Print out the pipeline graph
+                pipeprintgraph(make_path(self.outdir, "pipeline_graph.svg"), "svg")
+        finally:
+            # Write the per-stage resource usage next to the pipeline graph
+            if Path(self.outdir).is_dir():
+                self.report.write()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""A memory-mapped, indexed sequence store.
+
+A store is a pair of files: 'name.hvs' holds the sequences, one byte per
+base, back to back, and 'name.hvs.idx' is a tab-separated index of the id,
+offset, length and sha1 digest of each sequence (akin to a samtools '.fai').
+Sequences are read straight from the memory-mapped file, so selecting and
+streaming a subset of a large archive does not re-parse any fasta, and
+identical sequences can be found from the index digests alone.
+
+Stores may be listed in QUERY_FILES in place of fasta files, and are built
+with 'havic store'.
+"""
+
+import hashlib
+import mmap
+import os
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqRecord import SeqRecord
+from Bio.Seq import Seq
+
+STORE_SUFFIX = ".hvs"
+INDEX_SUFFIX = ".idx"
+INDEX_HEADER = "#ID\tOFFSET\tLENGTH\tSHA1\n"
+
+
+def is_store(fname):
+    """The file is a sequence store.
+
+    Args:
+        fname (str): path to a query file.
+
+    Returns:
+        bool: True if the path has the store suffix.
+
+    >>> is_store("archive.hvs"), is_store("archive.fa")
+    (True, False)
+    """
+    return str(fname).endswith(STORE_SUFFIX)
+
+
+def sequence_digest(seq):
+    """The sha1 hex digest of a sequence, ignoring case and gaps.
+
+    >>> sequence_digest("ac-gt") == sequence_digest("ACGT")
+    True
+    """
+    return hashlib.sha1(seq.replace("-", "").upper().encode()).hexdigest()
+
+
+def build_store(fasta_paths, store_path):
+    """Write the sequences of fasta files to a store.
+
+    Repeated sequence ids are skipped, keeping the first.
+
+    Args:
+        fasta_paths (list): paths to the input fasta files.
+        store_path (str): path to the output '.hvs' file.
+
+    Returns:
+        tuple: (number of sequences stored, number of duplicate ids skipped)
+    """
+    tmp_store = f"{store_path}.{os.getpid()}.tmp"
+    tmp_index = f"{store_path}{INDEX_SUFFIX}.{os.getpid()}.tmp"
+    seen = set()
+    skipped = 0
+    offset = 0
+    with open(tmp_store, "wb") as store_h, open(tmp_index, "w") as index_h:
+        index_h.write(INDEX_HEADER)
+        for fasta_path in fasta_paths:
+            with open(fasta_path, "r") as fasta_h:
+                for title, seq in SimpleFastaParser(fasta_h):
+                    seqid = title.split(None, 1)[0] if title.strip() else ""
+                    if seqid in seen:
+                        skipped += 1
+                        continue
+                    seen.add(seqid)
+                    seq = "".join(seq.split())
+                    store_h.write(seq.encode("ascii"))
+                    index_h.write(f"{seqid}\t{offset}\t{len(seq)}\t"
+                                  f"{sequence_digest(seq)}\n")
+                    offset += len(seq)
+    # the two files cannot be replaced together; a reader that opens them in
+    # between sees a store whose size does not match its index and retries
+    os.replace(tmp_store, store_path)
+    os.replace(tmp_index, f"{store_path}{INDEX_SUFFIX}")
+    return len(seen), skipped
+
+
+class SeqStore:
+    """Read sequences from a store."""
+
+    def __init__(self, store_path, attempts=3):
+        """
+        Args:
+            store_path (str): path to the '.hvs' file.
+            attempts (int): times to read the store and its index while they
+                do not match, e.g. while the store is being rebuilt.
+
+        Raises:
+            ValueError: if the store size does not match its index.
+        """
+        self.store_path = store_path
+        for _ in range(attempts):
+            self.index = {}
+            with open(f"{store_path}{INDEX_SUFFIX}", "r") as index_h:
+                next(index_h)
+                for line in index_h:
+                    seqid, offset, length, digest = line.rstrip("\n").split("\t")
+                    self.index[seqid] = (int(offset), int(length), digest)
+            self._store_h = open(store_path, "rb")
+            size = os.fstat(self._store_h.fileno()).st_size
+            if size == sum(length for _, length, _ in self.index.values()):
+                break
+            self._store_h.close()
+        else:
+            raise ValueError(f"The store {store_path} does not match its index.")
+        self._data = mmap.mmap(self._store_h.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else b""
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, seqid):
+        return seqid in self.index
+
+    def close(self):
+        """Release the memory map."""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._store_h.close()
+
+    def fetch(self, seqid):
+        """Get a sequence by id.
+
+        Args:
+            seqid (str): the sequence id.
+
+        Returns:
+            str: the sequence.
+        """
+        offset, length, _ = self.index[seqid]
+        return self._data[offset:offset + length].decode("ascii")
+
+    def digest(self, seqid):
+        """Get the sha1 digest of a sequence by id, without reading it."""
+        return self.index[seqid][2]
+
+    def records(self, seqids=None):
+        """Stream sequences as SeqRecords.
+
+        Args:
+            seqids (iterable): ids to select, in the order given, or None for
+                all sequences in store order.  Ids not in the store are
+                skipped.
+
+        Yields:
+            SeqRecord: the selected sequences, with the stored digest in
+                annotations["sha1"].
+        """
+        for seqid in self.index if seqids is None else seqids:
+            if seqid in self.index:
+                yield SeqRecord(Seq(self.fetch(seqid)), id=seqid, description="",
+                                annotations={"sha1": self.digest(seqid)})
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""Keep a pipeline in memory and pick the clusters of submitted sequences.
+
+'havic serve' parses the reference and target region and loads the mapping
+index once, then answers HTTP requests on a local port or Unix socket:
+
+    POST /jobs        a fasta batch; returns a job id (202 Accepted)
+    GET  /jobs/<id>   the job status and, when done, the cluster of each
+                      submitted sequence (null if it was not clustered)
+    GET  /status      the number of updates run and jobs queued
+
+Submitted batches are appended to {RUN_PREFIX}service_queries.fa in the
+OUTDIR, which is added to QUERY_FILES.  A single worker runs the pipeline
+updates, and the batches submitted while an update runs, or within the
+coalesce window, are combined into the next update.
+"""
+
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from .paths import absolute_path, correct_characters, make_path
+from .validate import sequence_ids
+
+SERVICE_QUERIES = "service_queries.fa"
+
+
+def parse_fasta(text):
+    """Parse a fasta batch.
+
+    Args:
+        text (str): fasta formatted sequences.
+
+    Returns:
+        list: (id, sequence) tuples.
+
+    >>> parse_fasta(">a first\\nACGT\\nAC\\n>b\\nTT\\n")
+    [('a', 'ACGTAC'), ('b', 'TT')]
+    """
+    records = []
+    for block in text.split(">")[1:]:
+        lines = block.splitlines() or [""]
+        name = lines[0].split(None, 1)[0] if lines[0].strip() else ""
+        seq = "".join(line.strip() for line in lines[1:])
+        if not name or not seq:
+            raise ValueError("Every fasta record needs an id and a sequence.")
+        records.append((name, seq))
+    if not records or text.lstrip()[:1] != ">":
+        raise ValueError("The request body must be fasta formatted sequences.")
+    return records
+
+
+def read_clusters(fname):
+    """Read the cluster of each sequence from a cluster list.
+
+    Args:
+        fname (str): path to the '_clusterPicks_list.txt' file.
+
+    Returns:
+        dict: cluster number keyed on sequence name.
+    """
+    if not Path(fname).is_file():
+        return {}
+    with open(fname, "r") as list_h:
+        next(list_h, None)
+        return {name: int(number) for name, number in
+                (line.rstrip("\n").split("\t")[:2] for line in list_h if line.strip())}
+
+
+class JobQueue:
+    """Run the submitted batches in coalesced updates on a worker thread."""
+
+    def __init__(self, update, coalesce_secs=2.0):
+        """
+        Args:
+            update (callable): takes a list of (id, sequence) tuples, updates
+                the pipeline, and returns the cluster number of each id
+                (None if it was not clustered).
+            coalesce_secs (float): seconds to wait for further submissions
+                before an update starts.
+        """
+        self.update = update
+        self.coalesce_secs = coalesce_secs
+        self.jobs = {}
+        self.updates = 0
+        self._records = {}
+        self._pending = []
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def submit(self, records):
+        """Queue a batch.
+
+        Args:
+            records (list): (id, sequence) tuples.
+
+        Returns:
+            str: the job id.
+        """
+        job = uuid.uuid4().hex[:12]
+        with self._condition:
+            self.jobs[job] = {
+                "job": job,
+                "status": "queued",
+                "submitted": datetime.now().isoformat(timespec="seconds"),
+                "sequences": len(records),
+            }
+            self._records[job] = records
+            self._pending.append(job)
+            self._condition.notify()
+        return job
+
+    def status(self, job=None):
+        """The state of a job, or of the queue.
+
+        Args:
+            job (str): a job id, or None for the queue.
+
+        Returns:
+            dict: a copy of the job (None if unknown), or the queue summary.
+        """
+        with self._condition:
+            if job is not None:
+                return dict(self.jobs[job]) if job in self.jobs else None
+            return {"updates": self.updates, "queued": len(self._pending),
+                    "jobs": len(self.jobs)}
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            time.sleep(self.coalesce_secs)  # let concurrent submissions join
+            with self._condition:
+                batch, self._pending = self._pending, []
+                self.updates += 1
+                for job in batch:
+                    self.jobs[job].update(status="running", update=self.updates)
+                records = [record for job in batch for record in self._records.pop(job)]
+            try:
+                clusters = self.update(records)
+            except (Exception, SystemExit) as exc:  # the pipeline exits on bad input
+                with self._condition:
+                    for job in batch:
+                        self.jobs[job].update(status="failed", error=str(exc))
+                continue
+            with self._condition:
+                for job, (start, end) in zip(batch, _spans(batch, self.jobs)):
+                    self.jobs[job].update(
+                        status="done",
+                        finished=datetime.now().isoformat(timespec="seconds"),
+                        clusters={name: clusters.get(name)
+                                  for name, _ in records[start:end]})
+
+
+def _spans(batch, jobs):
+    """The slice of the coalesced records submitted by each job."""
+    start = 0
+    for job in batch:
+        yield start, start + jobs[job]["sequences"]
+        start += jobs[job]["sequences"]
+
+
+class Service:
+    """The in-memory pipeline behind 'havic serve'."""
+
+    def __init__(self, yaml_in, coalesce_secs=2.0):
+        """
+        Args:
+            yaml_in (dict): the parsed yaml config.
+            coalesce_secs (float): see JobQueue.
+        """
+        from .pipeline_runner import Pipeline, clear_outputs
+
+        Path(yaml_in["OUTDIR"]).mkdir(parents=True, exist_ok=True)
+        if yaml_in["FORCE_OVERWRITE_AND_RE_RUN"]:
+            clear_outputs(yaml_in["OUTDIR"], yaml_in["RUN_PREFIX"])
+        self.query_file = Path(make_path(
+            yaml_in["OUTDIR"], f"{yaml_in['RUN_PREFIX']}{SERVICE_QUERIES}")).resolve()
+        self.query_file.touch()
+        # The configured queries, as absolute paths alongside the service file
+        query_files = [str(path) for path in
+                       (absolute_path(fname, yaml_in["DEFAULT_QUERIES"])
+                        for fname in yaml_in["QUERY_FILES"] or []) if path]
+        self.known = {correct_characters(seqid)
+                      for fname in query_files + [self.query_file]
+                      for seqid in sequence_ids(fname)}
+        self.pipeline = Pipeline(dict(
+            yaml_in, DEFAULT_QUERIES=False, FORCE_OVERWRITE_AND_RE_RUN=False,
+            QUERY_FILES=query_files + [str(self.query_file)]))
+        self.pipeline.update()
+        self._lock = threading.Lock()
+        self.queue = JobQueue(self.update, coalesce_secs)
+
+    def submit(self, records):
+        """Queue a batch of new sequences.
+
+        Args:
+            records (list): (id, sequence) tuples.
+
+        Returns:
+            str: the job id.
+
+        Raises:
+            ValueError: if a sequence id is already in the run.
+        """
+        names = [correct_characters(name) for name, _ in records]
+        with self._lock:
+            repeated = sorted({name for name in names if name in self.known}
+                              | {name for name in names if names.count(name) > 1})
+            if repeated:
+                raise ValueError(
+                    f"Sequence ids already in the run: {', '.join(repeated)}")
+            self.known.update(names)
+            return self.queue.submit(records)
+
+    def update(self, records):
+        """Add sequences to the run and pick the clusters.
+
+        Args:
+            records (list): (id, sequence) tuples.
+
+        Returns:
+            dict: cluster number (or None) keyed on the submitted id.
+
+        A failed update removes the batch from the query file and from the
+        known ids, so that it can be corrected and submitted again.
+        """
+        size = self.query_file.stat().st_size
+        with open(self.query_file, "a") as fasta_h:
+            for name, seq in records:
+                fasta_h.write(f">{name}\n{seq}\n")
+        try:
+            self.pipeline.update()
+        except (Exception, SystemExit):
+            with open(self.query_file, "r+") as fasta_h:
+                fasta_h.truncate(size)
+            with self._lock:
+                self.known.difference_update(
+                    correct_characters(name) for name, _ in records)
+            raise
+        clusters = read_clusters(self.pipeline.outfiles["cluster_list"])
+        return {name: clusters.get(correct_characters(name)) for name, _ in records}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """The HTTP API of a Service (self.server.service)."""
+
+    def _send(self, code, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": f"Unknown path {self.path}"})
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            records = parse_fasta(self.rfile.read(length).decode())
+            job = self.server.service.submit(records)
+        except (UnicodeDecodeError, ValueError) as exc:
+            return self._send(400, {"error": str(exc)})
+        return self._send(202, {"job": job, "status": "queued"},
+                          {"Location": f"/jobs/{job}"})
+
+    def do_GET(self):
+        queue = self.server.service.queue
+        path = self.path.rstrip("/")
+        if path == "/status":
+            return self._send(200, queue.status())
+        if path.startswith("/jobs/"):
+            job = queue.status(path[len("/jobs/"):])
+            if job is None:
+                return self._send(404, {"error": f"Unknown job {path[len('/jobs/'):]}"})
+            return self._send(200, job)
+        return self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """A threading HTTP server on a Unix socket."""
+
+    daemon_threads = True
+
+
+def serve(yaml_in, host="127.0.0.1", port=8765, socket_path=None, coalesce_secs=2.0):
+    """Run the service until interrupted.
+
+    Args:
+        yaml_in (dict): the parsed yaml config.
+        host (str): the address to listen on.
+        port (int): the port to listen on.
+        socket_path (str): listen on this Unix socket instead of a port.
+        coalesce_secs (float): see JobQueue.
+    """
+    service = Service(yaml_in, coalesce_secs)
+    if socket_path:
+        if Path(socket_path).exists():
+            os.unlink(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        address = f"http://{host}:{server.server_address[1]}"
+    server.service = service
+    print(f"\nhavic serve listening on {address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and Path(socket_path).exists():
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""Pairwise SNP distances from a multiple sequence alignment.
+
+The alignment is encoded once as an (n x L) uint8 matrix.  Sites holding an
+IUPAC ambiguity code, a gap or '?' in either member of a pair are excluded
+from that pair's comparison.  Counts are computed blockwise as matrix
+products so that large alignments can be spread over several cores.
+
+A distance store keeps the matrices of the last run keyed on the digest of
+each aligned row and of the row fixing the alignment window, so that a
+later run with the same window only compares its new or changed rows
+against the others.
+
+Input:
+    MultipleSeqAlignment
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# IUPAC ambiguity codes (Biostrings::IUPAC_CODE_MAP minus A, C, G, T), plus
+# gap and unknown characters.
+EXCLUDED_CHARS = b"MRWSYKVHDBN-?"
+
+
+def encode_alignment(alignment):
+    """Encode an alignment as an upper-case uint8 character matrix.
+
+    Args:
+        alignment (MultipleSeqAlignment): the input alignment.
+
+    Returns:
+        tuple: list of sequence ids, (n x L) uint8 numpy array.
+    """
+    ids = [seq.id for seq in alignment]
+    width = alignment.get_alignment_length()
+    matrix = np.frombuffer(
+        "".join(str(seq.seq) for seq in alignment).upper().encode("ascii"),
+        dtype=np.uint8,
+    ).reshape(len(ids), width)
+    return ids, matrix
+
+
+def valid_sites(matrix, excluded=EXCLUDED_CHARS):
+    """Mask of sites that take part in pairwise comparisons.
+
+    Args:
+        matrix (np.ndarray): (n x L) uint8 character matrix.
+        excluded (bytes): characters to exclude from comparisons.
+
+    Returns:
+        np.ndarray: (n x L) boolean mask, True where the site is valid.
+    """
+    return ~np.isin(matrix, np.frombuffer(excluded.upper(), dtype=np.uint8))
+
+
+def _block_counts(matrix, valid, rows, cols, codes, site_chunk):
+    """SNP and comparable-site counts for a block of rows against columns."""
+    snps = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype=np.float32)
+    sites = np.zeros_like(snps)
+    for start in range(0, matrix.shape[1], site_chunk):
+        chunk = slice(start, start + site_chunk)
+        row_chars, col_chars = matrix[rows, chunk], matrix[cols, chunk]
+        row_valid, col_valid = valid[rows, chunk], valid[cols, chunk]
+        sites += row_valid.astype(np.float32) @ col_valid.T.astype(np.float32)
+        for code in codes:
+            snps -= ((row_chars == code) & row_valid).astype(np.float32) @ (
+                (col_chars == code) & col_valid
+            ).T.astype(np.float32)
+    # mismatches are comparable sites that are not matches
+    snps += sites
+    return snps.astype(np.int32), sites.astype(np.int32)
+
+
+def pairwise_blocks(matrix, valid, others=None, block_size=512, threads=None,
+                    site_chunk=2048, rows=None):
+    """Yield pairwise counts one block of rows at a time.
+
+    Args:
+        matrix (np.ndarray): (n x L) uint8 character matrix.
+        valid (np.ndarray): (n x L) boolean mask from valid_sites().
+        others (slice): columns (sequences) to compare against, default all.
+        block_size (int): number of rows per block.
+        threads (int): worker threads, default os.cpu_count().
+        site_chunk (int): number of alignment columns per matrix product.
+        rows (slice): rows (sequences) to compare, default all.
+
+    Yields:
+        tuple: (row slice, SNP counts block, comparable sites block).
+    """
+    others = others or slice(0, matrix.shape[0])
+    rows = rows or slice(0, matrix.shape[0])
+    codes = np.unique(matrix[valid])
+    blocks = [
+        slice(start, min(start + block_size, rows.stop))
+        for start in range(rows.start, rows.stop, block_size)
+    ]
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        results = pool.map(
+            lambda rows: _block_counts(matrix, valid, rows, others, codes, site_chunk),
+            blocks,
+        )
+        for rows, (snps, sites) in zip(blocks, results):
+            yield rows, snps, sites
+
+
+def snp_distances(alignment, block_size=512, threads=None):
+    """Compute the full pairwise SNP and comparable-site matrices.
+
+    Args:
+        alignment (MultipleSeqAlignment): the input alignment.
+        block_size (int): number of rows per block.
+        threads (int): worker threads, default os.cpu_count().
+
+    Returns:
+        tuple: sequence ids, (n x n) SNP counts, (n x n) comparable sites.
+    """
+    ids, matrix = encode_alignment(alignment)
+    valid = valid_sites(matrix)
+    snps = np.zeros((len(ids), len(ids)), dtype=np.int32)
+    sites = np.zeros_like(snps)
+    for rows, snps_block, sites_block in pairwise_blocks(
+        matrix, valid, block_size=block_size, threads=threads
+    ):
+        snps[rows] = snps_block
+        sites[rows] = sites_block
+    return ids, snps, sites
+
+
+def row_digests(matrix):
+    """The sha1 hex digest of each aligned row.
+
+    A row holds the sequence at its alignment coordinates, so a sequence that
+    is aligned or trimmed differently has a different digest.
+
+    Args:
+        matrix (np.ndarray): (n x L) uint8 character matrix.
+
+    Returns:
+        list: hex digests, in row order.
+
+    >>> keys = row_digests(np.frombuffer(b"ACGTACGTAC-T", dtype=np.uint8).reshape(3, 4))
+    >>> keys[0] == keys[1], keys[0] == keys[2]
+    (True, False)
+    """
+    return [hashlib.sha1(row.tobytes()).hexdigest() for row in matrix]
+
+
+def read_snp_store(store_npz):
+    """Read a distance store written by write_snp_store().
+
+    Args:
+        store_npz (str): path to the store.
+
+    Returns:
+        tuple: window, row digests, (n x n) SNP counts, (n x n) comparable
+            sites, or None if the store is missing or unreadable.
+    """
+    try:
+        with np.load(store_npz) as archive:
+            return (str(archive["window"]), archive["keys"].tolist(),
+                    archive["snps"], archive["sites"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_snp_store(window, keys, snps, sites, store_npz):
+    """Write a distance store, uncompressed so that it loads quickly.
+
+    The store is replaced only once it is complete.
+
+    Args:
+        window (str): digest of the row that fixes the alignment coordinates.
+        keys (list): row digests, in matrix order.
+        snps (np.ndarray): (n x n) SNP counts.
+        sites (np.ndarray): (n x n) comparable sites.
+        store_npz (str): output path.
+    """
+    with open(f"{store_npz}.tmp", "wb") as npz_h:  # a handle keeps the suffix as given
+        np.savez(npz_h, window=np.array(window), keys=np.array(keys, dtype=str),
+                 snps=snps, sites=sites)
+    os.replace(f"{store_npz}.tmp", store_npz)
+
+
+def stored_snp_distances(alignment, store_npz, anchor=None, block_size=512,
+                         threads=None):
+    """Compute the pairwise SNP matrices, reusing the pairs in a distance store.
+
+    The store is only used if the anchor row is unchanged: trimming can move
+    the alignment window, which changes the comparable sites of every pair.
+    Rows whose digest is in the store are then copied from it, and only the
+    new rows are compared against all the rows (n x k comparisons for k new
+    rows).  The store is rewritten with the rows of this alignment.
+
+    Args:
+        alignment (MultipleSeqAlignment): the input alignment.
+        store_npz (str): path to the distance store.
+        anchor (str): id of the row that fixes the alignment coordinates,
+            e.g. the target region; default the alignment length.
+        block_size (int): number of rows per block.
+        threads (int): worker threads, default os.cpu_count().
+
+    Returns:
+        tuple: sequence ids, (n x n) SNP counts, (n x n) comparable sites,
+            number of rows computed.
+    """
+    ids, matrix = encode_alignment(alignment)
+    keys = row_digests(matrix)
+    window = keys[ids.index(anchor)] if anchor in ids else str(matrix.shape[1])
+    stored = read_snp_store(store_npz)
+    index = {key: idx for idx, key in enumerate(stored[1])} \
+        if stored and stored[0] == window else {}
+    known = [row for row, key in enumerate(keys) if key in index]
+    new = [row for row, key in enumerate(keys) if key not in index]
+    # Compare in the order known then new rows, and restore the input order
+    order = np.array(known + new, dtype=np.intp)
+    matrix = matrix[order]
+    snps = np.zeros((len(ids), len(ids)), dtype=np.int32)
+    sites = np.zeros_like(snps)
+    if known:
+        source = np.array([index[keys[row]] for row in known], dtype=np.intp)
+        snps[:len(known), :len(known)] = stored[2][np.ix_(source, source)]
+        sites[:len(known), :len(known)] = stored[3][np.ix_(source, source)]
+    if new:
+        for rows, snps_block, sites_block in pairwise_blocks(
+            matrix, valid_sites(matrix), block_size=block_size, threads=threads,
+            rows=slice(len(known), len(ids)),
+        ):
+            snps[rows], snps[:, rows] = snps_block, snps_block.T
+            sites[rows], sites[:, rows] = sites_block, sites_block.T
+    inverse = np.argsort(order)
+    snps, sites = snps[np.ix_(inverse, inverse)], sites[np.ix_(inverse, inverse)]
+    write_snp_store(window, keys, snps, sites, store_npz)
+    return ids, snps, sites, len(new)
+
+
+def write_snp_csvs(ids, snps, sites, snpdists_csv, counts_csv):
+    """Write the SNP matrices in the layout of R's write.csv(quote=FALSE).
+
+    Args:
+        ids (list): sequence ids, in matrix order.
+        snps (np.ndarray): (n x n) SNP counts.
+        sites (np.ndarray): (n x n) comparable sites.
+        snpdists_csv (str): path to the SNP counts csv.
+        counts_csv (str): path to the SNP counts over alignment length csv.
+    """
+    header = "," + ",".join(ids) + "\n"
+    with open(snpdists_csv, "w") as dists_h, open(counts_csv, "w") as counts_h:
+        dists_h.write(header)
+        counts_h.write(header)
+        for seqid, snps_row, sites_row in zip(ids, snps, sites):
+            dists_h.write(seqid + "," + ",".join(map(str, snps_row)) + "\n")
+            counts_h.write(
+                seqid + ","
+                + ",".join(f"={snp}/{site}" for snp, site in zip(snps_row, sites_row))
+                + "\n"
+            )
+
+
+def read_snp_csv(snpdists_csv):
+    """Read the SNP counts written by write_snp_csvs().
+
+    Args:
+        snpdists_csv (str): path to the SNP counts csv.
+
+    Returns:
+        tuple: sequence ids, (n x n) SNP counts.
+    """
+    with open(snpdists_csv, "r") as dists_h:
+        ids = next(dists_h).rstrip("\n").split(",")[1:]
+        snps = np.array([line.rstrip("\n").split(",")[1:] for line in dists_h],
+                        dtype=np.int32).reshape(len(ids), len(ids))
+    return ids, snps
+
+
+def write_snp_npz(ids, snps, sites, snpdists_npz):
+    """Write the SNP matrices to a compressed numpy archive.
+
+    Args:
+        ids (list): sequence ids, in matrix order.
+        snps (np.ndarray): (n x n) SNP counts.
+        sites (np.ndarray): (n x n) comparable sites.
+        snpdists_npz (str): output path.
+    """
+    with open(snpdists_npz, "wb") as npz_h:  # a handle keeps the suffix as given
+        np.savez_compressed(npz_h, ids=np.array(ids, dtype=str), snps=snps,
+                            sites=sites)
+
+
+def read_snp_npz(snpdists_npz):
+    """Read the SNP counts written by write_snp_npz().
+
+    Args:
+        snpdists_npz (str): path to the archive.
+
+    Returns:
+        tuple: sequence ids, (n x n) SNP counts.
+    """
+    with np.load(snpdists_npz) as archive:
+        return archive["ids"].tolist(), archive["snps"]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
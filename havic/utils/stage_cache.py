@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""A content-addressed cache of pipeline stage outputs.
+
+Each stage is keyed on the contents of its input files plus the yaml
+settings that affect it.  On a hit, the stored outputs are copied into the
+current OUTDIR instead of re-running the stage.  The cache can be shared
+between runs and output directories, and is kept below a maximum size by
+evicting the least recently used entries.  Each entry lists the roles it
+stores, and an entry with a missing file (e.g. evicted by another run while
+it is read) is a miss.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from .. import __version__
+
+ROLES_FILE = ".roles.json"  # the output roles stored in an entry
+
+
+def file_digest(fname, chunk_size=1 << 20):
+    """Hash the contents of a file.
+
+    Args:
+        fname (str): path to the file.
+        chunk_size (int): bytes read at a time.
+
+    Returns:
+        str: hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(fname, "rb") as input_h:
+        for chunk in iter(lambda: input_h.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Store and retrieve stage outputs keyed on their inputs and settings."""
+
+    def __init__(self, directory, max_size_gb=10):
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(float(max_size_gb) * 1024 ** 3)
+
+    def key(self, stage, inputs, settings):
+        """Build the cache key for a stage.
+
+        Args:
+            stage (str): stage name.
+            inputs (list): paths to the input files.
+            settings (dict): yaml settings used by the stage.
+
+        Returns:
+            str: hex digest.
+        """
+        digest = hashlib.sha256()
+        digest.update(f"{__version__}\t{stage}\n".encode())
+        for fname in inputs:
+            digest.update(file_digest(fname).encode())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key, outputs):
+        """Copy the stored outputs of a stage into place.
+
+        Args:
+            key (str): cache key.
+            outputs (dict): output file paths keyed on role.
+
+        Returns:
+            bool: True on a cache hit.
+        """
+        entry = self.directory.joinpath(key)
+        try:
+            roles = json.loads(entry.joinpath(ROLES_FILE).read_text())
+            if not all(entry.joinpath(role).is_file() for role in roles):
+                return False
+            for role, fname in outputs.items():
+                if role in roles:
+                    shutil.copyfile(entry.joinpath(role), fname)
+            os.utime(entry)  # mark as recently used
+        except (OSError, ValueError):  # no entry, or evicted while reading
+            return False
+        return True
+
+    def store(self, key, outputs):
+        """Store the outputs of a stage, then evict old entries.
+
+        Args:
+            key (str): cache key.
+            outputs (dict): output file paths keyed on role.  Missing files
+                (optional outputs the stage did not write) are skipped, and
+                the stored roles are listed in the entry.
+        """
+        entry = self.directory.joinpath(key)
+        if entry.is_dir():
+            return
+        staging = Path(tempfile.mkdtemp(dir=self.directory, prefix=".tmp_"))
+        roles = [role for role, fname in outputs.items() if Path(fname).is_file()]
+        for role in roles:
+            shutil.copyfile(outputs[role], staging.joinpath(role))
+        staging.joinpath(ROLES_FILE).write_text(json.dumps(roles))
+        try:
+            staging.rename(entry)
+        except OSError:  # another run stored the same entry first
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until below the size limit.
+
+        Only entries (directories holding ROLES_FILE) are counted and
+        removed, so other files kept in the cache directory are left alone.
+        """
+        entries = []
+        for entry in self.directory.iterdir():
+            if entry.joinpath(ROLES_FILE).is_file():
+                try:
+                    size = sum(fname.stat().st_size for fname in entry.iterdir())
+                    entries.append((entry.stat().st_mtime, size, entry))
+                except FileNotFoundError:  # evicted by another run
+                    continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
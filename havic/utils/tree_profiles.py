@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+"""Tree inference profiles for the run_iqtree stage.
+
+The 'full' profile runs IQ-TREE with the IQTREE2_SETTINGS 'other' options as
+given (ModelFinder and ultrafast bootstraps by default).  The 'fast' profile
+reuses the substitution model selected by an earlier run on the same
+SUBJECT_TARGET_REGION, starts the tree search from a neighbour-joining tree
+of the SNP distances, and measures branch support with the SH-aLRT test in
+place of UFBoot.  As the two support metrics differ in scale, the
+fine_cluster_support threshold (given for UFBoot) is scaled to the metric
+used.
+
+A cached model is stored with a fingerprint of the alignment it was
+selected on (length, base frequencies and the fraction of variable sites),
+and is only reused while the tree alignment stays within model_drift of
+that fingerprint.
+"""
+
+import hashlib
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from .checkpoint import atomic_path
+
+PROFILES = ("full", "fast")
+SUPPORTS = ("ufboot", "alrt")
+# Support at or above which a branch is considered reliable (IQ-TREE manual)
+RELIABLE_SUPPORT = {"ufboot": 95.0, "alrt": 80.0}
+SUPPORT_OPTIONS = {"ufboot": "-B", "alrt": "-alrt"}
+MODEL_OPTS = re.compile(r"(?<!\S)(-m|--model)\s+\S+")
+START_TREE_OPTS = re.compile(r"(?<!\S)(-t|--tree)\s+\S+")
+SUPPORT_OPTS = re.compile(
+    r"(?<!\S)(-B|-bb|--ufboot|-alrt|--alrt|-b|--boot)\s+\S+|(?<!\S)(-bnni|--bnni)(?!\S)")
+BEST_MODEL = re.compile(r"Best-fit model according to \w+: (\S+)")
+# ModelFinder runs for these -m values, or if -m is not given
+MODELFINDER = re.compile(r"MF|TEST")
+MODEL_PARAMETERS = {
+    "rates": re.compile(r"^\s+([ACGT]-[ACGT]): (\S+)$", re.MULTILINE),
+    "frequencies": re.compile(r"^\s+pi\(([ACGT])\) = (\S+)$", re.MULTILINE),
+    "gamma_alpha": re.compile(r"^Gamma shape alpha: (\S+)$", re.MULTILINE),
+    "invariable_sites": re.compile(r"^Proportion of invariable sites: (\S+)$",
+                                   re.MULTILINE),
+}
+BASES = "ACGT"
+# Sequences encoded at a time for the alignment fingerprint
+CHUNK_SIZE = 1024
+# Rows of the neighbour-joining Q matrix searched at a time (kept in cache)
+BLOCK_SIZE = 64
+
+
+def support_metric(settings):
+    """The branch support metric of an IQTREE2_SETTINGS section.
+
+    Args:
+        settings (dict): the IQTREE2_SETTINGS.
+
+    Returns:
+        str: 'ufboot' or 'alrt'.
+
+    >>> support_metric({"profile": "fast"}), support_metric({})
+    ('alrt', 'ufboot')
+    """
+    fast = str(settings.get("profile", "full")).lower() == "fast"
+    default = "alrt" if fast else "ufboot"
+    return str(settings.get("support") or default).lower()
+
+
+def support_threshold(threshold, support):
+    """Scale a UFBoot support threshold to another support metric.
+
+    Args:
+        threshold (float): the threshold for UFBoot.
+        support (str): the support metric of the tree.
+
+    Returns:
+        float: the equivalent threshold.
+
+    >>> support_threshold(95, "alrt"), support_threshold(90, "ufboot")
+    (80.0, 90.0)
+    """
+    scale = RELIABLE_SUPPORT[support] / RELIABLE_SUPPORT["ufboot"]
+    return round(float(threshold) * scale, 2)
+
+
+def tree_options(other, support, replicates, model=None):
+    """Rewrite IQ-TREE options for a support metric and model.
+
+    Args:
+        other (str): the IQTREE2_SETTINGS 'other' options.
+        support (str): 'ufboot' or 'alrt'.
+        replicates (int): bootstrap or SH-aLRT replicates.
+        model (str): a substitution model replacing '-m', or None to keep it.
+
+    Returns:
+        str: the options, without a start tree.
+
+    >>> tree_options("-T AUTO -m MFP+FO --ufboot 2000 -bnni", "alrt", 1000, "GTR+F+G4")
+    '-T AUTO -alrt 1000 -m GTR+F+G4'
+    """
+    options = START_TREE_OPTS.sub("", SUPPORT_OPTS.sub("", str(other))).split()
+    options += [SUPPORT_OPTIONS[support], str(replicates)]
+    if model:
+        options = MODEL_OPTS.sub("", " ".join(options)).split() + ["-m", model]
+    return " ".join(options)
+
+
+def region_key(seq):
+    """Key a target region on its sequence.
+
+    Args:
+        seq (str): the target region sequence.
+
+    Returns:
+        str: hex digest.
+    """
+    return hashlib.sha1(str(seq).upper().replace("-", "").encode()).hexdigest()
+
+
+def runs_modelfinder(other):
+    """IQ-TREE options select the model with ModelFinder.
+
+    Args:
+        other (str): the IQTREE2_SETTINGS 'other' options.
+
+    Returns:
+        bool: True if '-m' names a ModelFinder mode or is not given.
+
+    >>> runs_modelfinder("-m MFP+FO -B 1000"), runs_modelfinder("-m GTR+G4")
+    (True, False)
+    """
+    match = MODEL_OPTS.search(str(other))
+    return match is None or bool(MODELFINDER.search(match.group(0).split()[1]))
+
+
+def alignment_fingerprint(seqs):
+    """Summarise the composition of an alignment.
+
+    Args:
+        seqs (iterable): aligned sequences (str).
+
+    Returns:
+        dict: the alignment length, number of sequences, A, C, G and T
+            frequencies, and the fraction of sites holding more than one
+            of A, C, G and T.
+
+    >>> alignment_fingerprint(["ACGT", "ACGA", "AC-A"])["variable_sites"]
+    0.25
+    """
+    codes = np.frombuffer(BASES.encode(), dtype=np.uint8)
+    counts = np.zeros(len(BASES), dtype=np.int64)
+    present, sequences, length = None, 0, 0
+
+    def add(chunk):
+        nonlocal present
+        matrix = np.frombuffer("".join(chunk).upper().encode("ascii"),
+                               dtype=np.uint8).reshape(len(chunk), -1)
+        found = np.stack([(matrix == code).any(axis=0) for code in codes])
+        present = found if present is None else present | found
+        counts[:] += [(matrix == code).sum() for code in codes]
+
+    chunk = []
+    for seq in seqs:
+        chunk.append(str(seq))
+        sequences += 1
+        length = len(chunk[-1])
+        if len(chunk) == CHUNK_SIZE:
+            add(chunk)
+            chunk = []
+    if chunk:
+        add(chunk)
+    total = max(int(counts.sum()), 1)
+    return {
+        "length": length,
+        "sequences": sequences,
+        "frequencies": {base: round(int(count) / total, 6)
+                        for base, count in zip(BASES, counts)},
+        "variable_sites": round(
+            float((present.sum(axis=0) > 1).mean()) if length else 0.0, 6),
+    }
+
+
+def fingerprint_drift(selected, current):
+    """How far an alignment has drifted from the one a model was selected on.
+
+    Args:
+        selected (dict): alignment_fingerprint() when the model was selected,
+            or None.
+        current (dict): alignment_fingerprint() of the current alignment.
+
+    Returns:
+        float: the largest of the relative change in length, the total
+            variation distance between the base frequencies, and the change
+            in the fraction of variable sites (infinite without a
+            fingerprint).
+
+    >>> old = {"length": 400, "frequencies": {"A": 0.3, "C": 0.2, "G": 0.2, "T": 0.3},
+    ...        "variable_sites": 0.20}
+    >>> new = {"length": 404, "frequencies": {"A": 0.29, "C": 0.21, "G": 0.2, "T": 0.3},
+    ...        "variable_sites": 0.23}
+    >>> round(fingerprint_drift(old, new), 3)
+    0.03
+    """
+    if not selected:
+        return float("inf")
+    return max(
+        abs(current["length"] - selected["length"]) / max(selected["length"], 1),
+        0.5 * sum(abs(current["frequencies"][base] - selected["frequencies"][base])
+                  for base in BASES),
+        abs(current["variable_sites"] - selected["variable_sites"]),
+    )
+
+
+def model_parameters(report):
+    """Read the estimated model parameters from an IQ-TREE report.
+
+    Args:
+        report (str): path to the '.iqtree' file.
+
+    Returns:
+        dict: substitution rates and base frequencies keyed on base (pair),
+            and the gamma shape and proportion of invariable sites, where
+            the model has them.
+    """
+    with open(report, "r") as report_h:
+        text = report_h.read()
+    parameters = {}
+    for name, pattern in MODEL_PARAMETERS.items():
+        found = pattern.findall(text)
+        if found and isinstance(found[0], tuple):
+            parameters[name] = {key: float(value) for key, value in found}
+        elif found:
+            parameters[name] = float(found[0])
+    return parameters
+
+
+def best_model(report):
+    """Read the model chosen by ModelFinder from an IQ-TREE report.
+
+    Args:
+        report (str): path to the '.iqtree' file.
+
+    Returns:
+        str: the best-fit model, or None if ModelFinder did not run.
+    """
+    if not Path(report).is_file():
+        return None
+    with open(report, "r") as report_h:
+        match = BEST_MODEL.search(report_h.read())
+    return match.group(1) if match else None
+
+
+class ModelCache:
+    """Substitution models selected by ModelFinder, keyed on target region.
+
+    Each entry holds the model, its estimated parameters and the fingerprint
+    of the alignment it was selected on.  The cache is a json file that may
+    be shared between runs and configs.
+    """
+
+    def __init__(self, fname):
+        """
+        Args:
+            fname (str): path to the json file.
+        """
+        self.fname = Path(fname).expanduser()
+
+    def _read(self):
+        if not self.fname.is_file():
+            return {}
+        with open(self.fname, "r") as cache_h:
+            return json.load(cache_h)
+
+    def get(self, key):
+        """The cached model of a target region.
+
+        Args:
+            key (str): the region_key() of the target region.
+
+        Returns:
+            dict: the 'model', 'parameters', 'fingerprint' and 'selected'
+                date, or None.
+        """
+        entry = self._read().get(key)
+        return {"model": entry} if isinstance(entry, str) else entry
+
+    def put(self, key, model, parameters=None, fingerprint=None):
+        """Cache the model of a target region.
+
+        Args:
+            key (str): the region_key() of the target region.
+            model (str): the best-fit model.
+            parameters (dict): model_parameters() of the model.
+            fingerprint (dict): alignment_fingerprint() of the alignment
+                the model was selected on.
+        """
+        self.fname.parent.mkdir(parents=True, exist_ok=True)
+        models = self._read()
+        models[key] = {
+            "model": model,
+            "parameters": parameters or {},
+            "fingerprint": fingerprint,
+            "selected": datetime.now().isoformat(timespec="seconds"),
+        }
+        with atomic_path(str(self.fname)) as tmp, open(tmp, "w") as cache_h:
+            json.dump(models, cache_h, indent=1, sort_keys=True)
+
+
+def neighbour_joining(ids, dists):
+    """Build a neighbour-joining tree (Saitou and Nei, 1987).
+
+    The Q matrix is searched in blocks of rows above its diagonal, so memory
+    use beyond the distance matrix stays linear in the number of sequences.
+
+    Args:
+        ids (list): tip names.
+        dists (array-like): (n x n) pairwise distances.
+
+    Returns:
+        str: the unrooted tree in newick format.
+
+    >>> neighbour_joining(list("abcd"), [[0, 2, 4, 4], [2, 0, 4, 4],
+    ...                                  [4, 4, 0, 2], [4, 4, 2, 0]])
+    '((a:1,b:1):2,d:1,c:1);'
+    """
+    dist = np.array(dists, dtype=np.float32)
+    labels = list(ids)
+    size = len(labels)
+    sums = dist.sum(axis=1, dtype=np.float64)
+    buffer = np.empty((min(BLOCK_SIZE, size), size), dtype=np.float32)
+    while size > 3:
+        view = dist[:size, :size]
+        best, first, second = np.inf, 0, 1
+        for start in range(0, size, BLOCK_SIZE):
+            # Q is symmetric: search the blocks on and above the diagonal
+            block = view[start:start + BLOCK_SIZE, start:]
+            q = buffer[:block.shape[0], :block.shape[1]]
+            # Q = (n - 2) d(i, j) - S(i) - S(j); S(i) is added to the row minima
+            np.multiply(block, size - 2, out=q)
+            q -= sums[start:size].astype(np.float32)
+            rows = np.arange(q.shape[0])
+            q[rows, rows] = np.inf
+            columns = q.argmin(axis=1)
+            minima = q[rows, columns] - sums[start:start + block.shape[0]]
+            row = int(np.argmin(minima))
+            if minima[row] < best:
+                best, first, second = minima[row], start + row, start + int(columns[row])
+        first, second = min(first, second), max(first, second)
+        pair = float(view[first, second])
+        length = 0.5 * pair + (sums[first] - sums[second]) / (2 * (size - 2))
+        length = min(max(length, 0.0), pair)
+        joined = 0.5 * (view[first] + view[second] - pair)
+        joined[first] = joined[second] = 0.0
+        sums[:size] += joined - view[:, first] - view[:, second]
+        sums[first] = joined.sum(dtype=np.float64)
+        labels[first] = (f"({labels[first]}:{length:.8g},"
+                         f"{labels[second]}:{pair - length:.8g})")
+        view[first] = joined
+        view[:, first] = joined
+        # move the last node into the freed row
+        last = size - 1
+        if second != last:
+            view[second] = view[last]
+            view[:, second] = view[:, last]
+            view[second, second] = 0.0
+            sums[second] = sums[last]
+            labels[second] = labels[last]
+        labels.pop()
+        size -= 1
+    if size < 3:
+        half = dist[0, size - 1] / 2
+        return "(" + ",".join(f"{label}:{half:.8g}" for label in labels) + ");"
+    lengths = [max(0.5 * (dist[i, j] + dist[i, k] - dist[j, k]), 0.0)
+               for i, j, k in [(0, 1, 2), (1, 0, 2), (2, 0, 1)]]
+    return "(" + ",".join(f"{label}:{length:.8g}"
+                          for label, length in zip(labels, lengths)) + ");"
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
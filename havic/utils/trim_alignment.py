@@ -4,14 +4,18 @@
 
 Inherits from BioPython MultipleSeqAlignment
 
+The alignment is held as an (n x L) uint8 character matrix, so that boundary
+detection, trimming and depadding are vectorised over the whole alignment.
+It is converted back to a MultipleSeqAlignment on request.
+
 Input:
     MultipleSeqAlignment
 """
 
 import sys
-from re import search#, finditer
+import numpy as np
 from Bio.Align import MultipleSeqAlignment
-from Bio.Seq import MutableSeq
+from Bio.Seq import Seq
 
 
 class Trimmed_alignment(MultipleSeqAlignment):
@@ -22,73 +26,67 @@ class Trimmed_alignment(MultipleSeqAlignment):
 
     def __init__(self, alignment, trimguide, gap_char, trim_seqs):
 
-        self.alignment = alignment
+        self.records = list(alignment)
+        self.matrix = np.frombuffer(
+            "".join(str(seq.seq) for seq in self.records).encode("ascii"),
+            dtype=np.uint8,
+        ).reshape(len(self.records), alignment.get_alignment_length()).copy()
         self.trimguide = trimguide # trim to this reference guide sequence
         self.gap_char = gap_char
-        self.boundary = [0, self.alignment.get_alignment_length()]
+        self.gap_code = ord(gap_char)
+        self.boundary = [0, self.matrix.shape[1]]
         self.trim_seqs = trim_seqs
 
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def alignment(self):
+        """The trimmed alignment as a BioPython MultipleSeqAlignment."""
+        for seq, row in zip(self.records, self.matrix):
+            seq.seq = Seq(row.tobytes().decode("ascii"))
+        return MultipleSeqAlignment(self.records)
+
     def get_refseq_boundary(self):
         """
         Get the boundary of the anchor position of the guide sequence.
         """
-        for seq in self.alignment:
+        for idx, seq in enumerate(self.records):
             if seq.id == self.trimguide: # this is the id of seq used to anchor
-                start_pos = search(f"^{self.gap_char}+", str(seq.seq))
-                if start_pos:
-                    self.boundary[0] = start_pos.span()[1]
-                end_pos = search(f"{self.gap_char}+$", str(seq.seq))
-                if end_pos:
-                    self.boundary[-1] = end_pos.span()[0]
+                bases = np.flatnonzero(self.matrix[idx] != self.gap_code)
+                if bases.size:
+                    self.boundary = [int(bases[0]), int(bases[-1]) + 1]
+                else:
+                    self.boundary = [self.matrix.shape[1], 0]
 
     def trim_seqs_to_ref(self):
         """
         Trim the requested sequences to the reference length in the alignment.
         """
-        temp_aln = MultipleSeqAlignment([])
-        for seq in self.alignment:
-            if seq.id in self.trim_seqs and self.trim_seqs:
-                sequence = MutableSeq(str(seq.seq))
-                if self.boundary[0] > 0:
-                    sequence[0:self.boundary[0]] = self.gap_char * (self.boundary[0] - 0)
-                if self.boundary[1] < len(sequence):
-                    sequence[self.boundary[1]:] = self.gap_char * (len(sequence) - self.boundary[1])
-                seq.seq = sequence
-                if set(seq.seq) == set({self.gap_char}):
-                    print(f"{seq.id} contains only gaps after trimming. "
-                        f"Removing {seq.id} from alignment.",
-                        file=sys.stderr)
-                else:
-                    temp_aln.append(seq)
-            else:
-                temp_aln.append(seq)
-        self.alignment = temp_aln
+        if not self.trim_seqs:
+            return
+        trim_rows = np.array(
+            [seq.id in self.trim_seqs for seq in self.records], dtype=bool)
+        self.matrix[trim_rows, :self.boundary[0]] = self.gap_code
+        self.matrix[trim_rows, self.boundary[1]:] = self.gap_code
+        empty = trim_rows & (self.matrix == self.gap_code).all(axis=1)
+        for idx in np.flatnonzero(empty):
+            seqid = self.records[idx].id
+            print(f"{seqid} contains only gaps after trimming. "
+                  f"Removing {seqid} from alignment.",
+                  file=sys.stderr)
+        self.records = [seq for seq, drop in zip(self.records, empty) if not drop]
+        self.matrix = self.matrix[~empty]
 
     def depad_alignment(self):
         """
         Trim the entire alignment to remove 5' and 3' gap-padding.
+
+        Leading and trailing columns holding a single character state are
+        removed.
         """
-        site_set = {self.gap_char}
-        start_pos = 0
-        # Get the start_pos for trim
-        while len(site_set) == 1:
-            site_set = set(self.alignment[:, start_pos])
-            if len(site_set) > 1:
-                break
-            else:
-                start_pos += 1
-        site_set = {self.gap_char}
-        # subtract one to put slice position inside alignment
-        end_pos = self.alignment.get_alignment_length() - 1
-
-        # Get the end position for trim
-        while len(site_set) == 1:
-            site_set = set(self.alignment[:, end_pos])
-            if len(site_set) > 1:
-                break
-            else:
-                end_pos -= 1
-        self.alignment = self.alignment[:, start_pos:end_pos + 1]
+        sites = np.flatnonzero((self.matrix != self.matrix[0]).any(axis=0))
+        self.matrix = self.matrix[:, sites[0]:sites[-1] + 1]
 
 
 if __name__ == "__main__":
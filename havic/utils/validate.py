@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""Check a yaml config without running the pipeline.
+
+The checks cover the required keys, the subject, target region and query
+paths, the TREE_ROOT, TRIM_SEQS and HIGHLIGHT_TIP sequence names, and
+the availability of the external tools in havic/data/dependencies.py that
+the config will use.  Sequence names are read from the fasta header lines
+(or a sequence store index) only, and no heavy modules are imported, so a
+config is checked in a fraction of a second.
+"""
+
+import shlex
+import shutil
+from importlib.util import find_spec
+from pathlib import Path
+from .paths import package_path, correct_characters
+from ..data.dependencies import SOFTWAREZ
+
+REQUIRED_KEYS = [
+    "FORCE_OVERWRITE_AND_RE_RUN",
+    "DEFAULT_SUBJECT",
+    "DEFAULT_QUERIES",
+    "SUBJECT_FILE",
+    "SUBJECT_TARGET_REGION",
+    "OUTDIR",
+    "TREE_ROOT",
+    "RUN_PREFIX",
+    "PLOTS",
+    "MAPPER_SETTINGS",
+    "IQTREE2_SETTINGS",
+    "CLUSTER_PICKER_SETTINGS",
+    "TRIM_SEQS",
+    "QUERY_FILES",
+]
+REQUIRED_SETTINGS = {
+    "MAPPER_SETTINGS": ["executable", "other", "k_mer"],
+    "IQTREE2_SETTINGS": ["executable", "other"],
+    "CLUSTER_PICKER_SETTINGS": ["executable", "coarse_subtree_support",
+                                "fine_cluster_support", "distance_fraction",
+                                "large_cluster_threshold", "distance_method"],
+}
+# As cluster_picker.METHODS, repeated here to avoid importing numpy.
+DISTANCE_METHODS = ("valid", "abs", "gap", "ambiguity")
+# As tree_profiles.PROFILES and SUPPORTS.
+TREE_PROFILES = ("full", "fast")
+TREE_SUPPORTS = ("ufboot", "alrt")
+
+
+def sequence_ids(fname):
+    """Read the sequence ids of a fasta file or sequence store.
+
+    Args:
+        fname (str): path to a fasta file, or a '.hvs' store.
+
+    Returns:
+        list: the sequence ids.
+    """
+    if str(fname).endswith(".hvs"):
+        with open(f"{fname}.idx", "r") as index_h:
+            next(index_h)
+            return [line.split("\t", 1)[0] for line in index_h]
+    with open(fname, "r") as fasta_h:
+        return [line[1:].split(None, 1)[0] for line in fasta_h
+                if line.startswith(">") and line[1:].strip()]
+
+
+def input_path(fname, default_path):
+    """Resolve a config path as absolute_path() does, without printing.
+
+    Args:
+        fname (str): the path given in the config.
+        default_path (bool): the path is to pre-packaged havic data.
+
+    Returns:
+        Path: the file path, or None if it is not a file.
+    """
+    if not fname:
+        return None
+    path = Path(package_path(fname) if default_path else fname)
+    return path if path.is_file() else None
+
+
+def required_tools(yaml_in):
+    """The external tools the config will run.
+
+    Args:
+        yaml_in (dict): the parsed yaml config.
+
+    Returns:
+        dict: the configured executable keyed on dependency name.
+    """
+    mapper = yaml_in["MAPPER_SETTINGS"]
+    picker = yaml_in["CLUSTER_PICKER_SETTINGS"]
+    configured = {
+        "minimap2": shlex.split(str(mapper["executable"]))[0],
+        "iqtree": shlex.split(str(yaml_in["IQTREE2_SETTINGS"]["executable"]))[0],
+        "ClusterPicker": shlex.split(str(picker["executable"]))[0],
+    }
+    tools = {name: configured.get(name, name) for name in SOFTWAREZ}
+    if str(mapper.get("engine", "minimap2")).lower() == "mappy":
+        del tools["minimap2"]
+        if not mapper.get("write_bam"):
+            del tools["samtools"]
+    if str(picker.get("engine", "ClusterPicker")).lower() == "native":
+        del tools["ClusterPicker"]
+    if str(yaml_in.get("PLOTS_ENGINE", "R")).lower() == "matplotlib":
+        del tools["R"]
+    return tools
+
+
+def validate(yaml_in):
+    """Check a config.
+
+    Args:
+        yaml_in (dict): the parsed yaml config.
+
+    Returns:
+        tuple: list of errors (the run would fail), list of warnings.
+    """
+    errors, warnings = [], []
+    missing = [key for key in REQUIRED_KEYS if key not in yaml_in]
+    missing += [f"{section}: {key}" for section, keys in REQUIRED_SETTINGS.items()
+                if isinstance(yaml_in.get(section), dict)
+                for key in keys if key not in yaml_in[section]]
+    if missing:
+        return [f"Missing config keys: {', '.join(missing)}"], warnings
+
+    subject = input_path(yaml_in["SUBJECT_FILE"], yaml_in["DEFAULT_SUBJECT"])
+    target = input_path(yaml_in["SUBJECT_TARGET_REGION"], yaml_in["DEFAULT_SUBJECT"])
+    for key, path in [("SUBJECT_FILE", subject), ("SUBJECT_TARGET_REGION", target)]:
+        if path is None:
+            errors.append(f"{key} '{yaml_in[key]}' is not a valid file path.")
+        elif len(sequence_ids(path)) != 1:
+            errors.append(f"{key} '{yaml_in[key]}' must hold exactly one sequence.")
+
+    names = set()
+    if target is not None:
+        names.update(correct_characters(seqid) for seqid in sequence_ids(target))
+    queries = []
+    for fname in yaml_in["QUERY_FILES"] or []:
+        path = input_path(fname, yaml_in["DEFAULT_QUERIES"])
+        if path is None:
+            warnings.append(f"QUERY_FILES entry '{fname}' is not a valid file path.")
+        else:
+            queries.append(path)
+            names.update(correct_characters(seqid) for seqid in sequence_ids(path))
+    if not queries:
+        errors.append("Unable to continue without input query_files.")
+
+    root = correct_characters(str(yaml_in["TREE_ROOT"]))
+    if queries and root != "midpoint" and root not in names:
+        errors.append(f"TREE_ROOT '{yaml_in['TREE_ROOT']}' must be either "
+                      f"'midpoint' or a sequence in QUERY_FILES.")
+    for key in ["TRIM_SEQS", "HIGHLIGHT_TIP"]:
+        for name in filter(None, yaml_in.get(key) or []):
+            if queries and correct_characters(str(name)) not in names:
+                warnings.append(f"{key} entry '{name}' is not in QUERY_FILES.")
+
+    method = str(yaml_in["CLUSTER_PICKER_SETTINGS"]["distance_method"])
+    if method not in DISTANCE_METHODS:
+        errors.append(f"distance_method '{method}' must be one of "
+                      f"{', '.join(DISTANCE_METHODS)}.")
+
+    iqtree = yaml_in["IQTREE2_SETTINGS"]
+    profile = str(iqtree.get("profile", "full")).lower()
+    if profile not in TREE_PROFILES:
+        errors.append(f"IQTREE2_SETTINGS profile '{profile}' must be one of "
+                      f"{', '.join(TREE_PROFILES)}.")
+    support = str(iqtree.get("support") or "ufboot").lower()
+    if support not in TREE_SUPPORTS:
+        errors.append(f"IQTREE2_SETTINGS support '{support}' must be one of "
+                      f"{', '.join(TREE_SUPPORTS)}.")
+    elif support == "ufboot" and iqtree.get("support") \
+            and int(iqtree.get("support_replicates", 1000)) < 1000:
+        errors.append("IQ-TREE needs at least 1000 ufboot support_replicates.")
+    if float(iqtree.get("model_drift", 0.05)) < 0:
+        errors.append("IQTREE2_SETTINGS model_drift must not be negative.")
+
+    mapper = yaml_in["MAPPER_SETTINGS"]
+    if int(mapper.get("chunk_size") or 0) < 0:
+        errors.append("MAPPER_SETTINGS chunk_size must not be negative.")
+    workers = str(mapper.get("workers", 1)).strip().upper()
+    if workers != "AUTO" and not (workers.isdigit() and int(workers) >= 1):
+        errors.append("MAPPER_SETTINGS workers must be AUTO or at least 1.")
+
+    partition = yaml_in.get("PARTITION_SETTINGS") or {}
+    if not 1 <= int(partition.get("k_mer", 15)) <= 31:
+        errors.append("PARTITION_SETTINGS k_mer must be between 1 and 31.")
+
+    for name, executable in required_tools(yaml_in).items():
+        if shutil.which(executable) is None:
+            errors.append(f"Unable to find {name} ('{executable}') on the PATH.")
+    if str(yaml_in["MAPPER_SETTINGS"].get("engine", "minimap2")).lower() == "mappy" \
+            and find_spec("mappy") is None:
+        errors.append("The mappy mapping engine requires the mappy python package.")
+    if str(yaml_in.get("PLOTS_ENGINE", "R")).lower() == "matplotlib" \
+            and find_spec("matplotlib") is None:
+        errors.append("The matplotlib plots engine requires the matplotlib "
+                      "python package.")
+    snp_format = str((yaml_in.get("SNP_DISTS_SETTINGS") or {}).get("format", "csv"))
+    if snp_format.lower() == "npz" and yaml_in["PLOTS"] \
+            and str(yaml_in.get("PLOTS_ENGINE", "R")).lower() != "matplotlib":
+        errors.append("The SNP_DISTS_SETTINGS npz format requires PLOTS_ENGINE "
+                      "matplotlib.")
+    return errors, warnings
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()